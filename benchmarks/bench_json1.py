@@ -0,0 +1,101 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Measures the time to read the counters of a database that has not been migrated to version 3 of the schema (i.e. the counters are in the
+#   payloads) extracting them with the JSON1 extension of sqlite3 and decoding the payloads in python (see storage.JSON1_PUSHDOWN). The
+#   database is the original layout (version 1) with payloads of the same size than real ones (about 1.2KB), created in a temporary folder.
+#
+#   $ python3 benchmarks/bench_json1.py
+#   $ python3 benchmarks/bench_json1.py --no-orjson
+#
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import osidle.payload as payload
+from osidle.common import fromepoch
+from osidle.storage import Storage, TIME_FORMAT
+
+parser = argparse.ArgumentParser(allow_abbrev=False)
+parser.add_argument("-n", "--samples", dest="samples", help="the amount of samples of the database (default: 200000)", type=int, default=200000)
+parser.add_argument("-r", "--repeat", dest="repeat", help="the amount of times that each measure is repeated (the best one is shown) (default: 2)",
+    type=int, default=2)
+parser.add_argument("--no-orjson", dest="orjson", help="decode the payloads using json instead of orjson", action="store_false", default=True)
+args = parser.parse_args()
+
+if not args.orjson:
+    payload.orjson = None
+
+# The payload of a VM as obtained from OpenStack (4 vCPUs, 3 disks and 2 NICs); the counters grow with i
+def _payload(i):
+    return {"state": "running", "driver": "libvirt", "hypervisor": "kvm", "hypervisor_os": "ubuntu", "uptime": 1000 + i, "config_drive": False,
+        "num_cpus": 4, "num_disks": 3, "num_nics": 2, "memory_details": {"maximum": 8388608, "used": random.randint(1, 8388608)},
+        "cpu_details": [{"id": c, "time": 10**9 * i + c, "utilisation": None} for c in range(4)],
+        "nic_details": [{"mac_address": "fa:16:3e:{:02x}:{:02x}:07".format(n, i % 256), "rx_octets": 1000 * i, "rx_errors": 0,
+            "rx_drop": 0, "rx_packets": random.randint(1, 10**8), "rx_rate": None, "tx_octets": 1000 * i, "tx_errors": 0,
+            "tx_drop": 0, "tx_packets": random.randint(1, 10**8), "tx_rate": None} for n in range(2)],
+        "disk_details": [{"read_bytes": 500 * i, "read_requests": random.randint(1, 10**7), "write_bytes": 500 * i,
+            "write_requests": random.randint(1, 10**7), "errors_count": -1} for d in range(3)]}
+
+# The samples of 200 VMs, in the original layout of the table (see Storage._createDB)
+def createdatabase(filename, count):
+    random.seed(1)
+    conn = sqlite3.connect(filename)
+    conn.execute("create table vmmonitor (id integer PRIMARY KEY AUTOINCREMENT, t datetime DEFAULT (STRFTIME('%Y-%m-%dT%H:%M:%fZ', 'NOW')), \
+        vmid varchar(36) NOT NULL, data text)")
+    conn.executemany("insert into vmmonitor (vmid, t, data) values (?, ?, ?)", (("{:08d}-0000-0000-0000-000000000000".format(i % 200),
+        fromepoch(1760000000 + 3 * i).strftime(TIME_FORMAT), json.dumps(_payload(i // 200))) for i in range(count)))
+    conn.commit()
+    conn.close()
+
+# The best time of a function, in seconds
+def best(fnc):
+    result = None
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        fnc()
+        t1 = time.perf_counter() - t0
+        result = t1 if result is None else min(result, t1)
+    return result
+
+def measure(filename):
+    storage = Storage(filename, readonly = True)
+    storage.connect()
+    results = {}
+    for json1 in [ False, True ]:
+        storage._json1 = json1
+        window = best(lambda: sum(len(s) for (_, s) in storage.iter_window(None, None, None, True)))
+        deltas = best(lambda: sum(len(s) for (_, s) in storage.iter_deltas()))
+        name = "json1" if json1 else "python"
+        print("{:6s} iter_window (numeric) {:7.2f}s ({:8.0f} samples/s)  iter_deltas {:7.2f}s ({:8.0f} samples/s)".format(name, window,
+            args.samples / window, deltas, args.samples / deltas))
+        results[name] = (window, deltas)
+    storage.close()
+
+    ((python_window, python_deltas), (json1_window, json1_deltas)) = (results["python"], results["json1"])
+    print("sqlite {}: json1/python time ratio {:.2f} (iter_window) {:.2f} (iter_deltas)".format(sqlite3.sqlite_version, json1_window / python_window,
+        json1_deltas / python_deltas))
+
+with tempfile.TemporaryDirectory() as folder:
+    filename = os.path.join(folder, "osidled.db")
+    print("creating a database with {} samples ({})".format(args.samples, "orjson" if payload.orjson is not None else "json"))
+    createdatabase(filename, args.samples)
+    measure(filename)
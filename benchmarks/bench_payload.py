@@ -0,0 +1,123 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Measures the throughput of decoding and encoding the payloads of the samples (and of reading them from the database) using json and
+#   orjson (see payload.json_loads and payload.json_dumps). The payloads are the ones of a database (-d) or the ones of a database of the
+#   same size than a real one (about 1.2KB per payload) that is created in a temporary folder.
+#
+#   $ python3 benchmarks/bench_payload.py
+#   $ python3 benchmarks/bench_payload.py -d /var/lib/osidled/osidled.db
+#
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import osidle.payload as payload
+from osidle.payload import PayloadCodec
+from osidle.storage import Storage
+
+parser = argparse.ArgumentParser(allow_abbrev=False)
+parser.add_argument("-d", "--database", dest="database", help="the database whose payloads are measured (default: a new database with --samples samples)",
+    default=None)
+parser.add_argument("-n", "--samples", dest="samples", help="the amount of samples of the new database (default: 200000)", type=int, default=200000)
+parser.add_argument("-r", "--repeat", dest="repeat", help="the amount of times that each measure is repeated (the best one is shown) (default: 2)",
+    type=int, default=2)
+args = parser.parse_args()
+
+# The payload of a VM as obtained from OpenStack (4 vCPUs, 3 disks and 2 NICs)
+def _payload(i):
+    return {"state": "running", "driver": "libvirt", "hypervisor": "kvm", "hypervisor_os": "ubuntu", "uptime": 1000 + i, "config_drive": False,
+        "num_cpus": 4, "num_disks": 3, "num_nics": 2, "memory_details": {"maximum": 8388608, "used": random.randint(1, 8388608)},
+        "cpu_details": [{"id": c, "time": random.randint(1, 10**13), "utilisation": None} for c in range(4)],
+        "nic_details": [{"mac_address": "fa:16:3e:{:02x}:{:02x}:07".format(n, i % 256), "rx_octets": random.randint(1, 10**11), "rx_errors": 0,
+            "rx_drop": 0, "rx_packets": random.randint(1, 10**8), "rx_rate": None, "tx_octets": random.randint(1, 10**11), "tx_errors": 0,
+            "tx_drop": 0, "tx_packets": random.randint(1, 10**8), "tx_rate": None} for n in range(2)],
+        "disk_details": [{"read_bytes": random.randint(1, 10**11), "read_requests": random.randint(1, 10**7), "write_bytes": random.randint(1, 10**11),
+            "write_requests": random.randint(1, 10**7), "errors_count": -1} for d in range(3)]}
+
+def createdatabase(filename, count):
+    random.seed(1)
+    storage = Storage(filename)
+    storage.connect()
+    batch = []
+    for i in range(count):
+        batch.append(("{:08d}-0000-0000-0000-000000000000".format(i % 500), _payload(i), 1760000000 + i))
+        if len(batch) == 5000:
+            storage.savevms(batch)
+            batch = []
+    storage.savevms(batch)
+    storage.close()
+
+# The best time of a function, in seconds
+def best(fnc):
+    result = None
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        fnc()
+        t1 = time.perf_counter() - t0
+        result = t1 if result is None else min(result, t1)
+    return result
+
+def measure(filename):
+    # The payloads stored as text (i.e. codec "none"); the compressed ones are measured as part of the reading of the database
+    conn = sqlite3.connect("file:{}?mode=ro".format(filename), uri = True)
+    rows = [ data for (data,) in conn.execute("select data from vmmonitor where typeof(data) = 'text'") ]
+    conn.close()
+    if len(rows) > 0:
+        print("{} payloads stored as text (avg. {} bytes)".format(len(rows), sum(len(r) for r in rows) // len(rows)))
+
+    codec = PayloadCodec("none")
+    orjson = payload.orjson
+    results = {}
+    for (name, module) in [ ("json", None), ("orjson", orjson) ]:
+        if (name == "orjson") and (orjson is None):
+            print("orjson is not installed")
+            break
+        payload.orjson = module
+        if len(rows) > 0:
+            objs = [ codec.decode(r) for r in rows ]
+            decode = best(lambda: [ codec.decode(r) for r in rows ])
+            encode = best(lambda: [ codec.encode(o) for o in objs ])
+            print("{:6s} decode {:7.2f}s ({:8.0f} payloads/s)  encode {:7.2f}s ({:8.0f} payloads/s)".format(name, decode, len(rows) / decode,
+                encode, len(rows) / encode))
+
+        storage = Storage(filename, readonly = True)
+        storage.connect()
+        samples = []
+        window = best(lambda: samples.append(sum(len(s) for (_, s) in storage.iter_window())))
+        storage.close()
+        print("{:6s} iter_window (payloads) {:7.2f}s ({:8.0f} samples/s)".format(name, window, samples[-1] / window))
+        results[name] = (decode if len(rows) > 0 else None, window)
+    payload.orjson = orjson
+
+    if len(results) == 2:
+        ((json_decode, json_window), (orjson_decode, orjson_window)) = (results["json"], results["orjson"])
+        if json_decode is not None:
+            print("orjson decodes the payloads {:.2f} times faster than json".format(json_decode / orjson_decode))
+        print("orjson reads the payloads {:.2f} times faster than json".format(json_window / orjson_window))
+
+if args.database is not None:
+    measure(args.database)
+else:
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, "osidled.db")
+        print("creating a database with {} samples".format(args.samples))
+        createdatabase(filename, args.samples)
+        measure(filename)
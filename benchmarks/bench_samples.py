@@ -0,0 +1,125 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+# Measures the memory and the time per sample of the incremental samples stored as dicts and as Sample records (see rawdata.Sample), and the
+#   cost per sample of the scalar path of RawData (i.e. without numpy). Using --root, the scalar path of other checkout of osidle can be
+#   measured (e.g. a git worktree of a previous version, to compare the costs before and after a change).
+#
+#   $ python3 benchmarks/bench_samples.py
+#   $ git worktree add /tmp/osidle-old <commit> && python3 benchmarks/bench_samples.py --root /tmp/osidle-old
+#
+import argparse
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+import types
+from datetime import datetime, timezone
+
+parser = argparse.ArgumentParser(allow_abbrev=False)
+parser.add_argument("--root", dest="root", help="the folder of the checkout of osidle to measure (default: the one of this script)",
+    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+parser.add_argument("-n", "--samples", dest="samples", help="the amount of samples of the series (default: 20000)", type=int, default=20000)
+parser.add_argument("-r", "--repeat", dest="repeat", help="the amount of times that each measure is repeated (the best one is shown) (default: 5)",
+    type=int, default=5)
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.abspath(args.root))
+from osidle.rawdata import RawData
+
+# Sample exists from the version of osidle in which the incremental samples are records (before, they are dicts)
+try:
+    from osidle.rawdata import Sample
+except ImportError:
+    Sample = None
+
+N = args.samples
+T0 = 1760000000.0
+
+# The samples as stored in the database (i.e. the counters, see Storage.iter_window with numeric = True)
+def numericsamples():
+    random.seed(1)
+    samples, c = [], [ 0, 0, 0 ]
+    for i in range(N):
+        c = [ c[0] + random.randint(0, 10**9), c[1] + random.randint(0, 10**6), c[2] + random.randint(0, 10**6) ]
+        samples.append({ "s": T0 + 60 * i, "tcpu_ns": c[0], "tdisk": c[1], "tnic": c[2], "ncpu": 2, "ndisk": 1, "nnic": 1, "uptime": 1000 + 60 * i })
+    return samples
+
+# The samples as obtained from the payloads (i.e. the details of the resources, see Storage.iter_window with numeric = False)
+def rawsamples():
+    random.seed(1)
+    samples, c = [], 0
+    for i in range(N):
+        c += random.randint(0, 10**9)
+        samples.append({ "s": T0 + 60 * i, "uptime": 1000 + 60 * i, "cpu_details": [ { "time": c }, { "time": c } ],
+            "disk_details": [ { "read_bytes": c, "write_bytes": c } ], "nic_details": [ { "rx_octets": c, "tx_octets": c } ] })
+    return samples
+
+# The best time of a function, in microseconds per sample
+def persample(fnc, repeat = None):
+    return min(timeit.repeat(fnc, number = 1, repeat = repeat or args.repeat)) / N * 1e6
+
+# The memory allocated by a function (that builds the samples), in bytes per sample
+def memory(fnc):
+    tracemalloc.start()
+    result = fnc()
+    (size, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size / N
+
+numeric = numericsamples()
+raw = rawsamples()
+deltas = [ d.asdict() if hasattr(d, "asdict") else dict(d) for d in RawData._convert([ dict(x) for x in raw ]) ]
+# The dates are aware, so that they are the same epochs in any version of osidle (and any timezone of the host)
+full = types.SimpleNamespace(fromdate = datetime.fromtimestamp(0, timezone.utc), todate = datetime(2100, 1, 1, tzinfo = timezone.utc))
+
+print("osidle at {} ({} samples)".format(os.path.abspath(args.root), N))
+print("incremental samples")
+print("  dict    {:8.1f} bytes/sample  build {:6.2f} us/sample  read e {:6.3f} us/sample".format(
+    memory(lambda: [ dict(d) for d in deltas ]), persample(lambda: [ dict(d) for d in deltas ]), persample(lambda: sum(d["e"] for d in deltas))))
+if Sample is not None:
+    records = [ Sample.fromsample(d) for d in deltas ]
+    print("  Sample  {:8.1f} bytes/sample  build {:6.2f} us/sample  read e {:6.3f} us/sample".format(
+        memory(lambda: [ Sample.fromsample(d) for d in deltas ]), persample(lambda: [ Sample.fromsample(d) for d in deltas ]),
+        persample(lambda: sum(d.e for d in records))))
+else:
+    records = deltas
+
+print("scalar path of RawData")
+print("  _convert (numeric samples)  {:6.2f} us/sample".format(persample(lambda: RawData._convert([ dict(x) for x in numeric ]))))
+print("  _convert (payloads)         {:6.2f} us/sample".format(persample(lambda: RawData._convert([ dict(x) for x in raw ]))))
+print("  _get (whole series)         {:6.2f} us/sample".format(persample(lambda: RawData._get(records, full.fromdate, full.todate))))
+print("  RawData (payloads)          {:6.2f} us/sample".format(persample(lambda: RawData([ dict(x) for x in raw ], full))))
+# The incremental samples are accepted by RawData from the version of osidle that stores them in the database
+try:
+    RawData(deltas[:2], full, True)
+    print("  RawData (dict deltas)       {:6.2f} us/sample".format(persample(lambda: RawData(deltas, full, True))))
+    if Sample is not None:
+        print("  RawData (Sample deltas)     {:6.2f} us/sample".format(persample(lambda: RawData(records, full, True))))
+except TypeError:
+    pass
+
+# The cost of clipping a sample (i.e. the samples at the borders of the window): the cost of a call that keeps the whole sample is subtracted
+single = [ records[1:2] ] * N
+S = records[1]["S"]
+inside = (datetime.fromtimestamp(S + 10, timezone.utc), datetime.fromtimestamp(S + 20, timezone.utc))
+around = (datetime.fromtimestamp(S - 10, timezone.utc), datetime.fromtimestamp(S + 100, timezone.utc))
+print("  clipping a sample           {:6.2f} us/sample".format(
+    persample(lambda: [ RawData._get(x, *inside) for x in single ]) - persample(lambda: [ RawData._get(x, *around) for x in single ])))
+
+r = RawData([ dict(x) for x in raw ], full)
+print("  dumpdata json               {:6.2f} us/sample".format(persample(lambda: r.dumpdata("json"), 3)))
@@ -15,15 +15,19 @@
 #
 import sys
 from .common import *
-from .storage import Storage
-import json
-from .rawdata import RawData
-from .dataseries import DataSeries
+from .sharding import newStorage
+from .storage import ROLLUP_RESOLUTIONS
+from .payload import json_dumps
+from .rawdata import newRawData
+from .dataseries import newDataSeries
 from .version import VERSION
 from uuid import UUID
 from tqdm import tqdm
 import argparse
 import os
+import atexit
+import shutil
+import tempfile
 import xlsxwriter
 import math
 from .configuration import Configuration
@@ -61,6 +65,74 @@ def dataset_to_barchart(data, lower = None, upper = None):
         res = res + barchart_graphics[p]
     return res
 
+# The maximum size of the buckets of the rollups, relative to the window of the analysis, to use them in the "auto" resolution (i.e. the
+#   buckets at the borders of the window may make the analysis deviate up to this fraction of the window)
+ROLLUP_PRECISION = 0.01
+
+# Selects the resolution of the data used for the analysis: "raw" means the samples stored by the monitor, and any other value is one of
+#   the resolutions of the rollups; "auto" selects the coarsest resolution that meets ROLLUP_PRECISION for the window
+def selectResolution(resolution, fromDate, toDate):
+    if resolution != "auto":
+        return resolution
+
+    window = (toDate - fromDate).total_seconds()
+    resolution = "raw"
+    for (name, seconds) in sorted(ROLLUP_RESOLUTIONS.items(), key = lambda x: x[1]):
+        if seconds <= window * ROLLUP_PRECISION:
+            resolution = name
+    return resolution
+
+# Reads the samples of the VMs and yields the RawData of each VM as soon as its samples are read, so that the samples of only one VM are in
+#   memory at a time; the VMs without samples are yielded with None (as soon as the VMs are known to have no samples, because the VMs are
+#   read sorted), so that the VMs after them are not kept waiting for them (see inOrder)
+# @param groups a dict (fromdate, todate, resolution): [ vmids ], so that the VMs that share the range of dates and the resolution are read
+#   in a single pass
+# @param vmargs the options of the analysis of each VM
+def iterRawData(storage, groups, vmargs, progress_fnc = None):
+    for ((fromdate, todate, resolution), vms) in groups.items():
+        vms = sorted(vms)
+        # The incremental samples are calculated when the samples are stored, so they are used directly
+        if resolution == "raw":
+            vmsamples = storage.iter_deltas(fromdate, todate, vms)
+        else:
+            vmsamples = storage.iter_rollups(fromdate, todate, vms, resolution)
+
+        i = 0
+        for vm, vmdata in vmsamples:
+            while i < len(vms) and vms[i] < vm:
+                yield (vms[i], None)
+                i += 1
+            i += 1
+
+            if callable(progress_fnc):
+                progress_fnc()
+            p_debug("reading entries for vm {}".format(vm))
+            p_debugv("{} entries found".format(len(vmdata)))
+
+            yield (vm, newRawData(vmdata, vmargs[vm], incremental = True))
+
+        for vm in vms[i:]:
+            yield (vm, None)
+
+# Yields the items (key, value) of an iterator in the order of a list of keys, as soon as possible: the items that arrive before their
+#   turn are kept until then (so nothing is kept when the items arrive in order); the items whose value is None are not yielded
+def inOrder(items, keys):
+    position = dict(zip(keys, range(len(keys))))
+    pending = {}
+    expected = 0
+    for (key, value) in items:
+        pending[position[key]] = (key, value)
+        while expected in pending:
+            (key, value) = pending.pop(expected)
+            expected += 1
+            if value is not None:
+                yield (key, value)
+
+    # The keys that did not arrive are skipped
+    for i in sorted(pending):
+        if pending[i][1] is not None:
+            yield pending[i]
+
 def correctArguments(args, beginTime, endTime):
     # Convert the thresholds to bytes
     args.threshold_disk = toBytes(args.threshold_disk)
@@ -105,7 +177,9 @@ class OutputFile:
     def print(self, data):
         if self._closed:
             raise Exception("file already closed")
-        self.f.write(data)
+        # The output is written while the progress bar is running, so it is cleared and redrawn around the output
+        with tqdm.external_write_mode(file=self.f):
+            self.f.write(data)
     def println(self, data):
         self.print(data + "\n")
     def close(self):
@@ -114,6 +188,23 @@ class OutputFile:
         self._close = True
         self.f.close()
 
+# Makes a consistent copy of the storage in a temporary folder (that is removed at exit) and connects to the copy
+# @return the storage of the copy
+def snapshotStorage(storage):
+    folder = None
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        folder = "/dev/shm"
+    folder = tempfile.mkdtemp(prefix = "osidle-", dir = folder)
+    atexit.register(shutil.rmtree, folder, True)
+
+    p_debug("making a snapshot of the database in {}".format(folder))
+    filename = storage.snapshot(folder)
+    storage.close()
+
+    storage = newStorage(filename, readonly = True)
+    storage.connect()
+    return storage
+
 def osidle_analysis():
     config = Configuration({
             "DEFAULT": {
@@ -133,6 +224,11 @@ def osidle_analysis():
                 "EPSILON_SOFT": 0.85,
                 "EPSILON_MEDIUM": 0.75,
                 "EPSILON_HARD": 0.25,
+                # The resolution of the data used for the analysis: raw (the samples), hour or day (the rollups); auto selects the coarsest resolution whose buckets are at most a 1% of the window of the analysis
+                #   (default: raw, because the rollups average the usage in each bucket, and so the scores obtained from them differ from the ones obtained from the samples)
+                "RESOLUTION": "raw",
+                # Make a consistent copy of the database (in /dev/shm, if available) and analyze the copy, so that the samples stored during the analysis are not considered (default: False)
+                "SNAPSHOT": False,
             }
             # osidle -i 176b84ae-00ef-4e5d-ba3e-1c71250e9712 -f csv --from 2w --pretty --full-report --no-cpu --no-network --level hard --threshold-disk 1M
         }
@@ -194,6 +290,8 @@ def osidle_analysis():
     parser.add_argument("--epsilon-soft", dest="epsilon_soft", help="forward-sharing epsilon for soft level (default: 0.85)", type=float, default=configuration["EPSILON_SOFT"])
     parser.add_argument("--epsilon-medium", dest="epsilon_medium", help="forward-sharing epsilon for medium level (default: 0.75)", type=float, default=configuration["EPSILON_MEDIUM"])
     parser.add_argument("--epsilon-hard", dest="epsilon_hard", help="forward-sharing epsilon for hard level (default: 0.25)", type=float, default=configuration["EPSILON_HARD"])
+    parser.add_argument("--resolution", dest="resolution", help="resolution of the data used for the analysis: the raw samples or the hourly or daily rollups; auto selects the coarsest resolution whose buckets are at most a 1%% of the window of the analysis; the scores obtained from the rollups differ from the ones obtained from the raw samples (default: raw)", choices = ["auto", "raw", *ROLLUP_RESOLUTIONS.keys()], default=configuration["RESOLUTION"])
+    parser.add_argument("--snapshot", dest="snapshot", help="make a consistent copy of the database (in /dev/shm, if available) and analyze the copy, so that the samples stored during the analysis are not considered", action="store_true", default=configuration["SNAPSHOT"])
     parser.add_argument('--version', action='version', version=VERSION)
 
     args = parser.parse_args()
@@ -204,9 +302,15 @@ def osidle_analysis():
         if args.verbosemore:
             setVerbose(2)
 
-    # Connect to the database (if possible)
-    storage = Storage(args.database)
+    # Connect to the database (if possible); the analysis only reads, so the database is opened in read-only mode and it does not interfere
+    #   with the monitor
+    storage = newStorage(args.database, readonly = True)
     storage.connect()
+    if not storage.isConnected():
+        sys.exit(1)
+
+    if args.snapshot:
+        storage = snapshotStorage(storage)
 
     # Get the begin and end time of the data
     p_debugv("getting information from the database")
@@ -220,15 +324,20 @@ def osidle_analysis():
         args.include_stats = True
         
     args = correctArguments(args, beginTime, endTime)
+    # The requested resolution is kept, because it is selected again for the VMs with custom options (see --custom-file)
+    resolution = args.resolution
+    args.resolution = selectResolution(args.resolution, args.fromdate, args.todate)
+    p_debug("using resolution {} for the analysis".format(args.resolution))
 
     # Get information
     if args.info:
         print("Information about the data available:")
         print("  - first entry:", beginTime)
         print("  - last entry:", endTime)
-        print("  - available vms:", len(storage.getvms()))
+        vms = storage.getvms()
+        print("  - available vms:", len(vms))
         if args.vmlist:
-            print("  - available vm ids:", "\n      ".join(["", *storage.getvms()]))
+            print("  - available vm ids:", "\n      ".join(["", *vms]))
         sys.exit(0)
 
     # Prepare the output file
@@ -259,6 +368,7 @@ def osidle_analysis():
 
     # Now the default options for each of the specific VM is the options passed in the commandline
     parser.set_defaults(**args.__dict__)
+    parser.set_defaults(resolution = resolution)
 
     # Store the default args
     defaultargs = args
@@ -268,69 +378,72 @@ def osidle_analysis():
 
     if args.customoptions is not None:
         with open(args.customoptions, "r") as f:
-            optionsvms = [ l.split("#")[0].strip().split(":") for l in f.readlines() ]
+            # The options are separated from the uuid by the first colon, because the dates also include colons
+            optionsvms = [ l.split("#")[0].strip().split(":", 1) for l in f.readlines() ]
             for options in optionsvms:
+                if options == [ "" ]:
+                    continue
                 if len(options) == 1 or len(options) == 2:
                     uuid = options[0]
                     try:
                         UUID(uuid)
                         validuuid = True
                     except ValueError:
+                        validuuid = False
                         p_warning("invalid uuid {}".format(uuid))
 
                     if validuuid:
-                        p_debugv("custom options for {}: {}".format(uuid, options[1]))
                         if len(options) == 1:
                             # This may be a special case to deactivate the analysis
+                            p_debugv("the analysis of {} is deactivated".format(uuid))
                             customoptions[uuid] = {}
                         else:
+                            p_debugv("custom options for {}: {}".format(uuid, options[1]))
                             customargs, errorargs = parser.parse_known_args(options[1].split())
                             customargs = correctArguments(customargs, beginTime, endTime)
+                            customargs.resolution = selectResolution(customargs.resolution, customargs.fromdate, customargs.todate)
 
                             if len(errorargs) > 0:
                                 p_warning("invalid custom options for {}".format(uuid))
 
                             customoptions[uuid] = customargs
 
-    # Now get the VM ids to deal with
-    if args.vmids is not None:
-        vms = args.vmids
-    else:
-        vms = storage.getvms()
-
-    # Obtain the stats for the different VMs
-    rawdata = {}
+    # The options of the analysis of each VM are its custom options (if any), or the default ones
+    customargs = [ x for x in customoptions.values() if x != {} ]
 
-    if not args.quiet:
-        pbar = tqdm(total=len(vms), desc="Processing VMs", unit="VMs")
+    # Now get the VM ids to deal with; the catalog of VMs is used to skip the VMs that have no samples in the range of dates, before
+    #   reading the samples
+    available = storage.getvms(min([ x.fromdate for x in [ args, *customargs ] ]), max([ x.todate for x in [ args, *customargs ] ]))
+    if args.vmids is None:
+        vms = available
+    else:
+        available = set(available)
+        vms = [ vm for vm in dict.fromkeys(args.vmids) if vm in available ]
+        if len(vms) < len(args.vmids):
+            p_debug("{} of the requested VMs have no samples in the range of dates".format(len(args.vmids) - len(vms)))
+    vms = [ vm for vm in vms if customoptions.get(vm, None) != {} ]
+    vmargs = { vm: customoptions.get(vm, args) for vm in vms }
+
+    # The VMs are processed as they are read (see iterRawData), and the data of each VM is released as soon as it has been dumped or
+    #   evaluated, so that the memory needed is bounded by the largest VM instead of the whole set of VMs; the output keeps the order in
+    #   which the VMs were requested (see inOrder)
+    groups = {}
     for vm in vms:
-        if not args.quiet and getVerbose() == 0:
-            pbar.update(1)
-        p_debug("reading entries for vm {}".format(vm))
-        vmdata = storage.getvmdata(vm, args.fromdate, args.todate)
-        p_debugv("{} entries found".format(len(vmdata)))
+        groups.setdefault((vmargs[vm].fromdate, vmargs[vm].todate, vmargs[vm].resolution), []).append(vm)
 
-        if len(vmdata) == 0:
-            continue
-
-        rawdata[vm] = RawData(vmdata, args)
-
-    # Close the progress bar to avoid weird output
     if not args.quiet:
-        pbar.close()
+        pbar = tqdm(total=len(vms), desc="Processing VMs", unit="VMs")
+    rawdata = iterRawData(storage, groups, vmargs, (lambda: pbar.update(1)) if not args.quiet and getVerbose() == 0 else None)
 
     # If only wanted to get the data, dump it an finalize
     if args.dumpdata:
-        for vm, data in rawdata.items():
-            output_file.println(data.dumpdata(args.format, args.pretty, transform_fnc=lambda x: (vm, *x)))
+        dumps = ((vm, data.dumpdata(args.format, args.pretty, transform_fnc=lambda x, vm=vm: (vm, *x)) if data is not None else None) for (vm, data) in rawdata)
+        for vm, dump in inOrder(dumps, vms):
+            output_file.println(dump)
+        if not args.quiet:
+            pbar.close()
         sys.exit(0)
 
-    # Now prepare the results for the analysis
-    if args.format == 'json' or args.format == 'shell':
-        result = {}
-    else:
-        result = []
-
     f_stats = []
     f_evaluation = []
     f_data = []
@@ -395,16 +508,14 @@ def osidle_analysis():
             h_data = [ *h_data, "nic graph" ]
             fmt_data = [ *fmt_data, None ]
 
-    # Now get the analysis
-    if not args.quiet:
-        pbar = tqdm(total=len(rawdata), desc="Analyzing the data", unit="VMs")
-
-    for vm, data in rawdata.items():
-        if not args.quiet and (getVerbose() == 0):
-            pbar.update(1)
+    # Now get the analysis of each VM as it is read: a tuple (overall, evaluation), where the evaluation depends on the format (or None, if
+    #   the VM is removed)
+    def evaluate(vm, data):
+        if data is None:
+            return None
 
         p_debug("evaluating data for vm {}".format(vm))
-        _stats = DataSeries(data, args)
+        _stats = newDataSeries(data, vmargs[vm])
 
         stats = _stats.stats
         evaluation = _stats.evaluation
@@ -426,7 +537,7 @@ def osidle_analysis():
         # If wanted to remove the unknown values, we do it here
         if (len(scores) == 0) and args.removeunknown:
             p_debugv("removing vm {} because it has no valid data".format(vm))
-            continue
+            return None
 
         # In the "softer" mode, we overweight the maxium score, so that the VM profile is taken into account
         if args.overall == "mean":
@@ -459,40 +570,34 @@ def osidle_analysis():
                 del evaluation["disk"]["data2"]
                 del evaluation["nic"]["data2"]
 
-            result[vm] = evaluation
+            return (overall, evaluation)
         else:
             evaluation["cpu"]["data"] = [ "" if x == 0 else x for x in evaluation["cpu"]["data"] ] if evaluation["cpu"]["data"] is not None else [ ]
             evaluation["disk"]["data"] = [ "" if x == 0 else x for x in evaluation["disk"]["data"] ] if evaluation["disk"]["data"] is not None else [ ]
             evaluation["nic"]["data"] = [ "" if x == 0 else x for x in evaluation["nic"]["data"] ] if evaluation["nic"]["data"] is not None else [ ]
 
-            result.append(
-                (vm, overall, *get_fields(evaluation, f_evaluation), *get_fields(evaluation, f_data), *get_fields(evaluation, f_stats))
-            )
+            return (overall, (vm, overall, *get_fields(evaluation, f_evaluation), *get_fields(evaluation, f_data), *get_fields(evaluation, f_stats)))
 
-    # Close the progress bar to avoid weird output
-    if not args.quiet:
-        pbar.close()
+    # The evaluations are obtained lazily and in the order of the VMs, and only the evaluation of each VM is kept (not its data)
+    result = ( (vm, overall, _r) for vm, (overall, _r) in inOrder(((vm, evaluate(vm, data)) for (vm, data) in rawdata), vms)
+                if not args.summarize or overall < args.threshold_summarize )
 
-    # Finally, dump the data, depending on the format (moreover we'll sort it and summarize the data, depending on the options)
-    if args.format == "json" or args.format == "shell":
-        if args.summarize:
-            result = { k:v for k,v in result.items() if v["overall"] < args.threshold_summarize }
+    # Sorting needs the whole set of evaluations (the sort is stable, so the VMs with the same score keep their order)
+    if args.sort:
+        result = sorted(result, key=lambda x: x[1], reverse=True)
 
-        if args.sort:
-            result = dict(sorted(result.items(), key=lambda x: x[1]["overall"], reverse=True))
-
-    else:
-        if args.summarize:
-            result = [ x for x in result if x[1] < args.threshold_summarize ]
+    # Finally, dump the data, depending on the format
+    if args.format == "json":
+        result = { vm: _r for vm, _, _r in result }
 
-        if args.sort:
-            result = sorted(result, key=lambda x: x[1], reverse=True)
+        # Close the progress bar to avoid weird output
+        if not args.quiet:
+            pbar.close()
 
-    if args.format == "json":
         if args.pretty:
-            output_file.println(json.dumps(result, indent=4))
+            output_file.println(json_dumps(result, indent=4))
         else:
-            output_file.println(json.dumps(result))
+            output_file.println(json_dumps(result))
     elif args.format == "shell":
         fields = [ "disk.score", "cpu.score", "nic.score", "overall" ]
         if args.include_eval_data_graph:
@@ -505,9 +610,8 @@ def osidle_analysis():
                 "stats.cpu.min", "stats.cpu.max", "stats.cpu.mean", "stats.cpu.median", 
                 "stats.nic.min", "stats.nic.max", "stats.nic.mean", "stats.nic.median" 
             ]
-        c = 0
 
-        for vm, _r in result.items():
+        for c, (vm, _, _r) in enumerate(result):
             output = [
                 "ID_{}={}".format(c, vm)
             ]
@@ -515,7 +619,6 @@ def osidle_analysis():
             for i in range(len(fields)):
                 output.append("{}_{}={}".format(fields[i].replace(".", "_"), c, _r[i]))
             output_file.println("\n".join(output))
-            c += 1
     else:
         headers = [ *h_evaluation ]
         format = [ *fmt_evaluation ]
@@ -534,7 +637,7 @@ def osidle_analysis():
             for h in headers:
                 worksheet.write(0, headers.index(h), h)
 
-            for i in range(len(result)):
+            for i, (_, _, row) in enumerate(result):
                 for j in range(len(headers)):
 
                     c_fmt = None
@@ -546,13 +649,22 @@ def osidle_analysis():
                         c_fmt = formats[j]
                         
                     if c_fmt is None:
-                        worksheet.write(i+1, j, result[i][j])
+                        worksheet.write(i+1, j, row[j])
                     else:
-                        worksheet.write(i+1, j, result[i][j], c_fmt)
+                        worksheet.write(i+1, j, row[j], c_fmt)
             workbook.close()
         else:
             output_file.println(",".join(headers))
-            output_file.println("\n".join( [ ",".join([str(x) for x in y]) for y in result ]))        
+            empty = True
+            for _, _, row in result:
+                output_file.println(",".join([str(x) for x in row]))
+                empty = False
+            if empty:
+                output_file.println("")
+
+    # Close the progress bar to avoid weird output
+    if not args.quiet and args.format != "json":
+        pbar.close()
 
 if __name__ == "__main__":
     osidle_analysis()
\ No newline at end of file
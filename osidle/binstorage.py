@@ -0,0 +1,601 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import os
+import mmap
+import fcntl
+import struct
+import bisect
+from datetime import datetime
+from urllib.parse import quote, unquote
+from .common import p_error, p_warning, p_debug, p_debugv, fromepoch
+from .rawdata import incremental
+from .storage import SCHEMA_VERSION, SYNCHRONOUS_LEVELS, DEFAULT_BUSY_TIMEOUT, MIGRATION_BATCH_SIZE, MAINTENANCE_BATCH_SIZE, MAINTENANCE_VACUUM_PAGES, \
+    COUNTER_COLUMNS, ROLLUP_RESOLUTIONS, _tots, _counters, _state, _pack, _unpack, _rowtonumeric, _chunktosample, _countersinfo, \
+    _countersample, _rollupbuckets, _addrollup, _rolluptosample, _deltavalues, _deltatosample
+
+# The first bytes of the file of each VM, that identify the format of its records
+BINARY_MAGIC = b"OSIDLE01"
+
+# The states of the samples, as stored in the records (see storage._state); the counters of the samples that are not "ok" are 0
+RECORD_STATES = [ "ok", "invalid", "conflictingRequest", "itemNotFound" ]
+
+# Each record is a sample of the VM: its epoch (in microseconds), its state and its counters (in the same order than COUNTER_COLUMNS), as
+#   little-endian int64 values
+_RECORD_FIELDS = 2 + len(COUNTER_COLUMNS)
+_RECORD_SIZE = 8 * _RECORD_FIELDS
+_HEADER_SIZE = len(BINARY_MAGIC)
+_TS = struct.Struct("<q")
+
+# The extension of the files of the VMs (the name of the file is the quoted vmid)
+_EXTENSION = ".bin"
+
+# A compacted file (see expire) is only rewritten once the expired records are at least this fraction of the file (or all of them), so that
+#   the files are not copied each time that the maintenance runs
+EXPIRE_MIN_FRACTION = 0.25
+
+# Converts the records of a file (a bytes object with whole records) into tuples (ts, state, *counters)
+def _records(data):
+    values = _unpack(data).tolist()
+    return list(zip(*[ values[i::_RECORD_FIELDS] for i in range(_RECORD_FIELDS) ]))
+
+# Converts a sample into a record
+def _torecord(ts, info):
+    counters = _counters(info)
+    state = RECORD_STATES.index(_state(info, counters[0] if counters is not None else None))
+    return (ts, state, *([ int(x) for x in counters ] if counters is not None else [ 0 ] * len(COUNTER_COLUMNS)))
+
+# Builds a minimal payload of a record: the one whose counters are the ones of the record (see storage._countersinfo) or the one that has
+#   the same state (e.g. to store the sample in other storage)
+def _recordinfo(ts, state, *counters):
+    if state == 0:
+        return _countersinfo(ts, None, *counters)
+    state = RECORD_STATES[state]
+    return { state: {} } if state != "invalid" else {}
+
+# Converts a record into a sample, in the same format than the samples obtained from Storage.getvmdata; the records have no data, so the
+#   samples are the "numeric" ones (or the minimal payloads of the records, if not numeric)
+def _recordtosample(row, numeric):
+    (ts, state, *counters) = row
+    if state == 0:
+        return _chunktosample((ts, None, *counters), numeric)
+    sample = _rowtonumeric(ts, None, *[ None ] * len(COUNTER_COLUMNS)) if numeric else _recordinfo(*row)
+    if not numeric:
+        sample["s"] = ts / 1e6
+    return sample
+
+# Calculates the incremental samples of a series of records, in the same way than Storage._buildderived (the records without valid counters
+#   are skipped)
+# @param prev the counters of the sample previous to the records (see storage._countersample), or None if they are the first ones of the VM
+# @return a generator of tuples (prev, cur, delta); the consumption since the VM was started (see basesample) is not included, as in
+#   Storage._buildderived
+def _iterincremental(vmid, rows, prev):
+    for (ts, state, *counters) in rows:
+        if state != 0:
+            continue
+        cur = _countersample(ts, *counters)
+        if prev is not None:
+            delta = incremental(prev, cur)
+            if delta is None:
+                p_debug("the counters of vm {} have been reset".format(vmid))
+            else:
+                yield (prev, cur, delta)
+        prev = cur
+
+# The records of a VM, mapped in memory; it is a sequence of the epochs of the records, so that bisect finds the records of a range of dates
+#   (the records are always sorted by epoch)
+#   * the records appended after opening the file are not seen, and a partial record at the end of the file (i.e. a record that is being
+#     appended, or that was being appended when the monitor stopped) is ignored
+class _Series:
+    def __init__(self, filename):
+        self._map = None
+        with open(filename, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > 0:
+                self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        if (self._map is not None) and (self._map[:_HEADER_SIZE] != BINARY_MAGIC):
+            self.close()
+            raise Exception("{} is not a file of samples".format(filename))
+        self._count = max(0, (size - _HEADER_SIZE) // _RECORD_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        return _TS.unpack_from(self._map, _HEADER_SIZE + i * _RECORD_SIZE)[0]
+
+    # The index of the first record whose epoch is at least ts (or after ts, if after is True)
+    def find(self, ts, after = False):
+        if ts is None:
+            return len(self) if after else 0
+        return (bisect.bisect_right if after else bisect.bisect_left)(self, ts)
+
+    def rows(self, i = 0, j = None):
+        j = len(self) if j is None else j
+        if j <= i:
+            return []
+        return _records(self._map[_HEADER_SIZE + i * _RECORD_SIZE:_HEADER_SIZE + j * _RECORD_SIZE])
+
+    # The last record with valid counters before the record i (None if there is no such record)
+    def previous(self, i):
+        for k in range(i - 1, -1, -1):
+            row = self.rows(k, k + 1)[0]
+            if row[1] == 0:
+                return row
+        return None
+
+    # The first record with valid counters from the record j (None if there is no such record)
+    def following(self, j):
+        for k in range(j, len(self)):
+            row = self.rows(k, k + 1)[0]
+            if row[1] == 0:
+                return row
+        return None
+
+# A storage that keeps the samples of each VM in its own file, in a folder (i.e. the database is a folder): each sample is an append-only,
+#   fixed-width record with the epoch, the state and the counters of the sample (see _RECORD_FIELDS), so storing a sample needs no
+#   transaction and reading a range of dates needs neither queries nor parsing (the file is mapped in memory and the records are found
+#   using bisect). The data of the samples is not stored, and the incremental samples and the rollups are calculated when they are read.
+#   * the appends and the rewrites of a file (e.g. expire) are serialized using flock, so osidle-dbpack can modify the files while the
+#     monitor is running; the readers do not lock, because the files are replaced atomically
+#   * the synchronous level is honored in the same way than sqlite3: FULL and EXTRA sync the files after each batch of samples
+class BinaryStorage:
+    # The parameters are the same than the ones of Storage (codec, dedup, chunks and busy_timeout have no effect in this engine)
+    def __init__(self, filename = None, synchronous = "NORMAL", busy_timeout = DEFAULT_BUSY_TIMEOUT, codec = "none", readonly = False, dedup = False,
+                    chunks = False):
+        if filename is None:
+            raise Exception("the binary storage needs the name of a folder")
+        self._filename = filename
+        self._readonly = readonly
+        self._connected = False
+        if synchronous.upper() not in SYNCHRONOUS_LEVELS:
+            p_warning("invalid synchronous level {}; using NORMAL".format(synchronous))
+            synchronous = "NORMAL"
+        self._sync = synchronous.upper() in [ "FULL", "EXTRA" ]
+        # The records have no payload to compress and they are already fixed-width, so these options are only for the sqlite engine
+        for (name, value) in [ ("codec", codec not in [ None, "none" ]), ("dedup", dedup), ("chunks", chunks) ]:
+            if value:
+                p_warning("the binary engine does not support the {} option; ignoring it".format(name))
+
+    def connect(self, upgrade = False):
+        if os.path.exists(self._filename) and not os.path.isdir(self._filename):
+            p_error("Could not connect to database: {} is not a folder".format(self._filename))
+            return
+        if not os.path.isdir(self._filename):
+            if self._readonly:
+                p_error("Could not connect to database: {} does not exist".format(self._filename))
+                return
+            os.makedirs(self._filename)
+        self._connected = True
+
+    def isConnected(self):
+        return self._connected
+
+    def close(self):
+        self._connected = False
+
+    def getfilenames(self):
+        return [ self._filename ]
+
+    def _path(self, vmid):
+        return os.path.join(self._filename, quote(vmid, safe = "") + _EXTENSION)
+
+    # The VMs that have a file in the folder, sorted by vmid (the same order than the queries of Storage)
+    # @param vmids if not None, only these VMs are considered
+    def _vmids(self, vmids = None):
+        available = [ unquote(f[:-len(_EXTENSION)]) for f in os.listdir(self._filename) if f.endswith(_EXTENSION) ]
+        if vmids is not None:
+            available = set(available).intersection(vmids)
+        return sorted(available)
+
+    # Opens the records of a VM (see _Series); returns None if the VM has no file
+    def _series(self, vmid):
+        try:
+            return _Series(self._path(vmid))
+        except FileNotFoundError:
+            return None
+
+    # Opens the file of a VM for writing and locks it; if the file was replaced (or removed) while waiting for the lock, the new one is opened
+    # @return the file descriptor, or None if the file does not exist and create is False
+    def _lock(self, vmid, create = True):
+        filename = self._path(vmid)
+        while True:
+            try:
+                fd = os.open(filename, os.O_RDWR | (os.O_CREAT if create else 0), 0o644)
+            except FileNotFoundError:
+                return None
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.stat(filename).st_ino == os.fstat(fd).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+        # A record that was partially written (e.g. the monitor was killed while appending it) is discarded
+        size = os.fstat(fd).st_size
+        if size == 0:
+            os.write(fd, BINARY_MAGIC)
+        elif (size - _HEADER_SIZE) % _RECORD_SIZE != 0:
+            p_warning("discarding a partial record at the end of {}".format(filename))
+            os.ftruncate(fd, size - (size - _HEADER_SIZE) % _RECORD_SIZE)
+        return fd
+
+    # Replaces the records of a locked file (the new file is written aside and renamed, so that the readers see either file); if there are no
+    #   records, the file is removed
+    def _rewrite(self, vmid, fd, rows):
+        filename = self._path(vmid)
+        if len(rows) == 0:
+            os.remove(filename)
+            return
+        tmpfilename = "{}.tmp".format(filename)
+        with open(tmpfilename, "wb") as f:
+            f.write(BINARY_MAGIC)
+            f.write(_pack(value for row in rows for value in row))
+            if self._sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmpfilename, filename)
+
+    def _readlocked(self, fd):
+        size = os.fstat(fd).st_size
+        return _records(os.pread(fd, size - _HEADER_SIZE, _HEADER_SIZE))
+
+    # Modifies the records of each VM with a function that is called as fnc(rows) and returns the new rows (or None to keep the file as is)
+    # @return the amount of records removed
+    def _modify(self, fnc, vmids = None):
+        removed = 0
+        for vmid in self._vmids(vmids):
+            fd = self._lock(vmid, False)
+            if fd is None:
+                continue
+            try:
+                rows = self._readlocked(fd)
+                newrows = fnc(vmid, rows)
+                if newrows is not None:
+                    self._rewrite(vmid, fd, newrows)
+                    removed += len(rows) - len(newrows)
+            finally:
+                os.close(fd)
+        return removed
+
+    def getschemaversion(self):
+        return SCHEMA_VERSION
+
+    # The files have no schema, so there is nothing to migrate
+    def migrate(self, batchsize = MIGRATION_BATCH_SIZE, progress_fnc = None):
+        return SCHEMA_VERSION
+
+    # The records of each VM are stored in its own file, sorted, so they are always clustered
+    def cluster(self, batchsize = MIGRATION_BATCH_SIZE, progress_fnc = None):
+        return 0
+
+    # Copies the files of the VMs to a folder with the same name than the storage, in that folder (only the whole records are copied)
+    # @return the filename of the copy
+    def snapshot(self, folder):
+        if not self.isConnected():
+            return None
+
+        filename = os.path.join(folder, os.path.basename(os.path.normpath(self._filename)))
+        os.makedirs(filename, exist_ok = True)
+        for vmid in self._vmids():
+            series = self._series(vmid)
+            if series is None:
+                continue
+            with series:
+                with open(os.path.join(filename, os.path.basename(self._path(vmid))), "wb") as f:
+                    f.write(BINARY_MAGIC)
+                    f.write(series._map[_HEADER_SIZE:_HEADER_SIZE + len(series) * _RECORD_SIZE])
+        return filename
+
+    # Obtains the first and the last epochs, the amount of records, the state of the last record and the last record with valid counters
+    #   of each VM
+    def _summaries(self, vmids = None):
+        result = {}
+        for vmid in self._vmids(vmids):
+            series = self._series(vmid)
+            if series is None:
+                continue
+            with series:
+                if len(series) == 0:
+                    continue
+                last = series.rows(len(series) - 1)[0]
+                result[vmid] = (series[0], last[0], len(series), RECORD_STATES[last[1]], last if last[1] == 0 else series.previous(len(series) - 1))
+        return result
+
+    def getcount(self):
+        if not self.isConnected():
+            return 0
+        return sum(count for (_, _, count, _, _) in self._summaries().values())
+
+    def getmint(self):
+        if not self.isConnected():
+            return None
+        values = [ first for (first, _, _, _, _) in self._summaries().values() ]
+        return fromepoch(min(values) / 1e6) if len(values) > 0 else None
+
+    def getmaxt(self):
+        if not self.isConnected():
+            return None
+        values = [ last for (_, last, _, _, _) in self._summaries().values() ]
+        return fromepoch(max(values) / 1e6) if len(values) > 0 else None
+
+    def savevm(self, vmid, info, t = None):
+        return self.savevms([ (vmid, info, t) ])
+
+    # Appends the samples to the files of their VMs; a sample older than the last record of its VM (e.g. the samples imported from other
+    #   database) makes the file to be rewritten, so that the records are kept sorted
+    def savevms(self, batch):
+        if (not self.isConnected()) or self._readonly:
+            return False
+
+        valid = True
+        vms = {}
+        for (vmid, info, t) in batch:
+            if t is None:
+                t = datetime.utcnow()
+            ts = _tots(t)
+            if ts is None:
+                p_error("t should be a datetime object, a timestamp or a string in the format %Y-%m-%dT%H:%M:%S.%fZ")
+                valid = False
+                continue
+            vms.setdefault(vmid, []).append(_torecord(ts, info))
+
+        for (vmid, rows) in vms.items():
+            rows.sort(key = lambda x: x[0])
+            try:
+                fd = self._lock(vmid)
+                try:
+                    size = os.fstat(fd).st_size
+                    if (size > _HEADER_SIZE) and (_TS.unpack(os.pread(fd, 8, size - _RECORD_SIZE))[0] > rows[0][0]):
+                        self._rewrite(vmid, fd, sorted(self._readlocked(fd) + rows, key = lambda x: x[0]))
+                    else:
+                        os.lseek(fd, 0, os.SEEK_END)
+                        os.write(fd, _pack(value for row in rows for value in row))
+                        if self._sync:
+                            os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                p_error("could not store {} samples of vm {}: {}".format(len(rows), vmid, e))
+                valid = False
+        return valid
+
+    def getvmdata(self, vmid, fromDate = None, toDate = None, numeric = False):
+        if not self.isConnected():
+            return []
+
+        for (_, samples) in self.iter_window(fromDate, toDate, [ vmid ], numeric):
+            return samples
+        return []
+
+    # Yields the VMs (sorted by vmid) and their records, mapped in memory
+    def _iterseries(self, vmids):
+        for vmid in self._vmids(vmids):
+            series = self._series(vmid)
+            if series is None:
+                continue
+            with series:
+                yield (vmid, series)
+
+    def iter_window(self, fromDate = None, toDate = None, vmids = None, numeric = False):
+        if not self.isConnected():
+            return
+
+        fromts = _tots(fromDate) if fromDate is not None else None
+        tots = _tots(toDate) if toDate is not None else None
+        for (vmid, series) in self._iterseries(vmids):
+            rows = series.rows(series.find(fromts), series.find(tots, True))
+            if len(rows) > 0:
+                yield (vmid, [ _recordtosample(row, numeric) for row in rows ])
+
+    # The incremental samples are calculated from the records in the range (and the previous record with valid counters), and filtered in the
+    #   same way than Storage.iter_deltas
+    def iter_deltas(self, fromDate = None, toDate = None, vmids = None):
+        if not self.isConnected():
+            return
+
+        fromts = _tots(fromDate) if fromDate is not None else None
+        tots = _tots(toDate) if toDate is not None else None
+        for (vmid, series) in self._iterseries(vmids):
+            i = series.find(fromts)
+            previous = series.previous(i)
+            samples = []
+            for (_, cur, delta) in _iterincremental(vmid, series.rows(i, series.find(tots, True)), _countersample(previous[0], *previous[2:]) if previous is not None else None):
+                (_, ts, tsbegin, *values) = _deltavalues(vmid, cur["ts"], delta)
+                if ((fromts is None) or (tsbegin >= fromts)) and ((tots is None) or (ts <= tots)):
+                    samples.append(_deltatosample(ts, tsbegin, *values))
+            if len(samples) > 0:
+                yield (vmid, samples)
+
+    # The buckets of the rollups are calculated from the records whose intervals overlap the buckets in the range, in the same way than
+    #   Storage._buildderived (the buckets that are partially in the range are also included, as in Storage.iter_rollups)
+    def iter_rollups(self, fromDate = None, toDate = None, vmids = None, resolution = "hour"):
+        if not self.isConnected():
+            return
+
+        resolution = ROLLUP_RESOLUTIONS[resolution]
+        size = resolution * 1000000
+        frombucket = _tots(fromDate) - size if fromDate is not None else None
+        tobucket = _tots(toDate) if toDate is not None else None
+        for (vmid, series) in self._iterseries(vmids):
+            i = series.find(frombucket)
+            j = series.find(tobucket + size if tobucket is not None else None, True)
+            previous = series.previous(i)
+            rows = series.rows(i, j)
+            following = series.following(j)
+            if following is not None:
+                rows.append(following)
+
+            buckets = {}
+            for (prev, cur, delta) in _iterincremental(vmid, rows, _countersample(previous[0], *previous[2:]) if previous is not None else None):
+                for (_resolution, bucket, *values) in _rollupbuckets(prev["ts"], cur["ts"], delta):
+                    if (_resolution != resolution) or ((frombucket is not None) and (bucket <= frombucket)) or ((tobucket is not None) and (bucket > tobucket)):
+                        continue
+                    buckets[bucket] = _addrollup(buckets[bucket], values) if bucket in buckets else values
+
+            samples = [ _rolluptosample(tsbegin, e, tcpu_ns, tdisk, tnic, ncpu, ndisk, nnic)
+                for (e, tcpu_ns, tdisk, tnic, _, ncpu, ndisk, nnic, tsbegin) in [ buckets[bucket] for bucket in sorted(buckets.keys()) ] if e > 0 ]
+            if len(samples) > 0:
+                yield (vmid, samples)
+
+    # Nothing is derived from the records, so there is nothing to rebuild
+    def rebuildderived(self, progress_fnc = None):
+        return self.isConnected()
+
+    def getvms(self, fromDate = None, toDate = None):
+        if not self.isConnected():
+            return []
+
+        return [ entry["vmid"] for entry in self.getcatalog(fromDate, toDate) ]
+
+    # Obtains the same entries than Storage.getcatalog, from the first and the last records of the files
+    def getcatalog(self, fromDate = None, toDate = None):
+        if not self.isConnected():
+            return []
+
+        fromts = _tots(fromDate) if fromDate is not None else None
+        tots = _tots(toDate) if toDate is not None else None
+        catalog = []
+        for (vmid, (first_ts, last_ts, samples, state, counters)) in sorted(self._summaries().items()):
+            if ((fromts is not None) and (last_ts < fromts)) or ((tots is not None) and (first_ts > tots)):
+                continue
+            catalog.append({
+                "vmid": vmid,
+                "first": fromepoch(first_ts / 1e6),
+                "last": fromepoch(last_ts / 1e6),
+                "samples": samples,
+                "bytes": samples * _RECORD_SIZE,
+                "state": state,
+                "counters": _countersample(counters[0], *counters[2:]) if counters is not None else None,
+            })
+        return catalog
+
+    def delete(self, keepFromDate, keepToDate):
+        if not self.isConnected():
+            return False
+
+        if (keepFromDate is None) and (keepToDate is None):
+            raise Exception("refusing to wipe the whole database")
+
+        fromts = _tots(keepFromDate) if keepFromDate is not None else None
+        tots = _tots(keepToDate) if keepToDate is not None else None
+        return self._modify(lambda vmid, rows: [ row for row in rows if ((fromts is None) or (row[0] >= fromts)) and ((tots is None) or (row[0] <= tots)) ])
+
+    # The files are rewritten when they are modified, so there is no free space to reclaim
+    def vaccuum(self):
+        return self.isConnected()
+
+    # Deletes the records older than a date from the files of the VMs, until at least batchsize records are deleted; a file is only rewritten
+    #   if the expired records are enough (see EXPIRE_MIN_FRACTION), so the older records may remain for a while
+    # @return the amount of records deleted (0 means that there are no more files to compact)
+    def expire(self, keepFromDate, batchsize = MAINTENANCE_BATCH_SIZE):
+        if not self.isConnected():
+            return 0
+
+        keepts = _tots(keepFromDate)
+        removed = 0
+        for vmid in self._vmids():
+            series = self._series(vmid)
+            if series is None:
+                continue
+            with series:
+                expired = series.find(keepts)
+                if (expired == 0) or ((expired < len(series)) and (expired < len(series) * EXPIRE_MIN_FRACTION)):
+                    continue
+            p_debugv("deleting {} expired samples of vm {}".format(expired, vmid))
+            removed += self._modify(lambda vmid, rows: [ row for row in rows if row[0] >= keepts ], [ vmid ])
+            if removed >= batchsize:
+                break
+        return removed
+
+    def incrementalvacuum(self, pages = MAINTENANCE_VACUUM_PAGES):
+        return 0
+
+    def checkpoint(self):
+        return self.isConnected()
+
+    def analyze(self):
+        return self.isConnected()
+
+    # The records have no data, so filter_fnc only decides which samples are kept: it receives the minimal payload of each record (see
+    #   _recordinfo), not the payload that was stored, and the record is removed if it returns None; the result is not stored, so a filter
+    #   that inspects or modifies the payloads (other than remove_unneeded_data, that keeps the samples with counters in both cases) does
+    #   not work in the same way than in Storage.filterdata
+    def filterdata(self, filter_fnc, pre_fnc = None, post_fnc = None):
+        if not self.isConnected():
+            return False
+
+        if (callable(pre_fnc)):
+            pre_fnc(self.getcount())
+
+        def filterrows(vmid, rows):
+            result = [ row for row in rows if filter_fnc(vmid, row[0] / 1e6, _recordinfo(*row)) is not None ]
+            return result if len(result) < len(rows) else None
+        self._modify(filterrows)
+
+        if (callable(post_fnc)):
+            post_fnc()
+
+        return True
+
+    # Stores the samples in other storage (e.g. to convert the database to the sqlite3 engine), as the minimal payloads of the records; as
+    #   in filterdata, filter_fnc only decides which records are stored
+    def filterdata_to(self, filter_fnc, pre_fnc = None, post_fnc = None, other_storage = None):
+        if (other_storage is None) or (not other_storage.isConnected()):
+            return False
+
+        if not self.isConnected():
+            return False
+
+        if (callable(pre_fnc)):
+            pre_fnc(self.getcount())
+
+        batch = []
+        for (vmid, series) in self._iterseries(None):
+            for row in series.rows():
+                info = _recordinfo(*row)
+                if filter_fnc(vmid, row[0] / 1e6, info) is not None:
+                    batch.append((vmid, info, row[0] / 1e6))
+                if len(batch) >= MIGRATION_BATCH_SIZE:
+                    other_storage.savevms(batch)
+                    batch = []
+
+        if len(batch) > 0:
+            other_storage.savevms(batch)
+
+        if (callable(post_fnc)):
+            post_fnc()
+
+        return True
+
+    def traindictionary(self, *args, **kwargs):
+        p_warning("the binary storage does not keep the data of the samples, so there is nothing to compress")
+        return None
+
+    def recompress(self, codec, batchsize = MIGRATION_BATCH_SIZE, progress_fnc = None):
+        p_warning("the binary storage does not keep the data of the samples, so there is nothing to compress")
+        return False
@@ -13,7 +13,7 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 #
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import re
 import sys
 
@@ -29,13 +29,22 @@ def getVerbose():
 __now = None
 
 # A function to make that "now" is always the same in an execution. The "now" time will be generated by the first call to this function
-# @return datetime the current time (now)
+# @return datetime the current time (now), in UTC as the timestamps of the samples (see toepoch)
 def NOW():
     global __now
     if __now is None:
-        __now = datetime.now()
+        __now = datetime.utcnow()
     return __now
 
+# The naive datetimes are in UTC (e.g. the timestamps of the samples are obtained using datetime.utcnow), so they are converted into epochs
+#   (in seconds) as UTC, regardless of the timezone of the host (datetime.timestamp would interpret them in local time)
+def toepoch(t):
+    return (t.replace(tzinfo = timezone.utc) if t.tzinfo is None else t).timestamp()
+
+# Converts an epoch (in seconds) into a naive datetime in UTC (i.e. the inverse of toepoch)
+def fromepoch(s):
+    return datetime.fromtimestamp(s, timezone.utc).replace(tzinfo = None)
+
 def p_debug(*args):
     global __verbose
     if __verbose > 0:
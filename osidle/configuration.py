@@ -47,12 +47,14 @@ class Configuration:
         _result = {}
         for section, secconfig in self._defaultvalues.items():
             if section not in self._reader:
-                if forcedefaults:
-                    _result[section] = secconfig
-                continue
+                if not forcedefaults:
+                    continue
+                # The default values are processed in the same way as if the section was empty (i.e. the functions are applied to them)
+                readconfig = {}
+            else:
+                readconfig = self._reader[section]
             if section not in _result:
                 _result[section] = {}
-            readconfig = self._reader[section]
             for key in secconfig:
 
                 # If it is not a tuple, convert it to a tuple
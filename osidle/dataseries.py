@@ -15,6 +15,12 @@
 #
 from .common import *
 import math
+from itertools import repeat
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 def _reduce(d, func, init = 0):
     try:
@@ -170,6 +176,104 @@ def _filter_saturation(serie, t, c, threshold, eps = 0.5):
                 serie[c_s + 1][c] = n_val
             serie[c_s][c] = threshold
 
+# The vectorized version of basicstats, for a 2d array of rows; the sums are made by python (on the lists of values) and the accumulated
+#   samples are summed in order (cumsum), so that the results are the same than the ones of basicstats
+def arraybasicstats(_data, tpos = 0, vpos = 1):
+    if len(_data) == 0:
+        return None
+
+    # The order in which python sorts the NaN values depends on their positions, so the series with NaN values are analyzed by basicstats
+    if np.isnan(_data[:, [ tpos, vpos ]]).any():
+        return basicstats(_data.tolist(), tpos, vpos)
+
+    order = np.argsort(_data[:, vpos], kind = "stable")
+    times = _data[order, tpos]
+    values = _data[order, vpos]
+
+    count = sum(times.tolist())
+    if count == 0:
+        return None
+
+    meanval = sum((times * values).tolist()) / count
+
+    # The median is the value of the first sample whose accumulated amount of samples is over the middle point
+    accumulated = np.cumsum(times)
+    median = min(int(np.searchsorted(accumulated, count // 2, side = "right")), len(values) - 1)
+
+    # The squares are made by python, because the ones of numpy (x*x) may differ in the last digit from the ones of basicstats (pow)
+    deviation = math.sqrt(sum(map(pow, (values - meanval).tolist(), repeat(2))) / (count - 1))
+
+    minval = values[0].item()
+    maxval = values[-1].item()
+    if maxval == minval:
+        pct_deviation = 0
+    else:
+        pct_deviation = deviation / (maxval - minval)
+
+    return {
+        "min": minval,
+        "max": maxval,
+        "mean": meanval,
+        "deviation": deviation,
+        "pct_deviation": pct_deviation,
+        "median": values[median].item(),
+    }
+
+# The vectorized version of _fragments, for a 2d array of rows (the amounts are added to the fragments in order, using bincount)
+def _arrayfragments(_data, tpos = None, vpos = 0, low = None, up = None, nfragments = 4):
+    if len(_data) == 0:
+        return None
+
+    values = _data[:, vpos]
+    times = _data[:, tpos] if tpos is not None else None
+
+    # If the values are not finite or the width of the fragments is 0, the scalar version obtains the limits and raises the errors
+    if not np.isfinite(values).all():
+        return _fragments(_data.tolist(), tpos, vpos, low, up, nfragments)
+
+    if up is None:
+        up = values.max().item()
+    if low is None:
+        low = values.min().item()
+
+    w = (up - low) / nfragments
+    if w == 0:
+        return _fragments(_data.tolist(), tpos, vpos, low, up, nfragments)
+
+    # Make the borders to absorve the values
+    positions = np.clip(np.floor_divide(values - low, w), 0, nfragments - 1).astype(np.intp)
+    fragments = np.bincount(positions, weights = times, minlength = nfragments)
+    total = np.cumsum(times)[-1] if times is not None else len(values)
+
+    return (fragments / total).tolist()
+
+# The version of _filter_saturation for a 2d array of rows: the amount over the threshold is carried to the next sample, so only the samples
+#   over the threshold and the chains of samples that get over the threshold because of the carried amount are visited
+def _arrayfilter_saturation(serie, t, c, threshold, eps = 0.5):
+    n = len(serie)
+    times = serie[:, t]
+    values = serie[:, c]
+
+    c_s = -1
+    for s in np.flatnonzero(values > threshold).tolist():
+        # The sample has already been visited in a chain
+        if s <= c_s:
+            continue
+
+        c_s = s
+        while c_s < n:
+            disk = values[c_s].item()
+            if not disk > threshold:
+                break
+
+            diff_disk = disk - threshold
+            if (c_s < (n - 1)):
+                e = times[c_s].item()
+                e_next = times[c_s + 1].item()
+                values[c_s + 1] = ((values[c_s + 1].item() * e_next) + (diff_disk * e * eps)) / e_next
+            values[c_s] = threshold
+            c_s += 1
+
 def _evaluate_fragment(fragment, minval = 0, maxval = 10):
     # Calculate the points according to the position in the deciles os quartiles
     #   > in quartiles will have 4 pct of usage in 0-25%, 25-50%, 50-75% and 75-100%; 
@@ -184,6 +288,11 @@ def _evaluate_fragment(fragment, minval = 0, maxval = 10):
     return result
 
 class DataSeries:
+    # The functions that analyze the series (ArrayDataSeries uses the vectorized versions)
+    _basicstats = staticmethod(basicstats)
+    _fragments = staticmethod(_fragments)
+    _filter_saturation = staticmethod(_filter_saturation)
+
     def __init__(self, rawdata, args):
         self._params = {
             "threshold_disk": args.threshold_disk,
@@ -198,8 +307,7 @@ class DataSeries:
         # Now convert the data into a format ready to be analyzed (frequency, cpu (seconds/second), disk (bytes/second), nic(bytes/second))
         #   TODO(N): consider dividing the x["tcpu"] per ncpus to get the "for analysis" cpu time
         #       ANSWER: NO, because we want to be able to show the data; the "for analysis" cpu time is an internal value
-        _data = rawdata.data
-        self._data_series = [ [x["e"], x["tcpu"]/x["e"], x["tdisk"]/x["e"], x["tnic"]/x["e"]] for x in _data ]
+        self._data_series = rawdata.rates()
         # n_data_series = _cluster(self._data_series, 0, 2, 60)
         self._vminfo = {
             "ncpu": rawdata.ncpu,
@@ -251,14 +359,14 @@ class DataSeries:
             cpudata = stats["cpu"]["mean"] if stats["cpu"] is not None else None
 
         # Now we'll filter the disk information and the network to mitigate the impact of saturation
-        _filter_saturation(self._data_series, 0, 2, self._params["threshold_disk"], eps)
-        _filter_saturation(self._data_series, 0, 3, self._params["threshold_nic"], eps)
+        self._filter_saturation(self._data_series, 0, 2, self._params["threshold_disk"], eps)
+        self._filter_saturation(self._data_series, 0, 3, self._params["threshold_nic"], eps)
 
         # Calculate the decile distribution for each value
         decile = { 
-            "cpu": _fragments(self._data_series, 0, 1, 0, ncpu, 10),
-            "disk": _fragments(self._data_series, 0, 2, 0, self._params["threshold_disk"], 10),
-            "nic": _fragments(self._data_series, 0, 3, 0, self._params["threshold_nic"], 10),
+            "cpu": self._fragments(self._data_series, 0, 1, 0, ncpu, 10),
+            "disk": self._fragments(self._data_series, 0, 2, 0, self._params["threshold_disk"], 10),
+            "nic": self._fragments(self._data_series, 0, 3, 0, self._params["threshold_nic"], 10),
         }
 
         evaluation = {
@@ -287,8 +395,25 @@ class DataSeries:
     def _calculate_stats(self):
         # Get the stats
         result = {
-            "cpu": basicstats(self._data_series, tpos = 0, vpos = 1),
-            "disk": basicstats(self._data_series, tpos = 0, vpos = 2),
-            "nic": basicstats(self._data_series, tpos = 0, vpos = 3),
+            "cpu": self._basicstats(self._data_series, tpos = 0, vpos = 1),
+            "disk": self._basicstats(self._data_series, tpos = 0, vpos = 2),
+            "nic": self._basicstats(self._data_series, tpos = 0, vpos = 3),
         }
         return result
+
+# The version of DataSeries that keeps the series in a 2d array (one row per sample) and analyzes it using numpy; the results are the same
+#   than the ones of DataSeries
+class ArrayDataSeries(DataSeries):
+    _basicstats = staticmethod(arraybasicstats)
+    _fragments = staticmethod(_arrayfragments)
+    _filter_saturation = staticmethod(_arrayfilter_saturation)
+
+    def __init__(self, rawdata, args):
+        super().__init__(rawdata, args)
+        self._data_series = np.asarray(self._data_series, dtype = np.float64).reshape(-1, 4)
+
+# Creates the DataSeries for the data of a VM, using the arrays if numpy is available
+def newDataSeries(rawdata, args):
+    if np is not None:
+        return ArrayDataSeries(rawdata, args)
+    return DataSeries(rawdata, args)
@@ -0,0 +1,91 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import time
+from datetime import datetime, timedelta
+from .common import p_error, p_debug, p_debugv, p_info
+from .storage import MAINTENANCE_BATCH_SIZE, MAINTENANCE_VACUUM_PAGES
+
+# The maximum amount of seconds that each call to Maintenance.run can take
+DEFAULT_STEP_TIME = 0.5
+
+# The maintenance of the database that the monitor makes while it is idle, in small steps (see the MAINTENANCE_* settings)
+class Maintenance:
+    # @param retention the amount of seconds that the samples are kept (None to keep them forever)
+    # @param interval the amount of seconds between the searches for expired samples
+    # @param checkpoint_interval, analyze_interval the amount of seconds between checkpoints and between updates of the statistics (0 to
+    #   disable them)
+    def __init__(self, retention = None, interval = 3600, batchsize = MAINTENANCE_BATCH_SIZE, checkpoint_interval = 300, analyze_interval = 86400,
+                    step_time = DEFAULT_STEP_TIME):
+        self._retention = retention if (retention is not None) and (retention > 0) else None
+        self._interval = interval
+        self._batchsize = batchsize
+        self._checkpoint_interval = checkpoint_interval
+        self._analyze_interval = analyze_interval
+        self._step_time = step_time
+
+        # The moment of the last run of each task (the first checkpoint and analyze are made after their interval)
+        now = time.monotonic()
+        self._t_expire = None
+        self._t_checkpoint = now
+        self._t_analyze = now
+
+        # Whether there are expired samples or free pages pending (i.e. the task continues in the next step)
+        self._expiring = False
+        self._vacuuming = False
+        self._expired = 0
+
+    def _due(self, t, interval):
+        return (interval > 0) and ((t is None) or (time.monotonic() - t >= interval))
+
+    # Makes a step of the maintenance of the storage
+    # @return True if there is work pending (i.e. the next step should be run as soon as possible)
+    def run(self, storage):
+        deadline = time.monotonic() + self._step_time
+        try:
+            if self._due(self._t_checkpoint, self._checkpoint_interval):
+                self._t_checkpoint = time.monotonic()
+                if not storage.checkpoint():
+                    p_debugv("the checkpoint could not be completed (there are readers using the database)")
+
+            if self._due(self._t_analyze, self._analyze_interval):
+                self._t_analyze = time.monotonic()
+                p_debug("updating the statistics of the database")
+                storage.analyze()
+
+            if (self._retention is not None) and (self._expiring or self._due(self._t_expire, self._interval)):
+                if not self._expiring:
+                    self._t_expire = time.monotonic()
+                    self._expiring = True
+                # The timestamps of the samples are in UTC (see Monitor.monitorVMs)
+                keepFromDate = datetime.utcnow() - timedelta(seconds = self._retention)
+                while self._expiring and (time.monotonic() < deadline):
+                    rows = storage.expire(keepFromDate, self._batchsize)
+                    self._expired += rows
+                    if rows == 0:
+                        self._expiring = False
+                        if self._expired > 0:
+                            p_info("{} expired samples deleted".format(self._expired))
+                            self._vacuuming = True
+                        self._expired = 0
+
+            if self._vacuuming and (time.monotonic() < deadline):
+                self._vacuuming = storage.incrementalvacuum(MAINTENANCE_VACUUM_PAGES) > 0
+        except Exception as e:
+            p_error("the maintenance of the database failed: {}".format(e))
+            self._expiring = False
+            self._vacuuming = False
+
+        return self._expiring or self._vacuuming
@@ -22,11 +22,16 @@ from .virsh2osidle import readDomains
 from .common import *
 from .osconnect import getServers, getServerInfo, Token
 from datetime import datetime
-from .storage import Storage, remove_unneeded_data
+from .storage import remove_unneeded_data, SCHEMA_VERSION
+from .sharding import newStorage
+from .writer import StorageWriter
+from .maintenance import Maintenance
 from .runcommand import runcommand_e
 import argparse
 from .configuration import Configuration
 import os 
+import signal
+import atexit
 from .version import VERSION
 from .explodestring import RangeExploder
 
@@ -69,6 +74,9 @@ class Monitor:
 
         t0 = datetime.now().timestamp()
 
+        # The samples of the block are stored at once, in a single transaction
+        samples = []
+
         while (count < limit) and (len(self._pending_vms) > 0) and (walltime > 0):
             nextId = self._pending_vms.pop(0)
 
@@ -84,7 +92,8 @@ class Monitor:
                 serverInfo = None
             
             if serverInfo is not None:
-                self._db.savevm(nextId, filter_fnc(serverInfo))
+                # The timestamp is the time in which the sample was obtained (in UTC, as the default value in the database)
+                samples.append((nextId, filter_fnc(serverInfo), datetime.utcnow()))
 
             count += 1
             t1 = datetime.now().timestamp()
@@ -92,6 +101,10 @@ class Monitor:
             p_debugv("still have {} seconds to monitor in this block".format(walltime))
             t0 = t1
 
+        if len(samples) > 0:
+            if not self._db.savevms(samples):
+                p_error("failed to store the samples of {} VMs".format(len(samples)))
+
         p_debug("{} VMs monitored".format(count))
         return failed
 
@@ -270,9 +283,11 @@ class MonitorClusterSSH(Monitor):
                     p_debug(f"obtained {len(domains)} VMs from host {nextId}")
                     p_debugv(f"vm ids: {', '.join(list(domains.keys()))}")
 
-                    for vmId in domains:
-                        serverInfo = domains[vmId]
-                        self._db.savevm(vmId, filter_fnc(serverInfo))
+                    # All the domains in the host are stored at once, in a single transaction
+                    t = datetime.utcnow()
+                    samples = [ (vmId, filter_fnc(serverInfo), t) for vmId, serverInfo in domains.items() ]
+                    if not self._db.savevms(samples):
+                        p_error(f"failed to store the samples of the VMs in host {nextId}")
 
                 count += 1
                 t1 = datetime.now().timestamp()
@@ -283,6 +298,81 @@ class MonitorClusterSSH(Monitor):
         p_debug("{} hosts monitored".format(count))
         return failed
 
+# Connects to the storage; unless WRITER_QUEUE_SIZE is 0, the samples are stored (and the maintenance made) from a StorageWriter
+# @return the object to which the monitor must pass the samples (i.e. the writer or the storage)
+def _startwriter(storage, configuration, maintenance):
+    if configuration["WRITER_QUEUE_SIZE"] <= 0:
+        storage.connect()
+        if not storage.isConnected():
+            p_error("failed to connect to the database")
+            sys.exit(1)
+        _checkschema(storage)
+        return storage
+
+    writer = StorageWriter(storage, queue_size = configuration["WRITER_QUEUE_SIZE"], commit_size = configuration["WRITER_COMMIT_SIZE"], commit_interval = configuration["WRITER_COMMIT_INTERVAL"],
+        idle_fnc = maintenance.run)
+    if not writer.start():
+        p_error("failed to connect to the database")
+        sys.exit(1)
+
+    # The samples that are waiting in the queue are stored when the monitor is stopped (e.g. systemctl stop)
+    atexit.register(writer.stop)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    _checkschema(writer)
+    return writer
+
+# The monitor does not migrate a database with samples, because some migrations copy whole tables (see osidle-dbpack --migrate)
+def _checkschema(storage):
+    version = storage.getschemaversion()
+    if version < SCHEMA_VERSION:
+        p_error("the database schema is outdated (version {}); please run osidle-dbpack --migrate before starting the monitor".format(version))
+        sys.exit(1)
+
+# Reports the counters of the writer (if any)
+# @return the amount of samples that were dropped or could not be stored since the previous call
+def _writerstats(storage, previous):
+    if not isinstance(storage, StorageWriter):
+        return 0
+    stats = storage.getstats()
+    p_debug("writer: {queued} blocks queued (max {maxqueued}), {written} samples stored in {commits} commits, {failed} failed, {dropped} dropped, {blocked} waits for the queue".format(**stats))
+    lost = stats["failed"] + stats["dropped"]
+    lost, previous["lost"] = lost - previous.get("lost", 0), lost
+    return lost
+
+# The settings of the storage, the writer and the maintenance, which are the same for both monitors
+_STORAGE_DEFAULTS = {
+    # The "synchronous" level of the database: OFF, NORMAL, FULL or EXTRA (default: NORMAL)
+    "DATABASE_SYNCHRONOUS": "NORMAL",
+    # The milliseconds to wait for the database when it is locked by other process (default: 5000)
+    "DATABASE_BUSY_TIMEOUT": 5000,
+    # The codec of the data of the samples: none, zlib or zstd (default: none)
+    "PAYLOAD_CODEC": "none",
+    # Store the samples in one database file per period: none, daily, monthly or yearly (default: none)
+    "DATABASE_SHARDING": "none",
+    # Extend the previous sample of a VM instead of storing a sample whose counters have not changed (default: False)
+    "DATABASE_DEDUP": False,
+    # Pack the samples of each VM in one row per hour, once the hour is over (default: False)
+    "DATABASE_CHUNKS": False,
+    # The engine of the database: sqlite, or binary (a folder with a file per VM, which ignores the previous four options) (default: sqlite)
+    "DATABASE_ENGINE": "sqlite",
+    # The blocks of samples that can wait to be stored by the writer thread; 0 stores them from the monitoring loop (default: 100)
+    "WRITER_QUEUE_SIZE": 100,
+    # The amount of samples stored in each transaction (default: 500)
+    "WRITER_COMMIT_SIZE": 500,
+    # The maximum amount of seconds that a sample waits to be stored (default: 10)
+    "WRITER_COMMIT_INTERVAL": 10,
+    # Delete the samples older than this amount of time, e.g. 1Y, 6M or 90d (default: empty, to keep all the samples)
+    "MAINTENANCE_RETENTION": ("", lambda x: None if x == "" else toSeconds(x)),
+    # The amount of seconds between the searches for expired samples (default: 3600)
+    "MAINTENANCE_INTERVAL": 3600,
+    # The amount of expired samples deleted in each transaction (default: 1000)
+    "MAINTENANCE_BATCH_SIZE": 1000,
+    # The amount of seconds between the checkpoints of the WAL file; 0 disables them (default: 300)
+    "MAINTENANCE_CHECKPOINT_INTERVAL": 300,
+    # The amount of seconds between the updates of the statistics of the database; 0 disables them (default: 86400)
+    "MAINTENANCE_ANALYZE_INTERVAL": 86400,
+}
+
 def osidle_monitor_virsh():
     config = Configuration({
             "DEFAULT": {
@@ -322,6 +412,7 @@ def osidle_monitor_virsh():
                 "FRONTEND_PRIVATEKEY_FILE": ("", lambda x: None if x == "" else x),
                 # By default, osidle monitor will store the raw data obtained for each VM. Changing this option allows to store only the data that will use osidle (default: True, to store the raw data)
                 "STORE_RAW_DATA": True,
+                **_STORAGE_DEFAULTS,
             }
         }
     )
@@ -375,8 +466,11 @@ def osidle_monitor_virsh():
 
     # Connect to the database (if possible)
     p_debugv("connecting to the database {}".format(args.database))
-    storage = Storage(args.database)
-    storage.connect()
+    storage = newStorage(args.database, sharding = configuration["DATABASE_SHARDING"], synchronous = configuration["DATABASE_SYNCHRONOUS"], busy_timeout = configuration["DATABASE_BUSY_TIMEOUT"], codec = configuration["PAYLOAD_CODEC"],
+        dedup = configuration["DATABASE_DEDUP"], chunks = configuration["DATABASE_CHUNKS"], engine = configuration["DATABASE_ENGINE"])
+    maintenance = Maintenance(configuration["MAINTENANCE_RETENTION"], configuration["MAINTENANCE_INTERVAL"], configuration["MAINTENANCE_BATCH_SIZE"],
+        configuration["MAINTENANCE_CHECKPOINT_INTERVAL"], configuration["MAINTENANCE_ANALYZE_INTERVAL"])
+    storage = _startwriter(storage, configuration, maintenance)
 
                 
     # Prepare the monitor
@@ -402,6 +496,7 @@ def osidle_monitor_virsh():
 
     # List of errors
     error_list = []
+    writerstats = {}
 
     if not args.storerawdata:
         p_debug("removing the unneeded data")
@@ -435,6 +530,10 @@ def osidle_monitor_virsh():
                         p_debug("failed to monitor {} vms".format(failed))
                         error_list.append(s_error("failed to monitor {} vms".format(failed)))
 
+                    lost = _writerstats(storage, writerstats)
+                    if lost > 0:
+                        error_list.append(s_error("failed to store {} samples".format(lost)))
+
                 t0_vm = datetime.now().timestamp()
 
             if (t0_full + args.vmupdate) < t1:
@@ -445,6 +544,10 @@ def osidle_monitor_virsh():
                 t0_vm = datetime.now().timestamp()
                 t0_full = t0_vm
 
+            # Without a writer, the maintenance is made from the main loop
+            if not isinstance(storage, StorageWriter):
+                maintenance.run(storage)
+
             if t1 - t00 > configuration["STILL_ALIVE_MESSAGE_INTERVAL"]:
                 p_info(configuration["STILL_ALIVE_MESSAGE"])
                 t00 = t1
@@ -494,6 +597,7 @@ def osidle_monitor():
                 "SILENCE_CONFLICTING": False,
                 # By default, osidle monitor will store the raw data obtained for each VM. Changing this option allows to store only the data that will use osidle (default: True, to store the raw data)
                 "STORE_RAW_DATA": True,
+                **_STORAGE_DEFAULTS,
             }
         }
     )
@@ -551,8 +655,11 @@ def osidle_monitor():
 
     # Connect to the database (if possible)
     p_debugv("connecting to the database {}".format(args.database))
-    storage = Storage(args.database)
-    storage.connect()
+    storage = newStorage(args.database, sharding = configuration["DATABASE_SHARDING"], synchronous = configuration["DATABASE_SYNCHRONOUS"], busy_timeout = configuration["DATABASE_BUSY_TIMEOUT"], codec = configuration["PAYLOAD_CODEC"],
+        dedup = configuration["DATABASE_DEDUP"], chunks = configuration["DATABASE_CHUNKS"], engine = configuration["DATABASE_ENGINE"])
+    maintenance = Maintenance(configuration["MAINTENANCE_RETENTION"], configuration["MAINTENANCE_INTERVAL"], configuration["MAINTENANCE_BATCH_SIZE"],
+        configuration["MAINTENANCE_CHECKPOINT_INTERVAL"], configuration["MAINTENANCE_ANALYZE_INTERVAL"])
+    storage = _startwriter(storage, configuration, maintenance)
 
     # Prepare the monitor
     monitor = Monitor(storage)
@@ -571,6 +678,7 @@ def osidle_monitor():
 
     # List of errors
     error_list = []
+    writerstats = {}
 
     if not args.storerawdata:
         p_debug("removing the unneeded data")
@@ -604,6 +712,10 @@ def osidle_monitor():
                         p_debug("failed to monitor {} vms".format(failed))
                         error_list.append(s_error("failed to monitor {} vms".format(failed)))
 
+                    lost = _writerstats(storage, writerstats)
+                    if lost > 0:
+                        error_list.append(s_error("failed to store {} samples".format(lost)))
+
                 t0_vm = datetime.now().timestamp()
 
             if (t0_full + args.vmupdate) < t1:
@@ -614,6 +726,10 @@ def osidle_monitor():
                 t0_vm = datetime.now().timestamp()
                 t0_full = t0_vm
 
+            # Without a writer, the maintenance is made from the main loop
+            if not isinstance(storage, StorageWriter):
+                maintenance.run(storage)
+
             if t1 - t00 > configuration["STILL_ALIVE_MESSAGE_INTERVAL"]:
                 p_info(configuration["STILL_ALIVE_MESSAGE"])
                 t00 = t1
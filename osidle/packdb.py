@@ -1,7 +1,9 @@
 from .common import *
 import argparse
 from .version import VERSION
-from .storage import Storage, remove_unneeded_data
+from .storage import remove_unneeded_data, SCHEMA_VERSION, MIGRATION_BATCH_SIZE
+from .payload import CODECS
+from .sharding import newStorage, ENGINES
 import shutil
 import os
 import datetime
@@ -23,7 +25,14 @@ def osidle_packdb():
     parser.add_argument("-v", "--verbose", dest="verbose", help="verbose", action="store_true", default=False)
     parser.add_argument("-vv", "--verbose-more", dest="verbosemore", help="verbose more", action="store_true", default=False)
     parser.add_argument("-m", "--minimize", dest="minimize", help="minimize the entries in the database", action="store_true", default=False)
+    parser.add_argument("--migrate", dest="migrate", help="migrate the database to the current version of the schema and cluster the samples of each VM again (this action happens before any other action)", action="store_true", default=False)
+    parser.add_argument("--batch-size", dest="batchsize", help="amount of rows to process in each step of the migration", type=int, default=MIGRATION_BATCH_SIZE)
+    parser.add_argument("--recompress", dest="recompress", help="re-encode the data of the samples using this codec (this action happens after minimizing the entries)", choices=CODECS, default=None)
+    parser.add_argument("--train-dictionary", dest="traindictionary", help="when recompressing using zstd, train a new dictionary from the samples in the database before", action="store_true", default=False)
+    parser.add_argument("--rebuild-rollups", dest="rebuildrollups", help="calculate the incremental samples, the hourly and daily rollups and the catalog of VMs again from the samples in the database (e.g. if samples have been stored out of order)", action="store_true", default=False)
     parser.add_argument("-M", "--minimize-to", dest="minimizeto", help="minimize the entries in the database to another database (this action happens after any other action, e.g. removing data)", default=None)
+    parser.add_argument("--convert-to", dest="convertto", help="copy the samples to a new database that uses other engine (this action happens after any other action)", default=None)
+    parser.add_argument("--engine", dest="engine", help="the engine of the database created by --convert-to (default: the other engine than the one of the database)", choices=ENGINES, default=None)
     parser.add_argument('--version', action='version', version=VERSION)
 
     args = parser.parse_args()
@@ -36,8 +45,8 @@ def osidle_packdb():
             setVerbose(2)
 
     # Connect to the database (if possible)
-    storage = Storage(args.database)
-    storage.connect()
+    storage = newStorage(args.database)
+    storage.connect(upgrade = False)
 
     # Get the begin and end time of the data
     p_debugv("getting information from the database")
@@ -73,27 +82,38 @@ def osidle_packdb():
             p_debugv("forcing not backing up the database")
 
     if args.backupdb:
-        if args.backupfile is None:
-            args.backupfile = "{}/{}-{}".format(os.path.dirname(args.database), datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), os.path.basename(args.database))
+        # A sharded database has one file per period, and each of them is backed up next to the original file
+        filenames = storage.getfilenames()
+        if (args.backupfile is not None) and (len(filenames) > 1):
+            p_error("the database is sharded in {} files, so the name of the backup file cannot be set".format(len(filenames)))
+            sys.exit(1)
 
-        backupfile = args.backupfile
-        try:
-            if os.path.exists(backupfile) and args.force:
-                p_debugv("forcing overwriting the backup file")
-                args.overwrite = True
+        for filename in filenames:
+            backupfile = args.backupfile
+            if backupfile is None:
+                backupfile = "{}/{}-{}".format(os.path.dirname(os.path.abspath(filename)), datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), os.path.basename(filename))
 
-            if os.path.exists(backupfile) and not args.overwrite:
-                args.overwrite = user_yes_no_query("backup file {} already exists. Overwrite it?".format(backupfile), "n")
+            try:
+                if os.path.exists(backupfile) and args.force:
+                    p_debugv("forcing overwriting the backup file")
+                    args.overwrite = True
 
-            if os.path.exists(backupfile) and not args.overwrite:
-                p_error("not overwritting backup file {}".format(backupfile))
-                sys.exit(1)
+                if os.path.exists(backupfile) and not args.overwrite:
+                    args.overwrite = user_yes_no_query("backup file {} already exists. Overwrite it?".format(backupfile), "n")
 
-            p_info("backing up database to file {}".format(backupfile))
-            shutil.copyfile(args.database, backupfile)
-        except Exception as e:
-            p_error("could not backup database: {}".format(e))
-            sys.exit(1)
+                if os.path.exists(backupfile) and not args.overwrite:
+                    p_error("not overwritting backup file {}".format(backupfile))
+                    sys.exit(1)
+
+                p_info("backing up database to file {}".format(backupfile))
+                # The binary databases are folders (see DATABASE_ENGINE)
+                if os.path.isdir(filename):
+                    shutil.copytree(filename, backupfile, dirs_exist_ok=True)
+                else:
+                    shutil.copyfile(filename, backupfile)
+            except Exception as e:
+                p_error("could not backup database: {}".format(e))
+                sys.exit(1)
     else:
         p_info("not backing up database ")
     
@@ -102,6 +122,44 @@ def osidle_packdb():
             p_info("aborting the operation")
             sys.exit(0)
 
+    # Any other action needs the current version of the schema, so the database is migrated in any case (it has already been backed up)
+    version = storage.getschemaversion()
+    if args.migrate or (version < SCHEMA_VERSION):
+        if version >= SCHEMA_VERSION:
+            p_info("the database schema is already up to date (version {})".format(version))
+        else:
+            p_info("migrating the database schema from version {} to {}".format(version, SCHEMA_VERSION))
+
+            pbars = {}
+            def migrateprogress(version, done, total):
+                if not args.quiet:
+                    if version not in pbars:
+                        pbars[version] = tqdm(total=total, desc="Migrating to version {}".format(version), unit="entries")
+                    pbars[version].update(done - pbars[version].n)
+
+            storage.migrate(args.batchsize, migrateprogress)
+            for pbar in pbars.values():
+                pbar.close()
+            need_vaccuum = True
+            p_info("database migrated to schema version {}".format(SCHEMA_VERSION))
+
+        # The samples stored since the table was copied are interleaved (the migration to version 2 has just clustered them)
+        if args.migrate and (version >= 2):
+            p_info("clustering the samples of each VM")
+
+            pbars = {}
+            def clusterprogress(done, total):
+                if not args.quiet:
+                    if "cluster" not in pbars:
+                        pbars["cluster"] = tqdm(total=total, desc="Clustering the samples", unit="entries")
+                    pbars["cluster"].total = total
+                    pbars["cluster"].update(done - pbars["cluster"].n)
+
+            storage.cluster(args.batchsize, clusterprogress)
+            for pbar in pbars.values():
+                pbar.close()
+            need_vaccuum = True
+
     if (args.keepfromdate is not None) or (args.keeptodate is not None):
         rows = storage.delete(args.keepfromdate, args.keeptodate)
         need_vaccuum = True
@@ -117,7 +175,7 @@ def osidle_packdb():
             global pbar
             pbar.close()
 
-    def filterdata(vmid, t, data):
+    def filterdata(vmid, s, data):
         if not args.quiet:
             global pbar
             pbar.update(1)
@@ -143,13 +201,87 @@ def osidle_packdb():
 
             p_info("minimizing database to file {}".format(args.minimizeto))
 
-            dest_storage = Storage(args.minimizeto)
+            # The minimized database is a single file (or folder) of the same engine than the database
+            dest_storage = newStorage(args.minimizeto, sharding = "none", engine = "binary" if os.path.isdir(args.database) else "sqlite")
             dest_storage.connect()
+            if not dest_storage.isConnected():
+                p_error("could not create the destination database")
+                sys.exit(1)
 
             storage.filterdata_to(filterdata, prefilter, postfilter, dest_storage)
             # dest_storage.vaccuum()
             p_info("database minimized to file {}".format(args.minimizeto))
 
+    if args.recompress is not None:
+        if args.traindictionary:
+            if args.recompress != "zstd":
+                p_warning("dictionaries are only used by zstd; not training a dictionary")
+            else:
+                dictid = storage.traindictionary()
+                p_info("new zstd dictionary {} trained".format(dictid))
+
+        p_info("recompressing the database using codec {}".format(args.recompress))
+
+        pbars = {}
+        def recompressprogress(done, total):
+            if not args.quiet:
+                if "recompress" not in pbars:
+                    pbars["recompress"] = tqdm(total=total, desc="Recompressing entries", unit="entries")
+                pbars["recompress"].update(done - pbars["recompress"].n)
+
+        storage.recompress(args.recompress, args.batchsize, recompressprogress)
+        for pbar in pbars.values():
+            pbar.close()
+        need_vaccuum = True
+
+    if args.convertto is not None:
+        if args.engine is None:
+            args.engine = "sqlite" if os.path.isdir(args.database) else "binary"
+
+        if os.path.exists(args.convertto):
+            if not args.force and not user_yes_no_query("destination database already exists. Overwrite it?", "n"):
+                p_error("not overwritting destination database")
+                sys.exit(1)
+            p_debugv("removing destination database {}".format(args.convertto))
+            if os.path.isdir(args.convertto):
+                shutil.rmtree(args.convertto)
+            else:
+                for f in [ args.convertto, "{}-wal".format(args.convertto), "{}-shm".format(args.convertto) ]:
+                    if os.path.exists(f):
+                        os.remove(f)
+
+        p_info("converting database to file {} (engine {})".format(args.convertto, args.engine))
+
+        dest_storage = newStorage(args.convertto, sharding = "none", engine = args.engine)
+        dest_storage.connect()
+        if not dest_storage.isConnected():
+            p_error("could not create the destination database")
+            sys.exit(1)
+
+        def copydata(vmid, s, data):
+            if not args.quiet:
+                global pbar
+                pbar.update(1)
+            return data
+
+        storage.filterdata_to(copydata, prefilter, postfilter, dest_storage)
+        dest_storage.close()
+        p_info("database converted to file {}".format(args.convertto))
+
+    if args.rebuildrollups:
+        p_info("rebuilding the incremental samples, the rollups and the catalog of VMs")
+
+        pbars = {}
+        def rollupsprogress(done, total):
+            if not args.quiet:
+                if "rollups" not in pbars:
+                    pbars["rollups"] = tqdm(total=total, desc="Rebuilding rollups", unit="VMs")
+                pbars["rollups"].update(done - pbars["rollups"].n)
+
+        storage.rebuildderived(rollupsprogress)
+        for pbar in pbars.values():
+            pbar.close()
+
     if need_vaccuum:
         storage.vaccuum()
         p_info("database vaccuumed")
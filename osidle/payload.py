@@ -0,0 +1,172 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import json
+import struct
+import zlib
+from .common import p_warning
+
+# zstandard is optional: if it is not installed, zlib will be used instead
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# orjson is optional: if it is installed, it is used to encode and decode the json documents (the payloads and the output of the analysis),
+#   as it is faster than the json module (about twice when decoding the payloads and five times when encoding them); otherwise (or for the
+#   documents that it does not support) json is used
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The codecs that can be used to store the data of the samples
+CODECS = [ "none", "zlib", "zstd" ]
+
+# The payloads that are stored as text are plain json (i.e. "none" codec, the original format); the compressed payloads are stored as
+#   blobs that start with a tag that identifies the codec, so that the rows stored with different codecs can be read transparently
+TAG_ZLIB = b"z"
+TAG_ZSTD = b"s"
+# The payloads compressed with a zstd dictionary include the id of the dictionary after the tag (4 bytes, little endian)
+TAG_ZSTD_DICT = b"d"
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# The default size of the dictionaries trained for zstd (in bytes)
+DICTIONARY_SIZE = 64 * 1024
+
+# orjson decodes the integers that do not fit in 64 bits as floats, so the documents that have such long numbers (i.e. 20 digits or more) are
+#   decoded using json, so that any existing payload is decoded exactly in the same way; the digits are found by translating the document
+#   (i.e. each digit into "0" and any other byte into a space), which is much faster than a regular expression
+_DIGITS_TABLE = bytes(ord("0") if chr(i) in "0123456789" else ord(" ") for i in range(256))
+_LONG_NUMBER = b"0" * 20
+
+# Encodes an object as a json string; orjson produces the compact form (i.e. without spaces), and json is used for the indented output and for
+#   the objects that orjson does not support (e.g. keys that are not strings or integers that do not fit in 64 bits)
+def json_dumps(obj, indent = None):
+    if (orjson is not None) and (indent is None):
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj, indent = indent)
+
+# Decodes a json document (either a string or bytes); the documents that orjson does not accept (e.g. the NaN values that json encodes) are
+#   decoded using json
+def json_loads(data):
+    if orjson is not None:
+        try:
+            raw = data.encode("utf-8") if isinstance(data, str) else data
+            if _LONG_NUMBER not in raw.translate(_DIGITS_TABLE):
+                return orjson.loads(raw)
+        except ValueError:
+            pass
+    return json.loads(data)
+
+class PayloadCodec:
+    def __init__(self, codec = "none", dictionaries = None):
+        """
+        @param codec: the codec used to encode the payloads (one of CODECS); the payloads are decoded according to their tag, whatever the codec
+        @param dictionaries: a dict of { id: bytes } with the zstd dictionaries that can be used to decode the payloads; the one with the
+            greatest id is used to encode the new payloads
+        """
+        if codec not in CODECS:
+            p_warning("invalid payload codec {}; using none".format(codec))
+            codec = "none"
+        if codec == "zstd" and zstandard is None:
+            p_warning("zstandard module is not installed; using zlib to compress the payloads")
+            codec = "zlib"
+        self._codec = codec
+        self._dictionaries = {}
+        self._compressor = None
+        self._compressor_dictid = None
+        self._decompressors = {}
+
+        for dictid, data in (dictionaries or {}).items():
+            self.add_dictionary(dictid, data)
+
+    @property
+    def codec(self):
+        return self._codec
+
+    @property
+    def dictionaries(self):
+        return self._dictionaries
+
+    def add_dictionary(self, dictid, data):
+        self._dictionaries[dictid] = data
+        # The compressors are created lazily (the newest dictionary is used to compress)
+        self._compressor = None
+        self._compressor_dictid = None
+
+    def _zstd_compressor(self):
+        if self._compressor is None:
+            if len(self._dictionaries) > 0:
+                self._compressor_dictid = max(self._dictionaries.keys())
+                self._compressor = zstandard.ZstdCompressor(level = ZSTD_LEVEL, dict_data = zstandard.ZstdCompressionDict(self._dictionaries[self._compressor_dictid]))
+            else:
+                self._compressor = zstandard.ZstdCompressor(level = ZSTD_LEVEL)
+        return self._compressor
+
+    def _zstd_decompressor(self, dictid = None):
+        if zstandard is None:
+            raise Exception("the zstandard module is needed to read payloads compressed with zstd")
+        if dictid not in self._decompressors:
+            if dictid is None:
+                self._decompressors[dictid] = zstandard.ZstdDecompressor()
+            else:
+                if dictid not in self._dictionaries:
+                    raise Exception("the zstd dictionary {} is not available".format(dictid))
+                self._decompressors[dictid] = zstandard.ZstdDecompressor(dict_data = zstandard.ZstdCompressionDict(self._dictionaries[dictid]))
+        return self._decompressors[dictid]
+
+    # Encodes the data of a sample, using the codec of the object
+    # @return a string (for codec "none") or a blob that starts with the tag of the codec
+    def encode(self, info):
+        data = json_dumps(info)
+        if self._codec == "zlib":
+            return TAG_ZLIB + zlib.compress(data.encode("utf-8"), ZLIB_LEVEL)
+        if self._codec == "zstd":
+            compressed = self._zstd_compressor().compress(data.encode("utf-8"))
+            if self._compressor_dictid is None:
+                return TAG_ZSTD + compressed
+            return TAG_ZSTD_DICT + struct.pack("<I", self._compressor_dictid) + compressed
+        return data
+
+    # Decodes a payload stored in the database, whatever the codec used to encode it
+    def decode(self, data):
+        if isinstance(data, str):
+            return json_loads(data)
+
+        data = bytes(data)
+        tag = data[:1]
+        if tag == TAG_ZLIB:
+            return json_loads(zlib.decompress(data[1:]))
+        if tag == TAG_ZSTD:
+            return json_loads(self._zstd_decompressor().decompress(data[1:]))
+        if tag == TAG_ZSTD_DICT:
+            (dictid, ) = struct.unpack("<I", data[1:5])
+            return json_loads(self._zstd_decompressor(dictid).decompress(data[5:]))
+
+        # Just in case that a plain json has been stored as a blob
+        return json_loads(data)
+
+# Trains a zstd dictionary from a set of samples (i.e. the data of the samples, as they are returned by the database)
+# @return the data of the dictionary (bytes)
+def train_dictionary(samples, size = DICTIONARY_SIZE):
+    if zstandard is None:
+        raise Exception("the zstandard module is needed to train dictionaries")
+    return zstandard.train_dictionary(size, [ json_dumps(x).encode("utf-8") for x in samples ]).as_bytes()
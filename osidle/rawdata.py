@@ -13,26 +13,234 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 #
+import bisect
 import copy
-from datetime import datetime, timedelta
-import json
+from itertools import accumulate
 
-from osidle.common import p_warning
+from osidle.common import p_warning, toepoch, fromepoch
+from osidle.payload import json_dumps
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The format of the human readable timestamps (t and T) in the output
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# The human readable timestamp (in UTC) of an epoch (isoformat obtains the same string than strftime(TIME_FORMAT), but it is much faster)
+def _strtime(s):
+    return fromepoch(s).isoformat(timespec = "microseconds") + "Z"
+
+# Builds the "base" sample of a series of samples of a VM: a fake sample in which the consumption of resources is cleared, because it is the
+#   moment in which the VM was started (i.e. the timestamp of the sample minus the uptime)
+# @param d the first sample of the series (it needs the fields s and uptime)
+def basesample(d):
+    s = d["s"] - d["uptime"]
+    return {
+        # e is the difference between the previous timestamp and this one
+        "e": 0,
+        # s is the timestamp in seconds
+        "s": s,
+        # S is the timestamp where the sample starts, in seconds
+        "S": s,
+        "uptime": 0,
+        "tcpu": 0,
+        "tdisk": 0,
+        "tnic": 0,
+    }
+
+# Calculates the incremental sample (i.e. the consumption of resources between two samples) by subtracting the previous sample from the
+#   current one; the units of the counters are kept (e.g. RawData uses seconds of CPU, while the database stores nanoseconds)
+# @param d0 the previous sample (or the base sample, see basesample)
+# @param d the current sample (it needs the fields s, tcpu, tdisk, tnic, ncpu, ndisk and nnic)
+# @return the incremental sample, or None if the counters have been reset (i.e. the VM was shut down and started again)
+def incremental(d0, d):
+    # TODO: what to do with resized instances (either the number of CPUs or the number of NICs or the number of DISKs)
+    if d0["tcpu"] > d["tcpu"] or d0["tdisk"] > d["tdisk"] or d0["tnic"] > d["tnic"]:
+        # We cannot calculate the incremental consumption, because we do not know the time from the previous sample
+        # TODO: When a VM is stopped and started later, the amount of CPU is reset to 0...
+        #   the same happens to disk and nic, but not the uptime. 
+        return None
+
+    # The elapsed time is the difference between the timestamp of the previous sample and the current one
+    e = d["s"] - d0["s"]
+    return {
+        "s": d['s'],
+        "ncpu": d['ncpu'],
+        "ndisk": d['ndisk'],
+        "nnic": d['nnic'],
+        "tcpu": d["tcpu"] - d0["tcpu"],
+        "tdisk": d["tdisk"] - d0["tdisk"],
+        "tnic": d["tnic"] - d0["tnic"],
+        "e": e,
+        "S": d["s"] - e,
+    }
+
+# Obtains the totals of a sample, without modifying it
+# @return a tuple (tcpu, tdisk, tnic, ncpu, ndisk, nnic), where tcpu is in seconds, or None if the sample has no information (e.g.
+#   conflictingRequest)
+def _totals(d):
+    if "tcpu_ns" in d:
+        # This is a "numeric" sample (see Storage.getvmdata), that already has the counters; if they are None, the sample has no
+        #   information (e.g. conflictingRequest)
+        if d["tcpu_ns"] is None:
+            return None
+
+        return (d["tcpu_ns"] * 1e-9, d["tdisk"], d["tnic"], d["ncpu"], d["ndisk"], d["nnic"])
+
+    # Skip the samples that do not have information
+    if "conflictingRequest" in d:
+        return None
+    if "itemNotFound" in d:
+        return None
+    if (not 'cpu_details' in d) or (not 'disk_details' in d) or (not 'nic_details' in d):
+        p_warning("Missing information in the sample: {}".format(json_dumps(d)))
+        return None
+
+    return (sum(x["time"] for x in d["cpu_details"]) * 1e-9,
+        sum(x["read_bytes"] + x["write_bytes"] for x in d["disk_details"]),
+        sum(x["rx_octets"] + x["tx_octets"] for x in d["nic_details"]),
+        len(d['cpu_details']), len(d['disk_details']), len(d['nic_details']))
+
+# The beginning and the end of each of the samples of a series of repeated samples, from s to send (see Storage dedup): the timestamps of the
+#   repeated samples are not kept, so they are evenly spaced (i.e. the same samples if they were taken at regular intervals)
+# @param repeats the amount of samples merged into the series (i.e. the ones after its first sample)
+def _repeatedsamples(s, send, repeats):
+    repeats = max(repeats, 1)
+    ends = [ s + (send - s) * k / repeats for k in range(1, repeats) ] + [ send ]
+    return zip([ s ] + ends, ends)
+
+# The fields of the incremental samples, in the order in which they appear in the samples (see incremental)
+SAMPLE_FIELDS = [ "s", "ncpu", "ndisk", "nnic", "tcpu", "tdisk", "tnic", "e", "S" ]
+
+# An incremental sample of RawData (see SAMPLE_FIELDS); it needs much less memory than a dict, but the fields can also be read as in the
+#   dict samples (e.g. d["tcpu"])
+class Sample:
+    __slots__ = SAMPLE_FIELDS
+
+    def __init__(self, s, ncpu, ndisk, nnic, tcpu, tdisk, tnic, e, S):
+        self.s = s
+        self.ncpu = ncpu
+        self.ndisk = ndisk
+        self.nnic = nnic
+        self.tcpu = tcpu
+        self.tdisk = tdisk
+        self.tnic = tnic
+        self.e = e
+        self.S = S
+
+    # Creates the sample from an incremental sample (either a Sample or a dict, e.g. the ones obtained from incremental)
+    @staticmethod
+    def fromsample(d):
+        if isinstance(d, Sample):
+            return d
+        return Sample(d["s"], d["ncpu"], d["ndisk"], d["nnic"], d["tcpu"], d["tdisk"], d["tnic"], d["e"], d["S"])
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def asdict(self):
+        return { "s": self.s, "ncpu": self.ncpu, "ndisk": self.ndisk, "nnic": self.nnic, "tcpu": self.tcpu, "tdisk": self.tdisk, "tnic": self.tnic,
+            "e": self.e, "S": self.S }
+
+# The counters whose totals in a range of dates are obtained from the prefix sums of the series (see RawData.usage)
+USAGE_FIELDS = [ "e", "tcpu", "tdisk", "tnic" ]
+
+# A sequence of one of the values of the samples of a series (e.g. the timestamps in which they start), so that the samples can be found
+#   using bisect, without building a list of the values
+class _Values:
+    def __init__(self, samples, value_fnc):
+        self._samples = samples
+        self._value_fnc = value_fnc
+
+    def __len__(self):
+        return len(self._samples)
+
+    def __getitem__(self, i):
+        return self._value_fnc(self._samples[i])
 
 class RawData:
-    def __init__(self, data, args):
-        _data = RawData._convert(data)
-        # TODO: discard the first sample as it is just the historic data?
-        _data = _data[1:]
-        self._data = RawData._get(_data, args.fromdate, args.todate)
+    # @param incremental if True, the data is already a series of incremental samples (e.g. the ones obtained from Storage.iter_deltas or
+    #   Storage.iter_rollups)
+    def __init__(self, data, args, incremental = False):
+        if incremental:
+            _data = [ Sample.fromsample(d) for d in data ]
+        else:
+            _data = RawData._convert(data)
+            # TODO: discard the first sample as it is just the historic data?
+            _data = _data[1:]
+
+        # The whole series is kept, so that other ranges of dates can be obtained without converting the samples again (see window); the
+        #   samples without duration are discarded, because they are out of any range of dates (see _get)
+        self._series = [ d for d in _data if d.e > 0 ]
+        self._starts = _Values(self._series, lambda d: d.S)
+        self._ends = _Values(self._series, lambda d: d.S + d.e)
+        self._sorted = all(a.S <= b.S and a.S + a.e <= b.S + b.e for (a, b) in zip(self._series, self._series[1:]))
+        self._sums = None
+        self._setwindow(args.fromdate, args.todate)
+
+    # Clips the series to a range of dates (see _clip)
+    def _setwindow(self, fromDate, toDate):
+        self._data = self._clip(fromDate, toDate)
         self._ncpu = None
         self._nnic = None
         self._ndisk = None
 
         if len(self._data) > 0:
-            self._ncpu = self._data[0]["ncpu"]
-            self._nnic = self._data[0]["nnic"]
-            self._ndisk = self._data[0]["ndisk"]
+            self._ncpu = self._data[0].ncpu
+            self._nnic = self._data[0].nnic
+            self._ndisk = self._data[0].ndisk
+
+    # Obtains the samples of other range of dates, without converting the samples again; the series is shared with this object
+    def window(self, fromDate, toDate):
+        result = copy.copy(self)
+        result._setwindow(fromDate, toDate)
+        return result
+
+    # Finds the samples of the series that are in a range of dates, using bisect: the samples in [first, last) are completely in the range,
+    #   while the samples in [lo, first) and [last, hi) are at the borders of the range (i.e. they are clipped or discarded as in _get); the
+    #   other samples are out of the range. A sample more is considered at each border, so that the samples that only touch the range (due
+    #   to the rounding of the timestamps) are evaluated as in _get
+    #   * if the series is not sorted, all the samples are considered at the borders
+    # @return a tuple (lo, first, last, hi)
+    def _bounds(self, t_fromDate, t_toDate):
+        if not self._sorted:
+            return (0, 0, 0, len(self._starts))
+
+        lo = max(0, bisect.bisect_left(self._ends, t_fromDate) - 1)
+        hi = min(len(self._starts), bisect.bisect_right(self._starts, t_toDate) + 1)
+        first = max(lo, bisect.bisect_left(self._starts, t_fromDate))
+        last = max(first, min(hi, bisect.bisect_right(self._ends, t_toDate)))
+        return (lo, first, last, hi)
+
+    # Obtains the samples of the series in a range of dates, as _get, but only the samples at the borders of the range are evaluated
+    def _clip(self, fromDate, toDate):
+        if toepoch(fromDate) > toepoch(toDate):
+            return []
+        (lo, first, last, hi) = self._bounds(toepoch(fromDate), toepoch(toDate))
+        return RawData._get(self._series[lo:first], fromDate, toDate) + self._series[first:last] + RawData._get(self._series[last:hi], fromDate, toDate)
+
+    # Obtains the total consumption in a range of dates (see USAGE_FIELDS), using the prefix sums of the series, so that only the samples
+    #   at the borders of the range are evaluated; the mean usage is the total of each counter divided by e
+    # @return a dict field: total
+    def usage(self, fromDate, toDate):
+        if self._sums is None:
+            self._sums = { f: list(accumulate((getattr(d, f) for d in self._series), initial = 0)) for f in USAGE_FIELDS }
+
+        totals = { f: 0 for f in USAGE_FIELDS }
+        if toepoch(fromDate) > toepoch(toDate):
+            return totals
+        (lo, first, last, hi) = self._bounds(toepoch(fromDate), toepoch(toDate))
+        for f in USAGE_FIELDS:
+            totals[f] = self._sums[f][last] - self._sums[f][first]
+        for d in RawData._get(self._series[lo:first] + self._series[last:hi], fromDate, toDate):
+            for f in USAGE_FIELDS:
+                totals[f] += getattr(d, f)
+        return totals
 
     @property
     def ncpu(self):
@@ -49,11 +257,20 @@ class RawData:
     def __str__(self):
         return self.dumpdata("json", True)
 
+    # Builds the samples with the human readable timestamps (t and T), that are only calculated for the output
+    def _withtimes(self):
+        result = []
+        for d in self.data:
+            d = { "t": _strtime(d["s"]), **d }
+            d["T"] = _strtime(d["S"])
+            result.append(d)
+        return result
+
     def dumpdata(self, format, pretty = False, transform_fnc = None):
         if format == "csv" or format == "excel":
             lines = []
-            for d in self._data:
-                v = (d["T"], d["S"], d["e"], 
+            for d in self.data:
+                v = (_strtime(d["S"]), d["S"], d["e"], 
                     d["tcpu"], d["tdisk"], d["tnic"])
                 try:
                     v = v + (
@@ -74,149 +291,279 @@ class RawData:
                 return "\n".join([ separador.join([str(v).replace(".", ",") for v in x ]) for x in lines ])
         else:
             if pretty:
-                return json.dumps(self._data, indent=4)
+                return json_dumps(self._withtimes(), indent=4)
             else:
-                return json.dumps(self._data)
+                return json_dumps(self._withtimes())
 
+    # The samples as a list of dicts
     @property
     def data(self):
-        return self._data
+        return [ d.asdict() for d in self._data ]
+
+    # The usage of the resources in each sample, to be analyzed (see DataSeries): a list of [ e, cpu (seconds/second), disk (bytes/second),
+    #   nic (bytes/second) ]
+    def rates(self):
+        return [ [x.e, x.tcpu/x.e, x.tdisk/x.e, x.tnic/x.e] for x in self._data ]
 
+    # Clips the samples (see Sample) to the range of dates; the samples that are partially in the range are replaced by a new sample with
+    #   the fraction of the consumption that is in the range
     @staticmethod
     def _get(data, fromDate = None, toDate = None):
-        t_fromDate = fromDate.timestamp()
-        t_toDate = toDate.timestamp()
+        t_fromDate = toepoch(fromDate)
+        t_toDate = toepoch(toDate)
         if (t_fromDate > t_toDate):
             return []
 
         _data = []
         for d in data:
-            time_after_begin = max(0, t_fromDate - d["S"])
-            time_before_end = max(0, d["S"] + d["e"] - t_toDate)
-            e = d["e"] - time_after_begin - time_before_end
+            time_after_begin = max(0, t_fromDate - d.S)
+            time_before_end = max(0, d.S + d.e - t_toDate)
+            e = d.e - time_after_begin - time_before_end
 
-            if e == d["e"]:
+            # The sample is completely out of the range of dates
+            if e <= 0:
+                continue
+
+            if e == d.e:
                 _data.append(d)
             else:
-                # Duplicate d and update the data
-                d = copy.deepcopy(d)
-                fraction = e / d["e"]
-                d["cpu"] = [ x * fraction for x in d["cpu"] ]
-                d["disk"] = [ { "r": x["r"] * fraction, "w": x["w"] * fraction } for x in d["disk"] ]
-                d["nic"] = [ { "rx": x["rx"] * fraction, "tx": x["tx"] * fraction } for x in d["nic"] ]
-                d["S"] = d["S"] + time_after_begin
-                d["e"] = e
-                d["T"] = datetime.fromtimestamp(d["S"]).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-                d["tcpu"] = d["tcpu"] * fraction
-                d["tdisk"] = d["tdisk"] * fraction
-                d["tnic"] = d["tnic"] * fraction
-                _data.append(d)
+                fraction = e / d.e
+                _data.append(Sample(d.s, d.ncpu, d.ndisk, d.nnic, d.tcpu * fraction, d.tdisk * fraction, d.tnic * fraction, e, d.S + time_after_begin))
 
         return _data
 
     # This function gets a data series and converts it to an incremental data series. It assumes that each of the samples in the input
     # data series is an absolute sample and so it converts it to an incremental data series by subtracting the previous sample from the
     # current one.
-    # Returns a set of samples with the following data:
-    #   - t: the timestamp where the sample was taken; 
-    #   - s: t in seconds
-    #   - T: the tiemstamp where the sample starts; 
-    #   - S: T in seconds
+    # Returns a list of samples (see Sample) with the following data:
+    #   - s: the timestamp where the sample was taken (in seconds since the epoch)
+    #   - S: the timestamp where the sample starts (in seconds since the epoch)
+    #   * the human readable versions (t and T) are only built in the output (see dumpdata)
     #   - e: the usage of the resources correspond to this continuous number of seconds
-    #   - cpu, nic, disk: the usage of the CPU, NIC and DISK
     #   - ncpu, nnic, ndis: number of CPUs, NICs and DISKs
-    #   - tcpu, tnic, tdisk: the aggregated amount of nanoseconds of CPU used, NIC tx and rx and DISK r and w
+    #   - tcpu, tnic, tdisk: the aggregated amount of seconds of CPU used, NIC tx and rx and DISK r and w
+    # The input samples are not modified (the subtraction is the same than in incremental, without building the intermediate dicts)
     @staticmethod
     def _convert(data):
         converted = []
-        d0 = None
+        # The previous sample: (s, tcpu, tdisk, tnic)
+        p0 = None
 
         for d in data:
-            # Skip the samples that do not have information
-            if "conflictingRequest" in d:
-                continue
-            if "itemNotFound" in d:
-                continue
-            if (not 'cpu_details' in d) or (not 'disk_details' in d) or (not 'nic_details' in d):
-                p_warning("Missing information in the sample: {}".format(json.dumps(d)))
+            totals = _totals(d)
+            if totals is None:
                 continue
+            (tcpu, tdisk, tnic, ncpu, ndisk, nnic) = totals
+            s = d["s"]
+
+            # If it is the first sample, the previous one is the "base" sample, in which the VM was started with the counters set to 0 (see
+            #   basesample)
+            if p0 is None:
+                p0 = (s - d["uptime"], 0, 0, 0)
 
-            d["tcpu"] = sum(x["time"] for x in d["cpu_details"]) * 1e-9
-            d["tdisk"] = sum([ x["read_bytes"] + x["write_bytes"] for x in d["disk_details"] ])
-            d["tnic"] = sum([ x["rx_octets"] + x["tx_octets"] for x in d["nic_details"] ])
-
-            # If it is the first sample, we'll use it as the base but we need to convert it to a "pseudo-incremental" sample that
-            # starts the series with values set to 0. It is needed to adjust the timestamp
-            if d0 is None:
-                # Clone d to create the fake first sample
-                d0 = copy.deepcopy(d)
-
-                # t is the timestamp of the sample (when it was obtained)
-                t = datetime.strptime(d["t"], "%Y-%m-%dT%H:%M:%S.%fZ") - timedelta(seconds=d["uptime"])
-                d0["t"] = t.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-                # T is the timestamp where the sample starts (when the consumption of resources started)
-                d0["T"] = d["t"]
-                # e is the difference between the previous timestamp and this one
-                d0["e"] = 0,
-                # s is the timestamp (t) in seconds
-                d0["s"] = t.timestamp() # d0["s"] - d0["uptime"]
-                # S is the timestamp (s) in seconds
-                d0["S"] = d0["s"]
-                # Now clear the resource consumption as this is a "base sample" (e.g.) the VM was just started
-                d0["uptime"] = 0
-                for c in d0["cpu_details"]:
-                    c['time'] = 0
-                for x in d0["disk_details"]:
-                    x['read_bytes'] = 0
-                    x['write_bytes'] = 0
-                for n in d0["nic_details"]:
-                    n['rx_octets'] = 0
-                    n['tx_octets'] = 0
-                d0["tcpu"] = 0
-                d0["tdisk"] = 0
-                d0["tnic"] = 0
-
-            # Calculate the current incremental sample by subtracting the previous sample from the current one (also conver cpu from nanoseconds to seconds)
-            d1 = {
-                "t": d['t'],
-                "s": d['s'],
-                "ncpu": len(d['cpu_details']),
-                "ndisk": len(d['disk_details']),
-                "nnic": len(d['nic_details']),
-                "tcpu": sum(x["time"] for x in d["cpu_details"]) * 1e-9,
-                "tdisk": sum([ x["read_bytes"] + x["write_bytes"] for x in d["disk_details"] ]),
-                "tnic": sum([ x["rx_octets"] + x["tx_octets"] for x in d["nic_details"] ]),
-            }
-            # TODO: what to do with resized instances (either the number of CPUs or the number of NICs or the number of DISKs)
-
-            if d0["tcpu"] > d1["tcpu"] or d0["tdisk"] > d1["tdisk"] or d0["tnic"] > d1["tnic"]:
-                # The VM has been stopped and started again later; will not subtract the previous sample from the current one
-
-                # We'll skip the sample, because we do not know the time from the previous sample: the requests between this and the previous one
-                #   are conflicting and we cannot calculate the incremental consumption.
-
-                # TODO: When a VM is stopped and started later, the amount of CPU is reset to 0...
-                #   the same happens to disk and nic, but not the uptime. 
+            (s0, tcpu0, tdisk0, tnic0) = p0
+            if tcpu0 > tcpu or tdisk0 > tdisk or tnic0 > tnic:
+                # The VM has been stopped and started again later; we'll skip the sample, because we do not know the time from the previous
+                #   sample: the requests between this and the previous one are conflicting and we cannot calculate the incremental consumption.
                 p_warning("Skipping sample with negative number of CPUs, disks or NICs (the VM was probably shut down)")
             else:
-                d1["tcpu"] = d1["tcpu"] - d0["tcpu"]
-                d1["tdisk"] = d1["tdisk"] - d0["tdisk"]
-                d1["tnic"] = d1["tnic"] - d0["tnic"]
+                e = s - s0
+                converted.append(Sample(s, ncpu, ndisk, nnic, tcpu - tcpu0, tdisk - tdisk0, tnic - tnic0, e, s - e))
 
-                # TODO: now we have to calculate the values of T, S and e both for d and for d1
-                # So we have to calculate the elapsed time, which is the difference between the timestamp of the previous sample and the current one
-                d1["e"] = d["s"] - d0["s"]
-                d1["S"] = d["s"] - d1["e"]
-                d1["T"] = datetime.fromtimestamp(d1["S"]).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+            # Store the sample to be the reference for the next one
+            p0 = (s, tcpu, tdisk, tnic)
 
-                # d1["tcpu"] = sum(d1["cpu"])
-                # d1["tdisk"] = sum([ x for n in d1["disk"] for x in [n["r"], n["w"]]])
-                # d1["tnic"] = sum([ x for n in d1["nic"] for x in [n["rx"], n["tx"]]])
+            # The sample stands for a series of repeated samples (see Storage dedup), so the counters did not change until send: each of the
+            #   repeated samples is an incremental sample without consumption (with the type of the counters), evenly spaced because their
+            #   timestamps are not kept, and the next sample is subtracted from the end of the series
+            send = d.get("send", s)
+            if send > s:
+                for (S, s1) in _repeatedsamples(s, send, d.get("repeats", 1)):
+                    converted.append(Sample(s1, ncpu, ndisk, nnic, tcpu - tcpu, tdisk - tdisk, tnic - tnic, s1 - S, S))
+                p0 = (send, tcpu, tdisk, tnic)
 
-                # Add the incremental sample to the result
-                converted.append(d1)
+        return converted
 
-            # Store the sample to be the reference for the previous one
-            d0 = d
+# The fields of the samples that are the amount of devices (they are stored as int64; the others as float64)
+_DEVICE_FIELDS = [ "ncpu", "ndisk", "nnic" ]
 
-        return converted
+# The counters of the samples that may be integer (i.e. bytes), that are kept as integer in the output unless they are clipped (see ArrayRawData._get)
+_INTEGER_FIELDS = [ "tdisk", "tnic" ]
+
+# RawData that keeps the incremental samples as a contiguous array per field (see SAMPLE_FIELDS), instead of a dict per sample, so that the
+#   samples of many VMs can be kept in memory and the conversion and the clipping of the samples are vectorized using numpy; the samples
+#   as dicts are only built if they are requested (e.g. to dump the data)
+#   * the incremental samples have no details per device (see incremental), so there are no arrays for them
+class ArrayRawData(RawData):
+    def __init__(self, data, args, incremental = False):
+        if incremental:
+            columns = ArrayRawData._columns([ [ d[f] for f in SAMPLE_FIELDS ] for d in data ])
+        else:
+            columns = ArrayRawData._convert(data)
+            # TODO: discard the first sample as it is just the historic data?
+            columns = { f: v[1:] for (f, v) in columns.items() }
+
+        # The integer counters are converted to float64, to be scaled; the ones that were integer are restored in the output
+        self._integer = [ f for f in _INTEGER_FIELDS if columns[f].dtype.kind in "iu" ]
+        columns.update({ f: columns[f].astype(np.float64) for f in _INTEGER_FIELDS })
+
+        # The whole series is kept to obtain other ranges of dates (see RawData.window)
+        withtime = columns["e"] > 0
+        if not withtime.all():
+            columns = { f: v[withtime] for (f, v) in columns.items() }
+        self._series = columns
+        self._starts = columns["S"]
+        self._ends = columns["S"] + columns["e"]
+        self._sorted = bool((np.diff(self._starts) >= 0).all() and (np.diff(self._ends) >= 0).all())
+        self._sums = None
+        self._setwindow(args.fromdate, args.todate)
+
+    def _setwindow(self, fromDate, toDate):
+        (self._columns, self._clipped) = self._clip(fromDate, toDate)
+        self._ncpu = None
+        self._nnic = None
+        self._ndisk = None
+
+        if len(self) > 0:
+            self._ncpu = int(self._columns["ncpu"][0])
+            self._nnic = int(self._columns["nnic"][0])
+            self._ndisk = int(self._columns["ndisk"][0])
+
+    # The samples around the range of dates are found using bisect (see RawData._bounds), and they are clipped using _get
+    def _clip(self, fromDate, toDate):
+        (lo, _, _, hi) = self._bounds(toepoch(fromDate), toepoch(toDate))
+        return ArrayRawData._get({ f: v[lo:hi] for (f, v) in self._series.items() }, fromDate, toDate)
+
+    def usage(self, fromDate, toDate):
+        if self._sums is None:
+            self._sums = { f: np.concatenate([ [ 0.0 ], np.cumsum(self._series[f]) ]) for f in USAGE_FIELDS }
+
+        totals = { f: 0 for f in USAGE_FIELDS }
+        if toepoch(fromDate) > toepoch(toDate):
+            return totals
+        (lo, first, last, hi) = self._bounds(toepoch(fromDate), toepoch(toDate))
+        (borders, _) = ArrayRawData._get({ f: np.concatenate([ v[lo:first], v[last:hi] ]) for (f, v) in self._series.items() }, fromDate, toDate)
+        for f in USAGE_FIELDS:
+            totals[f] = float(self._sums[f][last] - self._sums[f][first] + borders[f].sum())
+        return totals
+
+    def __len__(self):
+        return len(self._columns["s"])
+
+    # The arrays of the samples (a dict field: array, see SAMPLE_FIELDS)
+    @property
+    def columns(self):
+        return self._columns
+
+    # The samples as a list of dicts, in the same format than the samples of RawData
+    @property
+    def data(self):
+        columns = { f: self._columns[f].tolist() for f in SAMPLE_FIELDS }
+        clipped = self._clipped.tolist()
+        for f in self._integer:
+            columns[f] = [ v if c else int(v) for (v, c) in zip(columns[f], clipped) ]
+        return [ dict(zip(SAMPLE_FIELDS, values)) for values in zip(*[ columns[f] for f in SAMPLE_FIELDS ]) ]
+
+    # The rates are a 2d array (one row per sample), to be analyzed without converting them back (see ArrayDataSeries)
+    def rates(self):
+        e = self._columns["e"]
+        return np.column_stack([ e, self._columns["tcpu"] / e, self._columns["tdisk"] / e, self._columns["tnic"] / e ])
+
+    # Builds the arrays from the values of the samples
+    # @param rows a list of lists with the values of each sample, in the order of SAMPLE_FIELDS
+    @staticmethod
+    def _columns(rows):
+        if len(rows) == 0:
+            return { f: np.zeros(0, dtype = np.int64 if f in _DEVICE_FIELDS + _INTEGER_FIELDS else np.float64) for f in SAMPLE_FIELDS }
+
+        columns = {}
+        for (f, values) in zip(SAMPLE_FIELDS, zip(*rows)):
+            if f in _DEVICE_FIELDS:
+                columns[f] = np.array(values, dtype = np.int64)
+            elif f in _INTEGER_FIELDS:
+                # The type depends on the values (e.g. the bytes of the rollups are float)
+                columns[f] = np.array(values)
+            else:
+                columns[f] = np.array(values, dtype = np.float64)
+        return columns
+
+    # The vectorized version of RawData._get: the samples are clipped to the range of dates, and the counters of the samples that are
+    #   partially in the range are scaled to the fraction of the sample that is in the range
+    # @return a tuple (columns, clipped), where clipped is a boolean array that is True for the samples that have been clipped
+    @staticmethod
+    def _get(columns, fromDate = None, toDate = None):
+        t_fromDate = toepoch(fromDate)
+        t_toDate = toepoch(toDate)
+        if (t_fromDate > t_toDate):
+            columns = { f: v[:0] for (f, v) in columns.items() }
+            return (columns, np.zeros(0, dtype = bool))
+
+        S = columns["S"]
+        time_after_begin = np.maximum(0, t_fromDate - S)
+        time_before_end = np.maximum(0, S + columns["e"] - t_toDate)
+        e = columns["e"] - time_after_begin - time_before_end
+
+        # The samples that are completely out of the range of dates are discarded
+        inrange = e > 0
+        if not inrange.all():
+            columns = { f: v[inrange] for (f, v) in columns.items() }
+            (time_after_begin, e) = (time_after_begin[inrange], e[inrange])
+
+        clipped = e != columns["e"]
+        if clipped.any():
+            fraction = np.where(clipped, e / columns["e"], 1.0)
+            columns = { **columns, "S": np.where(clipped, columns["S"] + time_after_begin, columns["S"]), "e": e,
+                **{ f: columns[f] * fraction for f in [ "tcpu", "tdisk", "tnic" ] } }
+
+        return (columns, clipped)
+
+    # The vectorized version of RawData._convert: the incremental samples are obtained by subtracting each sample from the next one (np.diff),
+    #   and the samples in which any of the counters decrease (i.e. the VM was shut down and started again) are discarded
+    # @return the arrays of the incremental samples (see SAMPLE_FIELDS)
+    @staticmethod
+    def _convert(data):
+        # The points are the values of the counters at a time: the samples, plus the base sample at the beginning and the repeated samples
+        #   of the series (see Storage dedup), so that the consumption is subtracted from them
+        points = []
+        for d in data:
+            values = _totals(d)
+            if values is None:
+                continue
+
+            if len(points) == 0:
+                points.append([ d["s"] - d["uptime"], 0, 0, 0, *values[3:] ])
+            points.append([ d["s"], *values ])
+            if d.get("send", d["s"]) > d["s"]:
+                points.extend([ s1, *values ] for (_, s1) in _repeatedsamples(d["s"], d["send"], d.get("repeats", 1)))
+
+        if len(points) == 0:
+            return ArrayRawData._columns([])
+
+        (s, tcpu, tdisk, tnic, ncpu, ndisk, nnic) = [ np.array(values) for values in zip(*points) ]
+        e = np.diff(s.astype(np.float64))
+        counters = [ np.diff(x) for x in (tcpu, tdisk, tnic) ]
+
+        reset = (counters[0] < 0) | (counters[1] < 0) | (counters[2] < 0)
+        for _ in range(int(reset.sum())):
+            p_warning("Skipping sample with negative number of CPUs, disks or NICs (the VM was probably shut down)")
+        keep = ~reset
+
+        s = s[1:][keep].astype(np.float64)
+        e = e[keep]
+        return {
+            "s": s,
+            "ncpu": ncpu[1:][keep].astype(np.int64),
+            "ndisk": ndisk[1:][keep].astype(np.int64),
+            "nnic": nnic[1:][keep].astype(np.int64),
+            "tcpu": counters[0][keep].astype(np.float64),
+            "tdisk": counters[1][keep],
+            "tnic": counters[2][keep],
+            "e": e,
+            "S": s - e,
+        }
+
+# Creates the RawData for the samples of a VM: the samples are kept in arrays (see ArrayRawData) if numpy is installed
+def newRawData(data, args, incremental = False):
+    if np is not None:
+        return ArrayRawData(data, args, incremental)
+    return RawData(data, args, incremental)
@@ -0,0 +1,537 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import os
+import glob
+import heapq
+from datetime import datetime, timedelta
+from .common import p_error, p_warning, p_debug, p_info, fromepoch
+from .storage import Storage, DEFAULT_FILENAME, DEFAULT_BUSY_TIMEOUT, MIGRATION_BATCH_SIZE, MAINTENANCE_BATCH_SIZE, MAINTENANCE_VACUUM_PAGES, SCHEMA_VERSION, _tots
+from .binstorage import BinaryStorage
+
+# The periods that can be used to split the database in shards, and the format of the key of each period (that is included in the name
+#   of the file of the shard, e.g. osidled-2026-10.db for the monthly shards of osidled.db)
+SHARD_PERIODS = {
+    "daily": "%Y-%m-%d",
+    "monthly": "%Y-%m",
+    "yearly": "%Y",
+}
+
+SHARDING_MODES = [ "none", *SHARD_PERIODS.keys() ]
+
+# The engines that can store the samples: sqlite3 (Storage, a database file) or binary (BinaryStorage, a folder with a file of records per VM)
+ENGINES = [ "sqlite", "binary" ]
+
+# Obtains the key of the period that contains a moment (a naive datetime, the same than the timestamps of the samples)
+def _periodkey(t, period):
+    return t.strftime(SHARD_PERIODS[period])
+
+# Obtains the moments in which a period starts and ends (the end is the beginning of the next period)
+def _periodlimits(key, period):
+    begin = datetime.strptime(key, SHARD_PERIODS[period])
+    if period == "daily":
+        end = begin + timedelta(days = 1)
+    elif period == "monthly":
+        end = begin.replace(year = begin.year + 1, month = 1) if begin.month == 12 else begin.replace(month = begin.month + 1)
+    else:
+        end = begin.replace(year = begin.year + 1)
+    return (begin, end)
+
+# Converts a date (a datetime object, an epoch in seconds or a string) into a naive datetime (in UTC), to compare it with the limits of the periods
+def _todatetime(t):
+    if t is None:
+        return None
+    return fromepoch(_tots(t) / 1e6)
+
+# Splits the name of the database into the parts used to build the names of the shards (e.g. /var/lib/osidled/osidled.db is split into
+#   /var/lib/osidled/osidled- and .db)
+def _shardnameparts(filename):
+    (root, ext) = os.path.splitext(filename)
+    return ("{}-".format(root), ext)
+
+# Finds the shards of a database that exist in the filesystem
+# @param period the period of the shards to find; if None, the period is guessed from the names of the files
+# @return a tuple (period, { key: filename }); period is None if there is no shard
+def findshards(filename, period = None):
+    (prefix, ext) = _shardnameparts(filename)
+    periods = [ period ] if period is not None else list(SHARD_PERIODS.keys())
+    shards = {}
+    for f in sorted(glob.glob("{}*{}".format(glob.escape(prefix), glob.escape(ext)))):
+        key = f[len(prefix):len(f) - len(ext)]
+        for p in periods:
+            try:
+                if _periodkey(datetime.strptime(key, SHARD_PERIODS[p]), p) != key:
+                    continue
+            except ValueError:
+                continue
+            if period is None:
+                period = p
+                periods = [ p ]
+            shards[key] = f
+            break
+    return (period, shards)
+
+# A storage whose samples are split in one database file per period (see SHARD_PERIODS). Each shard is a regular Storage (i.e. it has its
+#   own schema version and zstd dictionaries), the reads only open the shards that overlap the requested dates and discarding the data of
+#   a whole period (see delete) just removes the file.
+#   * if the unsharded database file also exists (e.g. the data stored before enabling the sharding), it is read as a shard that covers
+#     any date, but the new samples are always stored in the shards
+#   * each shard has its own connection instead of attaching the files to a single one: sqlite3 attaches at most 10 databases by default
+#     (fewer than the daily shards of a month), a transaction over several files in WAL mode is not atomic anyway, and the queries of Storage
+#     (and its migrations) would need the name of the schema of each table
+class ShardedStorage:
+    def __init__(self, filename = None, period = "monthly", synchronous = "NORMAL", busy_timeout = DEFAULT_BUSY_TIMEOUT, codec = "none", readonly = False,
+                    dedup = False, chunks = False):
+        if filename is None:
+            filename = DEFAULT_FILENAME
+        if period not in SHARD_PERIODS:
+            p_warning("invalid sharding period {}; using monthly".format(period))
+            period = "monthly"
+        self._filename = filename
+        self._period = period
+        self._options = { "synchronous": synchronous, "busy_timeout": busy_timeout, "codec": codec, "readonly": readonly, "dedup": dedup, "chunks": chunks }
+        self._upgrade = False
+        self._connected = False
+        # The Storage objects of the shards that have been opened, by key (the key of the unsharded file is None)
+        self._shards = {}
+        self._filenames = {}
+        # The key of the shard in which the samples are being stored
+        self._current = None
+
+    def connect(self, upgrade = False):
+        self._upgrade = upgrade
+        self._connected = True
+        (_, self._filenames) = findshards(self._filename, self._period)
+        if os.path.exists(self._filename):
+            self._filenames[None] = self._filename
+
+    def isConnected(self):
+        return self._connected
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
+        self._shards = {}
+
+    def getfilenames(self):
+        return [ self._filenames[key] for key in self._keys() ]
+
+    # Makes a consistent copy of each shard in a folder (see Storage.snapshot); the names of the files are kept, so that the copy is
+    #   detected as a sharded storage
+    # @return the filename of the copy of the sharded storage
+    def snapshot(self, folder):
+        if not self.isConnected():
+            return None
+
+        for key in self._keys():
+            self._shard(key).snapshot(folder)
+        return os.path.join(folder, os.path.basename(self._filename))
+
+    # The keys of the existing shards, in chronological order (the unsharded file goes first, because it contains the oldest data)
+    # @param fromDate, toDate if any of them is not None, only the keys of the shards that overlap the dates are returned
+    def _keys(self, fromDate = None, toDate = None):
+        fromDate = _todatetime(fromDate)
+        toDate = _todatetime(toDate)
+
+        keys = [ None ] if None in self._filenames else []
+        for key in sorted(k for k in self._filenames.keys() if k is not None):
+            (begin, end) = _periodlimits(key, self._period)
+            if (fromDate is not None) and (end <= fromDate):
+                continue
+            if (toDate is not None) and (begin > toDate):
+                continue
+            keys.append(key)
+        return keys
+
+    # Obtains the Storage object of a shard, connecting to it if needed (the shard is created if it does not exist)
+    def _shard(self, key):
+        if key not in self._shards:
+            if key not in self._filenames:
+                (prefix, ext) = _shardnameparts(self._filename)
+                self._filenames[key] = "{}{}{}".format(prefix, key, ext)
+                p_debug("creating shard {}".format(self._filenames[key]))
+            shard = Storage(self._filenames[key], **self._options)
+            shard.connect(self._upgrade)
+            if not shard.isConnected():
+                raise Exception("could not connect to shard {}".format(self._filenames[key]))
+            # The incremental samples of the first samples of a VM in a shard are calculated from the last samples in the previous shard
+            if key is not None:
+                shard.lastcounters_fnc = lambda vmid, ts, key = key: self._previouslastcounters(key, vmid, ts)
+            self._shards[key] = shard
+        return self._shards[key]
+
+    # Obtains the counters of the last sample of a VM in the shard previous to a shard (see Storage.getlastcounters); older shards are not
+    #   considered, because the VM has not been monitored for a whole period
+    def _previouslastcounters(self, key, vmid, ts):
+        previous = [ k for k in self._keys() if (k is None) or (k < key) ]
+        if len(previous) == 0:
+            return None
+        return self._shard(previous[-1]).getlastcounters(vmid, ts, False)
+
+    def _removeshard(self, key):
+        if key in self._shards:
+            self._shards[key].close()
+            del self._shards[key]
+        filename = self._filenames.pop(key)
+        for f in [ filename, "{}-wal".format(filename), "{}-shm".format(filename) ]:
+            if os.path.exists(f):
+                os.remove(f)
+
+    # The schema version of the sharded storage is the version of the oldest shard
+    def getschemaversion(self):
+        if not self.isConnected():
+            return None
+
+        versions = [ self._shard(key).getschemaversion() for key in self._keys() ]
+        if len(versions) == 0:
+            return SCHEMA_VERSION
+        return min(versions)
+
+    def migrate(self, batchsize = MIGRATION_BATCH_SIZE, progress_fnc = None):
+        if not self.isConnected():
+            return None
+
+        # The progress is accumulated for the whole set of shards
+        offsets = {}
+        def progress(version, done, total):
+            offset = offsets.get(version, 0)
+            progress_fnc(version, offset + done, offset + total)
+            if done >= total:
+                offsets[version] = offset + total
+
+        versions = [ self._shard(key).migrate(batchsize, progress if callable(progress_fnc) else None) for key in self._keys() ]
+        if len(versions) == 0:
+            return SCHEMA_VERSION
+        return min(versions)
+
+    def cluster(self, batchsize = MIGRATION_BATCH_SIZE, progress_fnc = None):
+        if not self.isConnected():
+            return None
+
+        # The progress is accumulated for the whole set of shards, as in migrate
+        offset = [ 0 ]
+        def progress(done, total):
+            progress_fnc(offset[0] + done, offset[0] + total)
+            if done >= total:
+                offset[0] += total
+
+        return sum(self._shard(key).cluster(batchsize, progress if callable(progress_fnc) else None) or 0 for key in self._keys())
+
+    def getmint(self):
+        values = [ t for t in [ self._shard(key).getmint() for key in self._keys() ] if t is not None ]
+        return min(values) if len(values) > 0 else None
+
+    def getmaxt(self):
+        values = [ t for t in [ self._shard(key).getmaxt() for key in self._keys() ] if t is not None ]
+        return max(values) if len(values) > 0 else None
+
+    def getcount(self):
+        return sum(self._shard(key).getcount() for key in self._keys())
+
+    def savevm(self, vmid, info, t = None):
+        return self.savevms([ (vmid, info, t) ])
+
+    # Stores the samples in the shards that correspond to their timestamps
+    def savevms(self, batch):
+        if not self.isConnected():
+            return False
+
+        shards = {}
+        for (vmid, info, t) in batch:
+            # The current time is obtained here (instead of in the shard) because it is needed to select the shard
+            if t is None:
+                t = datetime.utcnow()
+            try:
+                key = _periodkey(_todatetime(t), self._period)
+            except Exception:
+                # The shard will report the invalid timestamp
+                key = _periodkey(datetime.utcnow(), self._period)
+            shards.setdefault(key, []).append((vmid, info, t))
+
+        valid = True
+        for key in sorted(shards.keys()):
+            valid = self._shard(key).savevms(shards[key]) and valid
+
+        # The shard of the previous period is not needed anymore by the monitor, so it is closed (e.g. to allow removing it), but the last
+        #   counters of the VMs are kept to calculate the incremental samples in the new shard; its open chunks will not receive more samples,
+        #   so they are packed before
+        key = max(shards.keys()) if len(shards) > 0 else self._current
+        if (self._current is not None) and (key != self._current) and (self._current in self._shards):
+            if key in self._shards:
+                self._shards[key].seedlastcounters(self._shards[self._current].getcachedcounters())
+            self._shards[self._current].packchunks()
+            self._shards[self._current].close()
+            del self._shards[self._current]
+        self._current = key
+        return valid
+
+    def getvmdata(self, vmid, fromDate = None, toDate = None, numeric = False):
+        if not self.isConnected():
+            return []
+
+        result = []
+        for key in self._keys(fromDate, toDate):
+            result.extend(self._shard(key).getvmdata(vmid, fromDate, toDate, numeric))
+        return result
+
+    # Iterates over the samples of the VMs in the shards that overlap the dates; each shard yields its VMs in order, so the VMs of all
+    #   the shards are merged and the samples of the same VM are joined in chronological order
+    def iter_window(self, fromDate = None, toDate = None, vmids = None, numeric = False):
+        if not self.isConnected():
+            return
+
+        # The VMs are sorted, so that the batches of VMs in each shard yield the VMs in order
+        if vmids is not None:
+            vmids = sorted(set(vmids))
+
+        yield from self._merge([ self._shard(key).iter_window(fromDate, toDate, vmids, numeric) for key in self._keys(fromDate, toDate) ])
+
+    def iter_deltas(self, fromDate = None, toDate = None, vmids = None):
+        if not self.isConnected():
+            return
+
+        if vmids is not None:
+            vmids = sorted(set(vmids))
+
+        yield from self._merge([ self._shard(key).iter_deltas(fromDate, toDate, vmids) for key in self._keys(fromDate, toDate) ])
+
+    def iter_rollups(self, fromDate = None, toDate = None, vmids = None, resolution = "hour"):
+        if not self.isConnected():
+            return
+
+        if vmids is not None:
+            vmids = sorted(set(vmids))
+
+        yield from self._merge([ self._shard(key).iter_rollups(fromDate, toDate, vmids, resolution) for key in self._keys(fromDate, toDate) ])
+
+    # Merges the tuples (vmid, samples) yielded by the shards (each one ordered by vmid), joining the samples of the same VM
+    def _merge(self, iterators):
+        vmid = None
+        samples = []
+        for (_vmid, _samples) in heapq.merge(*iterators, key = lambda x: x[0]):
+            if _vmid != vmid:
+                if len(samples) > 0:
+                    yield (vmid, samples)
+                vmid = _vmid
+                samples = []
+            samples.extend(_samples)
+
+        if len(samples) > 0:
+            yield (vmid, samples)
+
+    # The incremental samples and the rollups are calculated in each shard, in chronological order; the incremental samples of the first
+    #   samples of a VM in a shard are calculated from its last samples in the previous shard (see _shard), as when they are stored
+    def rebuildderived(self, progress_fnc = None):
+        if not self.isConnected():
+            return False
+
+        keys = self._keys()
+        for i, key in enumerate(keys):
+            self._shard(key).rebuildderived((lambda done, total, i = i: progress_fnc(i * total + done, len(keys) * total)) if callable(progress_fnc) else None)
+        return True
+
+    def getvms(self, fromDate = None, toDate = None):
+        if not self.isConnected():
+            return []
+
+        vms = set()
+        for key in self._keys(fromDate, toDate):
+            vms.update(self._shard(key).getvms(fromDate, toDate))
+        return sorted(vms)
+
+    # Joins the catalogs of VMs of the shards that overlap the dates (see Storage.getcatalog)
+    def getcatalog(self, fromDate = None, toDate = None):
+        if not self.isConnected():
+            return []
+
+        catalog = {}
+        for key in self._keys(fromDate, toDate):
+            for entry in self._shard(key).getcatalog(fromDate, toDate):
+                if entry["vmid"] not in catalog:
+                    catalog[entry["vmid"]] = entry
+                    continue
+                current = catalog[entry["vmid"]]
+                if entry["last"] >= current["last"]:
+                    current["state"] = entry["state"]
+                if (entry["counters"] is not None) and ((current["counters"] is None) or (entry["counters"]["ts"] >= current["counters"]["ts"])):
+                    current["counters"] = entry["counters"]
+                current["first"] = min(current["first"], entry["first"])
+                current["last"] = max(current["last"], entry["last"])
+                current["samples"] += entry["samples"]
+                current["bytes"] += entry["bytes"]
+        return [ catalog[vmid] for vmid in sorted(catalog.keys()) ]
+
+    # Discards the samples out of the range of dates; the shards that are completely out of the range are removed, and only the samples
+    #   in the shards that are partially in the range are deleted
+    def delete(self, keepFromDate, keepToDate):
+        if not self.isConnected():
+            return False
+
+        if (keepFromDate is None) and (keepToDate is None):
+            raise Exception("refusing to wipe the whole database")
+
+        kept = self._keys(keepFromDate, keepToDate)
+        rows = 0
+        for key in self._keys():
+            if key not in kept:
+                rows += self._shard(key).getcount()
+                p_info("removing shard {}".format(self._filenames[key]))
+                self._removeshard(key)
+                continue
+
+            if key is not None:
+                (begin, end) = _periodlimits(key, self._period)
+                # The shard is completely in the range, so there is nothing to delete
+                if ((keepFromDate is None) or (_todatetime(keepFromDate) <= begin)) and ((keepToDate is None) or (_todatetime(keepToDate) >= end)):
+                    continue
+            rows += self._shard(key).delete(keepFromDate, keepToDate)
+        return rows
+
+    def vaccuum(self):
+        if not self.isConnected():
+            return False
+
+        for key in self._keys():
+            self._shard(key).vaccuum()
+        return True
+
+    # Deletes a batch of the samples older than a date (see Storage.expire); the shards that are completely older than the date are just
+    #   removed (except the one in which the samples are being stored)
+    def expire(self, keepFromDate, batchsize = MAINTENANCE_BATCH_SIZE):
+        if not self.isConnected():
+            return 0
+
+        keepFromDate = _todatetime(keepFromDate)
+        for key in self._keys():
+            if key is not None:
+                (begin, end) = _periodlimits(key, self._period)
+                if begin >= keepFromDate:
+                    break
+                if (end <= keepFromDate) and (key != self._current):
+                    rows = self._shard(key).getcount()
+                    p_info("removing shard {}".format(self._filenames[key]))
+                    self._removeshard(key)
+                    return max(rows, 1)
+            rows = self._shard(key).expire(keepFromDate, batchsize)
+            if rows > 0:
+                return rows
+        return 0
+
+    # The maintenance of the files (see Storage.incrementalvacuum, checkpoint and analyze) is made in the shards that are open (i.e. the ones
+    #   that are being used)
+    def incrementalvacuum(self, pages = MAINTENANCE_VACUUM_PAGES):
+        return sum(shard.incrementalvacuum(pages) for shard in list(self._shards.values()))
+
+    def checkpoint(self):
+        return all([ shard.checkpoint() for shard in list(self._shards.values()) ])
+
+    def analyze(self):
+        return all([ shard.analyze() for shard in list(self._shards.values()) ])
+
+    def filterdata(self, filter_fnc, pre_fnc = None, post_fnc = None):
+        if not self.isConnected():
+            return False
+
+        if (callable(pre_fnc)):
+            pre_fnc(self.getcount())
+
+        # Each shard calculates its incremental samples and rollups again (see Storage.filterdata), in chronological order, so that the first
+        #   samples of each shard follow the ones already filtered in the previous shard
+        for key in self._keys():
+            self._shard(key).filterdata(filter_fnc)
+
+        if (callable(post_fnc)):
+            post_fnc()
+
+        return True
+
+    def filterdata_to(self, filter_fnc, pre_fnc = None, post_fnc = None, other_storage = None):
+        if (other_storage is None) or (not other_storage.isConnected()):
+            return False
+
+        if not self.isConnected():
+            return False
+
+        if (callable(pre_fnc)):
+            pre_fnc(self.getcount())
+
+        for key in self._keys():
+            self._shard(key).filterdata_to(filter_fnc, None, None, other_storage)
+
+        if (callable(post_fnc)):
+            post_fnc()
+
+        return True
+
+    # Trains a zstd dictionary for each shard (the dictionaries are stored in each shard, as each one is self-contained)
+    # @return the id of the dictionary of the newest shard
+    def traindictionary(self, *args, **kwargs):
+        if not self.isConnected():
+            return None
+
+        dictid = None
+        for key in self._keys():
+            dictid = self._shard(key).traindictionary(*args, **kwargs)
+        return dictid
+
+    def recompress(self, codec, batchsize = MIGRATION_BATCH_SIZE, progress_fnc = None):
+        if not self.isConnected():
+            return False
+
+        # The new shards will also use the codec
+        self._options["codec"] = codec
+
+        total = self.getcount()
+        offset = 0
+        for key in self._keys():
+            shard = self._shard(key)
+            count = shard.getcount()
+            shard.recompress(codec, batchsize, (lambda done, _, offset = offset: progress_fnc(offset + done, total)) if callable(progress_fnc) else None)
+            offset += count
+        return True
+
+# Creates the storage for a database, either a single file, a sharded one or a binary one; the storages share the same interface (the one of
+#   Storage), so the monitor, the writer, the maintenance and the analysis do not depend on the engine
+# @param sharding the sharding mode (one of SHARDING_MODES); if None, the mode is detected from the files that exist (i.e. if there are
+#   shards of the database, it is sharded)
+# @param engine the engine of the database (one of ENGINES); if None, it is detected from the filename (i.e. a folder is a binary storage)
+def newStorage(filename = None, sharding = None, engine = None, **kwargs):
+    if filename is None:
+        filename = DEFAULT_FILENAME
+
+    if engine is None:
+        engine = "binary" if os.path.isdir(filename) else "sqlite"
+
+    if engine == "binary":
+        if sharding not in [ None, "none" ]:
+            p_warning("the binary engine keeps a file per VM, so it is not sharded; ignoring sharding mode {}".format(sharding))
+        return BinaryStorage(filename, **kwargs)
+
+    if engine != "sqlite":
+        p_error("invalid engine {}; using sqlite".format(engine))
+
+    if sharding is None:
+        (sharding, _) = findshards(filename)
+        if sharding is None:
+            sharding = "none"
+
+    if sharding == "none":
+        return Storage(filename, **kwargs)
+
+    if sharding not in SHARD_PERIODS:
+        p_error("invalid sharding mode {}; using a single database file".format(sharding))
+        return Storage(filename, **kwargs)
+
+    return ShardedStorage(filename, sharding, **kwargs)
\ No newline at end of file
@@ -13,39 +13,525 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 #
+import os
+import sys
+import heapq
 import sqlite3
-import json
-from .common import p_error, p_warning, p_debugv, p_debug, p_info
+from array import array
+from urllib.request import pathname2url
+from .common import p_error, p_warning, p_debugv, p_debug, p_info, toepoch, fromepoch
+from .payload import PayloadCodec, train_dictionary, DICTIONARY_SIZE
+from .rawdata import incremental, RawData, Sample, _repeatedsamples
 from datetime import datetime, timedelta
 
 DEFAULT_FILENAME = "monitoring.sqlite3"
 
+# The version of the schema of the database; it is stored in the "user_version" pragma of the sqlite3 file. Version 1 is the original
+#   layout (no indexes) and each version from then on has an entry in Storage._MIGRATIONS
+SCHEMA_VERSION = 14
+
+# The amount of rows that are moved in each step of a migration (each step is committed, so that the monitor can keep on writing)
+MIGRATION_BATCH_SIZE = 10000
+
+# The values accepted for the "synchronous" pragma of sqlite3; in WAL mode, NORMAL only syncs at checkpoints and is safe against corruption
+SYNCHRONOUS_LEVELS = [ "OFF", "NORMAL", "FULL", "EXTRA" ]
+
+# The amount of milliseconds that a connection waits for a lock held by another process (e.g. osidle-dbpack) before failing
+DEFAULT_BUSY_TIMEOUT = 5000
+
+# The size of the memory map and the page cache of the read-only connections (e.g. the analysis), so that the pages read in a run stay in
+#   the page cache of the OS and the next runs do not need to read them from the disk again; the cache size is in KiB (negative value)
+READONLY_MMAP_SIZE = 1024 * 1024 * 1024
+READONLY_CACHE_SIZE = -256 * 1024
+
+# The amount of expired samples deleted in each step of the maintenance (see expire), the amount of free pages returned to the filesystem in
+#   each step (see incrementalvacuum) and the amount of rows examined in each index by analyze
+MAINTENANCE_BATCH_SIZE = 1000
+MAINTENANCE_VACUUM_PAGES = 256
+ANALYSIS_LIMIT = 1000
+
+# Whether the counters of the databases that have not been migrated to version 3 are extracted from the payloads by sqlite3 (using the
+#   JSON1 extension, see _JSON_COUNTERS) instead of decoding the payloads in python; it is disabled because it is slower, even using the JSON
+#   functions of sqlite 3.45 (that were rewritten over the binary JSONB format), see benchmarks/bench_json1.py
+JSON1_PUSHDOWN = False
+
+# The maximum amount of VM ids included in each "in (...)" clause (sqlite3 limits the amount of parameters in a query)
+IN_BATCH_SIZE = 500
+
+# The columns that store the counters of the samples (they are extracted from the data when the sample is stored, so that the analysis
+#   does not need to decode the data); the counters are NULL for the samples without valid information (e.g. conflictingRequest)
+COUNTER_COLUMNS = [ "tcpu_ns", "tdisk", "tnic", "ncpu", "ndisk", "nnic", "uptime" ]
+
+# The resolutions (in seconds) of the rollups, i.e. the consumption of the VMs aggregated per hour and per day
+ROLLUP_RESOLUTIONS = { "hour": 3600, "day": 86400 }
+
+# The period (in seconds) of the chunks, i.e. the samples of each VM in each period are packed in a single row (see Storage chunks)
+CHUNK_PERIOD = 3600
+
+# The format of the timestamps in column t (the human readable version of column ts, that is only filled in the databases created before
+#   version 3 of the schema; the samples are identified by ts, so t is only built for the output, see RawData.dumpdata)
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
 def _sql(cursor, query, params = ()):
     p_debugv("{}: {}".format(query,params))
     result = cursor.execute(query, params)
     return result
 
+# Converts the string of a timestamp (in UTC) into the amount of microseconds since the epoch
+def _strtots(t):
+    return round(toepoch(datetime.strptime(t, TIME_FORMAT)) * 1e6)
+
+# Converts a timestamp (either a datetime object, a number of seconds since the epoch or a string) into the amount of microseconds since
+#   the epoch (i.e. the value stored in column ts); returns None if it is not a valid timestamp
+def _tots(t):
+    if isinstance(t, int) or isinstance(t, float):
+        return round(t * 1e6)
+    if isinstance(t, datetime):
+        return round(toepoch(t) * 1e6)
+    if isinstance(t, str):
+        return _strtots(t)
+    return None
+
+# Converts a timestamp (either a datetime object, a number of seconds since the epoch or a string) into the string of column t (i.e. for
+#   the databases without column ts); returns None if it is not a valid timestamp
+def _tostr(t):
+    if isinstance(t, int) or isinstance(t, float):
+        return fromepoch(t).strftime(TIME_FORMAT)
+    if isinstance(t, datetime):
+        return t.strftime(TIME_FORMAT)
+    if isinstance(t, str):
+        return t
+    return None
+
+# Builds the condition (and the parameters) to filter the samples between two dates (any of them may be None); the dates may be
+#   datetime objects or epochs (seconds)
+# @param legacy if True, the samples are filtered using column t (i.e. the databases without column ts, see Storage._counters)
+def _timerange(fromDate = None, toDate = None, legacy = False):
+    (column, convert_fnc) = ("t", _tostr) if legacy else ("ts", _tots)
+    conditions = []
+    params = []
+    if fromDate is not None:
+        conditions.append("{} >= ?".format(column))
+        params.append(convert_fnc(fromDate))
+    if toDate is not None:
+        conditions.append("{} <= ?".format(column))
+        params.append(convert_fnc(toDate))
+    return (" and ".join(conditions), tuple(params))
+
+# Extracts the counters of a sample (in the same order than COUNTER_COLUMNS); returns None if the sample has no valid information
+def _counters(info):
+    if ("conflictingRequest" in info) or ("itemNotFound" in info):
+        return None
+    if ("cpu_details" not in info) or ("disk_details" not in info) or ("nic_details" not in info):
+        return None
+    try:
+        return (
+            sum(x["time"] for x in info["cpu_details"]),
+            sum(x.get("read_bytes", 0) + x.get("write_bytes", 0) for x in info["disk_details"]),
+            sum(x.get("rx_octets", 0) + x.get("tx_octets", 0) for x in info["nic_details"]),
+            len(info["cpu_details"]),
+            len(info["disk_details"]),
+            len(info["nic_details"]),
+            info.get("uptime", 0)
+        )
+    except (KeyError, TypeError):
+        return None
+
+# Obtains the values of the columns of a row to be inserted in the vmmonitor table, in the order (vmid, ts, data, *COUNTER_COLUMNS)
+# @param codec the PayloadCodec used to encode the data
+# @param ts the epoch of the sample (in microseconds)
+def _rowvalues(vmid, ts, info, codec):
+    counters = _counters(info)
+    if counters is None:
+        counters = (None, ) * len(COUNTER_COLUMNS)
+    return (vmid, ts, codec.encode(info), *counters)
+
+# The values of a sample that must be the same than the ones of the previous row of the VM to extend that row instead of storing a new one
+#   (see Storage dedup): the state and the counters, except the uptime (that increases even if the VM is idle)
+# @param row the values of the row, as obtained from _rowvalues
+def _repeatkey(row, state):
+    return (state, *row[3:2 + len(COUNTER_COLUMNS)])
+
+# Converts a row of the database with the counters into a "numeric" sample (i.e. the counters and the epoch in seconds, without the data)
+# @param tsend the epoch of the last sample merged into the row (None if the row is a single sample); it is included as "send"
+def _rowtonumeric(ts, tsend, *counters):
+    data = dict(zip(COUNTER_COLUMNS, counters))
+    data["s"] = ts / 1e6
+    if tsend is not None:
+        data["send"] = tsend / 1e6
+    return data
+
+# Converts a row of the samples (see Storage._samplecolumns) into a "numeric" sample; a series of repeated samples also has the amount of samples
+#   merged into the row (i.e. the ones after the first one) as "repeats", so that RawData analyzes them as that amount of samples
+def _sampletonumeric(ts, tsend, repeats, *counters):
+    data = _rowtonumeric(ts, tsend, *counters)
+    if tsend is not None:
+        data["repeats"] = repeats
+    return data
+
+# The condition and the expressions that extract the counters of a sample from its payload (in the same order than COUNTER_COLUMNS) using the
+#   JSON1 extension of sqlite3, i.e. the same values than _counters but without decoding the payload in python; the samples that do not
+#   match the condition have no valid information (the compressed payloads are blobs, so they are not considered valid either)
+_JSON_VALID = " and ".join([ "typeof(data) = 'text'", "json_valid(data)", "json_type(data, '$.conflictingRequest') is null", "json_type(data, '$.itemNotFound') is null",
+    *[ "json_type(data, '$.{}') = 'array'".format(x) for x in [ "cpu_details", "disk_details", "nic_details" ] ] ])
+_JSON_COUNTERS = [
+    "(select sum(json_extract(value, '$.time')) from json_each(data, '$.cpu_details'))",
+    "(select coalesce(sum(json_extract(value, '$.read_bytes')), 0) + coalesce(sum(json_extract(value, '$.write_bytes')), 0) from json_each(data, '$.disk_details'))",
+    "(select coalesce(sum(json_extract(value, '$.rx_octets')), 0) + coalesce(sum(json_extract(value, '$.tx_octets')), 0) from json_each(data, '$.nic_details'))",
+    "json_array_length(data, '$.cpu_details')",
+    "json_array_length(data, '$.disk_details')",
+    "json_array_length(data, '$.nic_details')",
+    "coalesce(json_extract(data, '$.uptime'), 0)",
+]
+
+# The columns to retrieve the counters of the samples using the JSON1 extension (the counters are NULL if the sample has no valid information)
+def _jsoncolumns(valid = True):
+    if valid:
+        return ", ".join([ "{} as {}".format(expression, column) for (expression, column) in zip(_JSON_COUNTERS, COUNTER_COLUMNS) ])
+    return ", ".join([ "case when {} then {} end as {}".format(_JSON_VALID, expression, column) for (expression, column) in zip(_JSON_COUNTERS, COUNTER_COLUMNS) ])
+
+# The size of each sample in a chunk (the epoch and the counters, as int64 values)
+_CHUNK_SAMPLE_BYTES = 8 * (1 + len(COUNTER_COLUMNS))
+
+# The columns of table vmchunk that hold the packed samples (in the same order than the rows of the samples, see _chunkrows)
+_CHUNK_COLUMNS = ", ".join([ "ts", *COUNTER_COLUMNS ])
+
+# Packs a list of integers into a blob of little-endian int64 values
+def _pack(values):
+    values = array("q", values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+# Unpacks a blob of little-endian int64 values; in little-endian hosts, the values are read from the blob itself (i.e. without copying it)
+def _unpack(blob):
+    if sys.byteorder == "little":
+        return memoryview(blob).cast("q")
+    values = array("q", blob)
+    values.byteswap()
+    return values
+
+# Converts the blobs of a chunk (the epochs and the counters, see _CHUNK_COLUMNS) into rows (ts, tsend, *counters), i.e. the same values
+#   than the rows of the samples with counters (see _columns)
+# @param fromts, tots if not None, only the samples between these epochs (in microseconds) are returned
+def _chunkrows(blobs, fromts = None, tots = None):
+    return [ (ts, None, *counters) for (ts, *counters) in zip(*[ _unpack(blob) for blob in blobs ])
+                if ((fromts is None) or (ts >= fromts)) and ((tots is None) or (ts <= tots)) ]
+
+# Obtains the values of the columns first_ts, last_ts, samples and _CHUNK_COLUMNS of a chunk from its rows (ordered by ts)
+def _chunkvalues(rows):
+    columns = zip(*[ (ts, *counters) for (ts, _, *counters) in rows ])
+    return (rows[0][0], rows[-1][0], len(rows), *[ _pack(int(x) for x in column) for column in columns ])
+
+# Converts a row of a chunk into a sample, in the same format than the samples stored in vmmonitor; the samples in the chunks have no data,
+#   so they only have the counters (as the "numeric" samples)
+def _chunktosample(row, numeric):
+    return _rowtonumeric(*row)
+
+# Builds a minimal payload whose counters (see _counters) are the ones of a sample packed in a chunk (e.g. to store it in other database)
+def _countersinfo(ts, tsend, tcpu_ns, tdisk, tnic, ncpu, ndisk, nnic, uptime):
+    return {
+        "cpu_details": [ { "time": tcpu_ns if i == 0 else 0 } for i in range(ncpu) ],
+        "disk_details": [ { "read_bytes": tdisk if i == 0 else 0, "write_bytes": 0 } for i in range(ndisk) ],
+        "nic_details": [ { "rx_octets": tnic if i == 0 else 0, "tx_octets": 0 } for i in range(nnic) ],
+        "num_cpus": ncpu,
+        "num_disks": ndisk,
+        "num_nics": nnic,
+        "uptime": uptime,
+    }
+
+# Merges several generators of tuples (vmid, samples) ordered by vmid (e.g. the samples stored in vmmonitor and the ones stored in chunks),
+#   sorting the samples of each VM by their epoch
+def _mergevms(iterators):
+    vmid = None
+    samples = []
+    for (_vmid, _samples) in heapq.merge(*iterators, key = lambda x: x[0]):
+        if _vmid != vmid:
+            if len(samples) > 0:
+                yield (vmid, sorted(samples, key = lambda x: x["s"]))
+            vmid = _vmid
+            samples = []
+        samples.extend(_samples)
+
+    if len(samples) > 0:
+        yield (vmid, sorted(samples, key = lambda x: x["s"]))
+
+# The layout of table vmmonitor from version 11 of the schema (see Storage._migrate_v11 and Storage.cluster), and the indexes and the view
+#   that are created once the table is renamed to vmmonitor
+_CREATE_VMMONITOR = "create table {{}} (\
+        id integer PRIMARY KEY AUTOINCREMENT, \
+        t datetime DEFAULT (STRFTIME('%Y-%m-%dT%H:%M:%fZ', 'NOW')), \
+        vm integer NOT NULL REFERENCES vms (id), \
+        ts integer, \
+        tsend integer, \
+        repeats integer NOT NULL DEFAULT 0, \
+        {}, \
+        data text\
+    )".format(", ".join([ "{} integer".format(c) for c in COUNTER_COLUMNS ]))
+_VMMONITOR_INDEXES = [
+    "create index vmmonitor_vm_ts on vmmonitor (vm, ts)",
+    "create index vmmonitor_ts on vmmonitor (ts)",
+    "create view vmsamples as select vmmonitor.*, vms.uuid as vmid from vmmonitor join vms on vms.id = vmmonitor.vm",
+]
+
+# The statement to insert a row in the vmmonitor table, using the values obtained with _rowvalues; the column of the VM is either vmid (the
+#   uuid) or vm (the id of the VM in the dictionary of VMs, see Storage._getvmkeys; column t is NULL, as the samples are identified by ts)
+_INSERT_ROW = "insert into vmmonitor ({{}}, t, ts, data, {}) values (?, null, ?, ?, {})".format(", ".join(COUNTER_COLUMNS), ", ".join([ "?" ] * len(COUNTER_COLUMNS)))
+
+# The columns to retrieve, depending on whether the samples are "numeric" or not; the samples that are not numeric also have the amount of
+#   repeated samples merged into the row
+# @param repeats whether the database has the columns of the repeated samples (otherwise tsend is retrieved as NULL)
+def _columns(numeric = False, repeats = False):
+    tsend = "tsend" if repeats else "null"
+    if numeric:
+        return "ts, {}, {}".format(tsend, ", ".join(COUNTER_COLUMNS))
+    return "ts, {}, {}, data".format(tsend, "repeats" if repeats else "0")
+
+# Converts a row of the database into the sample that is returned to the caller
+def _rowtodata(ts, tsend, repeats, data, codec):
+    data = codec.decode(data)
+    data["s"] = ts / 1e6
+    if tsend is not None:
+        data["send"] = tsend / 1e6
+        data["repeats"] = repeats
+    return data
+
+# Converts the counters of a row of the vmmonitor table (i.e. ts and COUNTER_COLUMNS) into a sample that can be used to calculate the
+#   incremental samples (see rawdata.incremental); the counters keep the units of the database (i.e. tcpu is in nanoseconds)
+def _countersample(ts, tcpu_ns, tdisk, tnic, ncpu, ndisk, nnic, uptime):
+    return {
+        "ts": ts,
+        "s": ts / 1e6,
+        "tcpu": tcpu_ns,
+        "tdisk": tdisk,
+        "tnic": tnic,
+        "ncpu": ncpu,
+        "ndisk": ndisk,
+        "nnic": nnic,
+        "uptime": uptime,
+    }
+
+# Splits the consumption of an incremental sample into the buckets of each resolution of the rollups, proportionally to the time of the
+#   interval that falls into each bucket
+# @param ts0, ts1 the epochs (in microseconds) of the previous and the current samples
+# @param delta the incremental sample, as obtained from rawdata.incremental
+# @param counted whether the current sample is counted in the samples of the bucket (the repeated samples are not, see Storage dedup)
+# @return a list of tuples (resolution, bucket, e, tcpu_ns, tdisk, tnic, samples, ncpu, ndisk, nnic, begin), where begin is the epoch in which
+#   the interval starts within the bucket
+def _rollupbuckets(ts0, ts1, delta, counted = True):
+    if ts1 <= ts0:
+        return []
+
+    deltas = (delta["tcpu"], delta["tdisk"], delta["tnic"])
+    result = []
+    for resolution in ROLLUP_RESOLUTIONS.values():
+        size = resolution * 1000000
+        bucket = ts0 - ts0 % size
+        while bucket < ts1:
+            begin = max(bucket, ts0)
+            end = min(bucket + size, ts1)
+            fraction = (end - begin) / (ts1 - ts0)
+            # The sample is counted in the bucket in which it was taken
+            result.append((resolution, bucket, (end - begin) / 1e6, *[ d * fraction for d in deltas ], 1 if counted and end == ts1 else 0, delta["ncpu"], delta["ndisk"], delta["nnic"], begin))
+            bucket += size
+    return result
+
+# The statement to add the consumption of a VM to a bucket of the rollups (the values are the vmid and the values from _rollupbuckets)
+_UPSERT_ROLLUP = "insert into vmrollup (vmid, resolution, bucket, e, tcpu_ns, tdisk, tnic, samples, ncpu, ndisk, nnic, tsbegin) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) \
+    on conflict (vmid, resolution, bucket) do update set e = e + excluded.e, tcpu_ns = tcpu_ns + excluded.tcpu_ns, tdisk = tdisk + excluded.tdisk, \
+    tnic = tnic + excluded.tnic, samples = samples + excluded.samples, ncpu = max(ncpu, excluded.ncpu), ndisk = max(ndisk, excluded.ndisk), \
+    nnic = max(nnic, excluded.nnic), tsbegin = min(tsbegin, excluded.tsbegin)"
+
+# Aggregates the values of two deltas of the same bucket (as obtained from _rollupbuckets, without the resolution and the bucket)
+def _addrollup(a, b):
+    return [ *[ x + y for (x, y) in zip(a[:5], b[:5]) ], *[ max(x, y) for (x, y) in zip(a[5:8], b[5:8]) ], min(a[8], b[8]) ]
+
+# Converts a row of the rollups into an "incremental" sample, i.e. the consumption of the VM in the bucket, in the same format than the
+#   samples obtained by RawData._convert (the sample starts when the first interval of the bucket starts)
+def _rolluptosample(tsbegin, e, tcpu_ns, tdisk, tnic, ncpu, ndisk, nnic):
+    return Sample(tsbegin / 1e6 + e, ncpu, ndisk, nnic, tcpu_ns * 1e-9, tdisk, tnic, e, tsbegin / 1e6)
+
+# The statement to store an incremental sample of a VM (the values are obtained with _deltavalues)
+_INSERT_DELTA = "insert or replace into vmdelta (vmid, ts, tsbegin, e, tcpu_ns, tdisk, tnic, ncpu, ndisk, nnic) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+# The statement to set the amount of repeated samples that an incremental sample of a VM stands for (see Storage dedup)
+_SET_REPEATED_DELTA = "update vmdelta set repeated = ? where vmid = ? and ts = ?"
+
+# Obtains the values to store an incremental sample of a VM (the sample ends at the epoch ts, in microseconds)
+def _deltavalues(vmid, ts, delta):
+    return (vmid, ts, ts - round(delta["e"] * 1e6), delta["e"], delta["tcpu"], delta["tdisk"], delta["tnic"], delta["ncpu"], delta["ndisk"], delta["nnic"])
+
+# Converts a row of the vmdelta table into an incremental sample, in the same format than the samples obtained by RawData._convert
+# @param repeated the amount of repeated samples that the incremental sample stands for (see Storage dedup); the sample is split into that
+#   amount of samples without consumption, evenly spaced (as RawData._convert does), and a list is returned
+def _deltatosample(ts, tsbegin, e, tcpu_ns, tdisk, tnic, ncpu, ndisk, nnic, repeated = 0):
+    if repeated > 0:
+        return [ Sample(s, ncpu, ndisk, nnic, tcpu_ns * 1e-9, tdisk, tnic, s - S, S) for (S, s) in _repeatedsamples(tsbegin / 1e6, ts / 1e6, repeated) ]
+    return Sample(ts / 1e6, ncpu, ndisk, nnic, tcpu_ns * 1e-9, tdisk, tnic, e, tsbegin / 1e6)
+
+# Joins the incremental samples of a VM obtained from _deltatosample (i.e. the lists of the series of repeated samples), keeping the ones in a
+#   range of epochs (in seconds; any of them may be None)
+def _joindeltas(samples, fromts, tots):
+    result = []
+    for sample in samples:
+        if isinstance(sample, list):
+            result.extend(x for x in sample if ((fromts is None) or (x.S >= fromts)) and ((tots is None) or (x.s <= tots)))
+        else:
+            result.append(sample)
+    return result
+
+# The state of a sample in the catalog of VMs: ok if it has valid counters, or the reason why it has no information
+# @param tcpu_ns the counter of CPU of the sample (None if the sample has no valid counters)
+def _state(info, tcpu_ns):
+    if tcpu_ns is not None:
+        return "ok"
+    for state in [ "conflictingRequest", "itemNotFound" ]:
+        if state in info:
+            return state
+    return "invalid"
+
+# The columns of the catalog of VMs that are updated with the latest sample of the VM with valid counters
+_CATALOG_COUNTERS = [ "counters_ts", *COUNTER_COLUMNS ]
+
+# The statement to add a sample to the catalog of VMs (the values are obtained with _catalogvalues)
+_UPSERT_CATALOG = "insert into vm_catalog (vmid, first_ts, last_ts, samples, bytes, state, {}) values (?, ?, ?, 1, ?, ?, {}) \
+    on conflict (vmid) do update set first_ts = min(first_ts, excluded.first_ts), last_ts = max(last_ts, excluded.last_ts), \
+    samples = samples + 1, bytes = bytes + excluded.bytes, state = case when excluded.last_ts >= last_ts then excluded.state else state end, {}".format(
+        ", ".join(_CATALOG_COUNTERS), ", ".join([ "?" ] * len(_CATALOG_COUNTERS)),
+        ", ".join([ "{0} = case when excluded.counters_ts >= coalesce(counters_ts, excluded.counters_ts) then excluded.{0} else {0} end".format(c) for c in _CATALOG_COUNTERS ]))
+
+# Obtains the values to add a sample to the catalog of VMs
+# @param row the values of the row inserted in vmmonitor, as obtained from _rowvalues
+def _catalogvalues(row, state):
+    (vmid, ts, data, *counters) = row
+    return (vmid, ts, ts, len(data), state, ts if counters[0] is not None else None, *counters)
+
+# The statements to update the global values of the database in the metadata table with the values of a batch of samples (the values are
+#   obtained with _metadatavalues); the schema version is not included, because it is kept in pragma user_version
+_UPSERT_METADATA = "insert into metadata (key, value) values (?, ?) on conflict (key) do update set value = {}"
+_UPSERT_METADATA_MIN = _UPSERT_METADATA.format("min(value, excluded.value)")
+_UPSERT_METADATA_MAX = _UPSERT_METADATA.format("max(value, excluded.value)")
+_UPSERT_METADATA_ADD = _UPSERT_METADATA.format("value + excluded.value")
+
+# Converts a row of the catalog of VMs into a dict; the dates are datetime objects and the counters are the ones of the last sample of the
+#   VM with valid information (see _countersample), or None if there is no such sample
+def _catalogtoentry(vmid, first_ts, last_ts, samples, bytes, state, counters_ts, *counters):
+    return {
+        "vmid": vmid,
+        "first": fromepoch(first_ts / 1e6),
+        "last": fromepoch(last_ts / 1e6),
+        "samples": samples,
+        "bytes": bytes,
+        "state": state,
+        "counters": _countersample(counters_ts, *counters) if counters_ts is not None else None,
+    }
+
 class Storage:
-    def __init__(self, filename = None):
+    # @param readonly if True, the database is opened in read-only mode (i.e. the analysis), so that it never writes to the database nor holds
+    #   any lock that may delay the monitor; an outdated database is read using its schema (see _checkDB)
+    # @param dedup if True, a sample whose state and counters (except the uptime) are the same than the ones of the last row of the VM (e.g. a
+    #   VM that is shut off or completely idle) is not stored: the last row is extended up to the sample instead (see columns tsend and
+    #   repeats), and the data of the sample is discarded. The analysis splits the series into that amount of samples, evenly spaced (i.e. the
+    #   same samples if they were taken at regular intervals)
+    # @param chunks if True, the samples of each VM with valid counters are packed in a single row per period (see CHUNK_PERIOD and table
+    #   vmchunk) once the period is over, i.e. when the VM has samples of a later period; the data of the packed samples is discarded. The
+    #   samples of the open period are kept in vmmonitor meanwhile, so they are not lost if the monitor is stopped (dedup is not used, because
+    #   the repeated samples are cheap in the chunks)
+    def __init__(self, filename = None, synchronous = "NORMAL", busy_timeout = DEFAULT_BUSY_TIMEOUT, codec = "none", readonly = False, dedup = False,
+                    chunks = False):
         if filename is None:
             filename = DEFAULT_FILENAME
         self._filename = filename
+        self._readonly = readonly
+        self._dedup = dedup and not chunks
+        self._chunking = chunks
         self._conn = None
+        self._codec = PayloadCodec(codec)
+        # Whether the rollups and the incremental samples are available in the database (i.e. they must be updated when storing samples)
+        self._rollups = False
+        self._deltas = False
+        # Whether the catalog of VMs and the metadata table are available in the database
+        self._catalog = False
+        self._metadata = False
+        # Whether the rows of vmmonitor may be extended by repeated samples (i.e. columns tsend and repeats exist)
+        self._repeats = False
+        # Whether vmmonitor refers to the VMs using their id in the dictionary of VMs (table vms); the samples are read from view vmsamples,
+        #   that has the uuid of the VM in column vmid (i.e. the same columns than vmmonitor had before)
+        self._vms = False
+        self._samples = "vmmonitor"
+        # The ids of the VMs in the dictionary of VMs, by uuid (see _getvmkeys)
+        self._vmkeys = {}
+        # Whether the samples may be packed in chunks (i.e. table vmchunk exists), and the beginning of the open chunk of each VM (i.e. its
+        #   samples before that epoch have been packed already, see _packchunks)
+        self._chunks = False
+        self._openchunks = {}
+        # Whether vmdelta may have the incremental samples since the VMs were started (i.e. an outdated database, see _migrate_v13)
+        self._basedeltas = False
+        # Whether vmdelta marks the incremental samples that stand for a series of repeated samples (i.e. column repeated exists)
+        self._deltarepeats = False
+        # Whether vmmonitor has the epoch and the counters of the samples (i.e. the database has been migrated to version 3), and whether the
+        #   counters are extracted from the payloads by sqlite3 otherwise (see _hasjson1)
+        self._counters = False
+        self._json1 = False
+        # The last row of each VM (see _getlastrow), to check whether the next sample repeats it; if a VM is not in the cache, it is loaded
+        #   from the database
+        self._lastrows = {}
+        # The counters of the last sample stored for each VM (see _countersample), to calculate the incremental samples when storing the
+        #   next ones; if a VM is not in the cache, they are loaded from the database
+        self._lastcounters = {}
+        # A function that is called as lastcounters_fnc(vmid, ts) to obtain the counters of the last sample of a VM when there are no samples
+        #   of the VM in the database (e.g. the previous shard of a ShardedStorage)
+        self.lastcounters_fnc = None
 
-    def connect(self):
+        if synchronous.upper() not in SYNCHRONOUS_LEVELS:
+            p_warning("invalid synchronous level {}; using NORMAL".format(synchronous))
+            synchronous = "NORMAL"
+        self._synchronous = synchronous.upper()
+        self._busy_timeout = busy_timeout
+
+    # @param upgrade whether to migrate an outdated database that has samples (a new database is always created with the current schema);
+    #   the migrations that copy whole tables are left to osidle-dbpack --migrate by default, so that the monitor does not hold the database
+    def connect(self, upgrade = False):
         conn = None
         try:
-            conn = sqlite3.connect(self._filename)
+            if self._readonly:
+                # The database is not created if it does not exist
+                conn = sqlite3.connect("file:{}?mode=ro".format(pathname2url(os.path.abspath(self._filename))), uri = True, timeout = self._busy_timeout / 1000)
+            else:
+                conn = sqlite3.connect(self._filename, timeout = self._busy_timeout / 1000)
         except Exception as e:
             p_error("Could not connect to database: {}".format(e))
             conn = None
 
         if conn is not None:
             self._conn = conn
-            self._createDB()
+            self._setupConnection()
+            self._createDB(upgrade)
+
+    # The database is used in WAL mode, so that the monitors can write to it while osidle is reading (readers do not block writers and
+    #   vice versa); the journal mode is persistent in the file, but synchronous and busy_timeout are per connection
+    def _setupConnection(self):
+        cursor = self._conn.cursor()
+        _sql(cursor, "pragma busy_timeout = {:d}".format(int(self._busy_timeout)))
+        if self._readonly:
+            _sql(cursor, "pragma query_only = 1")
+            _sql(cursor, "pragma mmap_size = {:d}".format(READONLY_MMAP_SIZE))
+            _sql(cursor, "pragma cache_size = {:d}".format(READONLY_CACHE_SIZE))
+            return
+        # The free pages are returned to the filesystem in small steps (see incrementalvacuum); this only applies to new databases, as the
+        #   existing ones need a full vacuum to change it (see vaccuum)
+        _sql(cursor, "pragma auto_vacuum = incremental")
+        mode = _sql(cursor, "pragma journal_mode = wal").fetchone()[0]
+        if mode.lower() != "wal":
+            p_warning("could not set the database in WAL mode (journal mode is {})".format(mode))
+        _sql(cursor, "pragma synchronous = {}".format(self._synchronous))
     
-    def _createDB(self):
+    def _createDB(self, upgrade = False):
+        if self._readonly:
+            return self._checkDB()
+
         cursor = self._conn.cursor()
+        # The original layout of the table (i.e. schema version 1); any newer version is obtained by migrating from this one
         cursor.execute("create table if not exists \
             vmmonitor (\
                 id integer PRIMARY KEY AUTOINCREMENT, \
@@ -55,107 +541,1249 @@ class Storage:
             )")
         self._conn.commit()
 
-    def isConnected(self):
-        return self._conn is not None
+        version = self.getschemaversion()
+        if version < SCHEMA_VERSION:
+            if (version == 1) and not _sql(cursor, "select exists (select 1 from vmmonitor)").fetchone()[0]:
+                # A new database is just "upgraded" silently
+                self.migrate()
+            elif upgrade:
+                p_info("upgrading the database schema from version {} to {}".format(version, SCHEMA_VERSION))
+                self.migrate()
+            else:
+                p_warning("the database schema is outdated (version {}); please run osidle-dbpack --migrate".format(version))
 
-    def getmaxt(self):
+        self._setfeatures()
+
+    # The read-only version of _createDB: an outdated database is not upgraded, but read using its schema, because some migrations copy whole
+    #   tables and they would compete for the database with the monitor
+    def _checkDB(self):
+        version = self.getschemaversion()
+        if version < SCHEMA_VERSION:
+            p_warning("the database schema is outdated (version {}); please run osidle-dbpack --migrate".format(version))
+        self._setfeatures()
+
+    # Sets which of the tables of the schema are available, according to the version of the database
+    def _setfeatures(self):
+        version = self.getschemaversion()
+        self._counters = version >= 3
+        self._json1 = self._hasjson1()
+        self._rollups = version >= 6
+        self._deltas = version >= 7
+        self._catalog = version >= 8
+        self._metadata = version >= 9
+        self._repeats = version >= 10
+        self._vms = version >= 11
+        self._samples = "vmsamples" if self._vms else "vmmonitor"
+        self._chunks = version >= 12
+        self._basedeltas = self._deltas and version < 13
+        self._deltarepeats = version >= 14
+        self._loaddictionaries()
+
+    # Checks whether the counters are extracted from the payloads by sqlite3 (see JSON1_PUSHDOWN), i.e. it has the JSON1 extension and the
+    #   window functions (both are built in from sqlite 3.38 and 3.25)
+    def _hasjson1(self):
+        if not JSON1_PUSHDOWN:
+            return False
+        try:
+            _sql(self._conn.cursor(), "select json_extract('{\"a\": 1}', '$.a'), lag(1) over ()").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    # Makes the zstd dictionaries stored in the database available to the codec
+    def _loaddictionaries(self):
+        cursor = self._conn.cursor()
+        if _sql(cursor, "select count(*) from sqlite_master where type = 'table' and name = 'payload_dictionaries'").fetchone()[0] == 0:
+            return
+        for (dictid, data) in _sql(cursor, "select id, data from payload_dictionaries").fetchall():
+            self._codec.add_dictionary(dictid, data)
+
+    # Obtains the version of the schema of the database (a database without version is the original layout, i.e. version 1)
+    def getschemaversion(self):
+        if not self.isConnected():
+            return None
+
+        cursor = self._conn.cursor()
+        version = _sql(cursor, "pragma user_version").fetchone()[0]
+        return max(version, 1)
+
+    def _setschemaversion(self, version):
+        cursor = self._conn.cursor()
+        # pragma statements do not accept parameters
+        _sql(cursor, "pragma user_version = {:d}".format(version))
+        self._conn.commit()
+
+    # Migrates the database to the current version of the schema, step by step, committing each batch of rows so that any other process
+    #   (e.g. the monitor) can keep on using the database while the migration is in progress
+    # @param batchsize the amount of rows to move in each step
+    # @param progress_fnc a function that is called as progress_fnc(version, done, total) after each step
+    # @return the version of the schema after the migration
+    def migrate(self, batchsize = MIGRATION_BATCH_SIZE, progress_fnc = None):
         if not self.isConnected():
             return None
 
+        version = self.getschemaversion()
+        for (v, migration_fnc) in Storage._MIGRATIONS:
+            if v <= version:
+                continue
+            p_debug("migrating the database to schema version {}".format(v))
+            migration_fnc(self, batchsize, (lambda done, total: progress_fnc(v, done, total)) if callable(progress_fnc) else None)
+            self._setschemaversion(v)
+            version = v
+        return version
+
+    # Version 2: the rows of vmmonitor are clustered by (vmid, t) and there are indexes on (vmid, t) and t, so that reading the samples of
+    #   one VM in a range of dates is a sequential read of pages instead of a scan of the whole table.
+    def _migrate_v2(self, batchsize, progress_fnc = None):
+        cursor = self._conn.cursor()
+
+        # The index is created in the original table first, so that the rows can be walked in order without sorting the table in each batch
+        _sql(cursor, "create index if not exists vmmonitor_vmid_t on vmmonitor (vmid, t)")
+        _sql(cursor, "drop table if exists vmmonitor_v2")
+        _sql(cursor, "create table vmmonitor_v2 (\
+                id integer PRIMARY KEY AUTOINCREMENT, \
+                t datetime DEFAULT (STRFTIME('%Y-%m-%dT%H:%M:%fZ', 'NOW')), \
+                vmid varchar(36) NOT NULL,\
+                data text\
+            )")
+        self._conn.commit()
+
+        # The rows inserted while migrating (i.e. id > maxid) are moved at the end, in the same transaction that swaps the tables
+        (maxid, total) = _sql(cursor, "select coalesce(max(id), 0), count(*) from vmmonitor").fetchone()
+        done = 0
+        last = None
+        while True:
+            if last is None:
+                _sql(cursor, "select id, vmid, t, data from vmmonitor where id <= ? order by vmid, t, id limit ?", (maxid, batchsize))
+            else:
+                _sql(cursor, "select id, vmid, t, data from vmmonitor where id <= ? and (vmid, t, id) > (?, ?, ?) order by vmid, t, id limit ?", (maxid, *last, batchsize))
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                break
+            cursor.executemany("insert into vmmonitor_v2 (vmid, t, data) values (?, ?, ?)", [ (vmid, t, data) for (_, vmid, t, data) in rows ])
+            self._conn.commit()
+            (id, vmid, t, _) = rows[-1]
+            last = (vmid, t, id)
+            done += len(rows)
+            if callable(progress_fnc):
+                progress_fnc(done, total)
+
+        cursor.execute("begin immediate")
+        _sql(cursor, "insert into vmmonitor_v2 (vmid, t, data) select vmid, t, data from vmmonitor where id > ? order by vmid, t, id", (maxid,))
+        _sql(cursor, "drop table vmmonitor")
+        _sql(cursor, "alter table vmmonitor_v2 rename to vmmonitor")
+        _sql(cursor, "create index vmmonitor_vmid_t on vmmonitor (vmid, t)")
+        _sql(cursor, "create index vmmonitor_t on vmmonitor (t)")
+        self._conn.commit()
+
+    # Version 3: the counters of the samples and the timestamp (as microseconds since the epoch) are stored in their own columns, so that
+    #   the analysis does not need to decode the data of each sample
+    def _migrate_v3(self, batchsize, progress_fnc = None):
+        cursor = self._conn.cursor()
+        columns = [ row[1] for row in _sql(cursor, "pragma table_info(vmmonitor)").fetchall() ]
+        for column in [ "ts", *COUNTER_COLUMNS ]:
+            if column not in columns:
+                _sql(cursor, "alter table vmmonitor add column {} integer".format(column))
+        self._conn.commit()
+
+        # Fill in the new columns for the existing rows (the rows inserted from now on already have them)
+        total = _sql(cursor, "select count(*) from vmmonitor where ts is null").fetchone()[0]
+        done = 0
+        lastid = 0
+        while True:
+            _sql(cursor, "select id, vmid, t, data from vmmonitor where id > ? and ts is null order by id limit ?", (lastid, batchsize))
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                break
+            updates = []
+            for (id, vmid, t, data) in rows:
+                (_, ts, _, *counters) = _rowvalues(vmid, _strtots(t), self._codec.decode(data), self._codec)
+                updates.append((ts, *counters, id))
+            cursor.executemany("update vmmonitor set ts = ?, {} where id = ?".format(", ".join([ "{} = ?".format(c) for c in COUNTER_COLUMNS ])), updates)
+            self._conn.commit()
+            lastid = rows[-1][0]
+            done += len(rows)
+            if callable(progress_fnc):
+                progress_fnc(done, total)
+
+    # Version 4: the data of the samples may be compressed (see PayloadCodec) and the dictionaries for zstd are stored in the database
+    def _migrate_v4(self, batchsize, progress_fnc = None):
+        cursor = self._conn.cursor()
+        _sql(cursor, "create table if not exists payload_dictionaries (\
+                id integer PRIMARY KEY AUTOINCREMENT, \
+                t datetime DEFAULT (STRFTIME('%Y-%m-%dT%H:%M:%fZ', 'NOW')), \
+                data blob NOT NULL\
+            )")
+        self._conn.commit()
+
+    # Version 5: the samples are retrieved using the epoch (ts) instead of the timestamp string (t), so the indexes are moved to ts
+    def _migrate_v5(self, batchsize, progress_fnc = None):
+        cursor = self._conn.cursor()
+        _sql(cursor, "create index if not exists vmmonitor_vmid_ts on vmmonitor (vmid, ts)")
+        _sql(cursor, "create index if not exists vmmonitor_ts on vmmonitor (ts)")
+        _sql(cursor, "drop index if exists vmmonitor_vmid_t")
+        _sql(cursor, "drop index if exists vmmonitor_t")
+        self._conn.commit()
+
+    # Version 6: the consumption of the VMs is aggregated per hour and per day in table vmrollup (it is updated when the samples are
+    #   stored), so that the analysis of long periods does not need to read every sample
+    def _migrate_v6(self, batchsize, progress_fnc = None):
+        cursor = self._conn.cursor()
+        _sql(cursor, "create table if not exists vmrollup (\
+                vmid varchar(36) NOT NULL, \
+                resolution integer NOT NULL, \
+                bucket integer NOT NULL, \
+                e real, \
+                tcpu_ns real, \
+                tdisk real, \
+                tnic real, \
+                samples integer, \
+                ncpu integer, \
+                ndisk integer, \
+                nnic integer, \
+                tsbegin integer, \
+                PRIMARY KEY (vmid, resolution, bucket)\
+            ) WITHOUT ROWID")
+        self._conn.commit()
+
+        # From now on, the rollups are updated when the samples are stored, so only the existing samples are aggregated here
+        self._rollups = True
+        maxts = _sql(cursor, "select max(ts) from vmmonitor").fetchone()[0]
+        if maxts is not None:
+            self._buildderived(maxts, True, False, progress_fnc)
+
+    # Version 7: the incremental samples (i.e. the consumption of resources between each sample and the previous one) are calculated when
+    #   the samples are stored and they are kept in table vmdelta, so that the analysis does not need to calculate them in each run
+    def _migrate_v7(self, batchsize, progress_fnc = None):
+        cursor = self._conn.cursor()
+        _sql(cursor, "create table if not exists vmdelta (\
+                vmid varchar(36) NOT NULL, \
+                ts integer NOT NULL, \
+                tsbegin integer NOT NULL, \
+                e real, \
+                tcpu_ns integer, \
+                tdisk integer, \
+                tnic integer, \
+                ncpu integer, \
+                ndisk integer, \
+                nnic integer, \
+                PRIMARY KEY (vmid, ts)\
+            ) WITHOUT ROWID")
+        self._conn.commit()
+
+        self._deltas = True
+        maxts = _sql(cursor, "select max(ts) from vmmonitor").fetchone()[0]
+        if maxts is not None:
+            self._buildderived(maxts, False, True, progress_fnc)
+
+    # Version 8: the catalog of VMs (table vm_catalog) keeps the first and the last sample of each VM, the amount of samples (and bytes of
+    #   data) and the counters and the state of the last sample, so that the VMs can be listed without scanning vmmonitor
+    def _migrate_v8(self, batchsize, progress_fnc = None):
+        cursor = self._conn.cursor()
+        _sql(cursor, "create table if not exists vm_catalog (\
+                vmid varchar(36) PRIMARY KEY, \
+                first_ts integer NOT NULL, \
+                last_ts integer NOT NULL, \
+                samples integer NOT NULL, \
+                bytes integer NOT NULL, \
+                state varchar(32), \
+                counters_ts integer, \
+                {} \
+            ) WITHOUT ROWID".format(", ".join([ "{} integer".format(c) for c in COUNTER_COLUMNS ])))
+        self._conn.commit()
+
+        self._catalog = True
+        self._rebuildcatalog(progress_fnc)
+
+    # Version 9: the global values of the database (the first and the last timestamp and the amount of samples) are kept in table metadata,
+    #   so that they are obtained without reading vmmonitor
+    def _migrate_v9(self, batchsize, progress_fnc = None):
+        cursor = self._conn.cursor()
+        _sql(cursor, "create table if not exists metadata (\
+                key varchar(32) PRIMARY KEY, \
+                value integer \
+            ) WITHOUT ROWID")
+        self._conn.commit()
+
+        self._metadata = True
+        self._rebuildmetadata()
+
+    # Version 10: a row of vmmonitor may stand for a series of samples of a VM whose state and counters did not change (see Storage dedup); the
+    #   row is valid from ts to tsend, and repeats is the amount of samples merged into it (tsend is NULL for a single sample)
+    def _migrate_v10(self, batchsize, progress_fnc = None):
+        cursor = self._conn.cursor()
+        columns = [ row[1] for row in _sql(cursor, "pragma table_info(vmmonitor)").fetchall() ]
+        if "tsend" not in columns:
+            _sql(cursor, "alter table vmmonitor add column tsend integer")
+        if "repeats" not in columns:
+            _sql(cursor, "alter table vmmonitor add column repeats integer NOT NULL DEFAULT 0")
+        self._conn.commit()
+        self._repeats = True
+
+    # Version 11: the uuids of the VMs are stored once, in the dictionary of VMs (table vms), and vmmonitor refers to them by their integer id
+    #   (column vm), so the rows and the index on (vm, ts) are smaller; the data is moved to the last column, so that the counters are read
+    #   without reading the overflow pages of the data. The table is copied in batches (as in version 2) and view vmsamples keeps the uuid
+    #   of the VMs in column vmid for the queries.
+    def _migrate_v11(self, batchsize, progress_fnc = None):
+        cursor = self._conn.cursor()
+        _sql(cursor, "create table if not exists vms (\
+                id integer PRIMARY KEY, \
+                uuid varchar(36) NOT NULL UNIQUE\
+            )")
+        _sql(cursor, "drop table if exists vmmonitor_v11")
+        _sql(cursor, _CREATE_VMMONITOR.format("vmmonitor_v11"))
+        _sql(cursor, "insert or ignore into vms (uuid) select distinct vmid from vmmonitor order by vmid")
+        self._conn.commit()
+
+        # The rows inserted while migrating (i.e. id > maxid) are moved at the end, in the same transaction that swaps the tables
+        columns = ", ".join([ "t", "ts", "tsend", "repeats", *COUNTER_COLUMNS, "data" ])
+        copy = "insert into vmmonitor_v11 (id, vm, {0}) select m.id, vms.id, {1} from vmmonitor m join vms on vms.uuid = m.vmid".format(
+            columns, ", ".join([ "m.{}".format(c) for c in [ "t", "ts", "tsend", "repeats", *COUNTER_COLUMNS, "data" ] ]))
+        (maxid, total) = _sql(cursor, "select coalesce(max(id), 0), count(*) from vmmonitor").fetchone()
+        done = 0
+        lastid = 0
+        while lastid < maxid:
+            _sql(cursor, "{} where m.id > ? and m.id <= ? order by m.id limit ?".format(copy), (lastid, maxid, batchsize))
+            if cursor.rowcount <= 0:
+                break
+            done += cursor.rowcount
+            lastid = _sql(cursor, "select max(id) from vmmonitor_v11").fetchone()[0]
+            self._conn.commit()
+            if callable(progress_fnc):
+                progress_fnc(done, total)
+
+        cursor.execute("begin immediate")
+        _sql(cursor, "insert or ignore into vms (uuid) select distinct vmid from vmmonitor where id > ?", (maxid,))
+        _sql(cursor, "{} where m.id > ? order by m.id".format(copy), (maxid,))
+        _sql(cursor, "drop table vmmonitor")
+        _sql(cursor, "alter table vmmonitor_v11 rename to vmmonitor")
+        for statement in _VMMONITOR_INDEXES:
+            _sql(cursor, statement)
+        self._conn.commit()
+        self._vms = True
+        self._samples = "vmsamples"
+
+    # Version 12: the samples of a VM in a period may be packed in a single row of table vmchunk (see Storage chunks), that holds the epochs
+    #   and each of the counters of the samples as blobs of int64 values (see _pack); view vmchunks has the uuid of the VM in column vmid
+    def _migrate_v12(self, batchsize, progress_fnc = None):
+        cursor = self._conn.cursor()
+        _sql(cursor, "create table if not exists vmchunk (\
+                id integer PRIMARY KEY, \
+                vm integer NOT NULL REFERENCES vms (id), \
+                bucket integer NOT NULL, \
+                first_ts integer NOT NULL, \
+                last_ts integer NOT NULL, \
+                samples integer NOT NULL, \
+                {}, \
+                UNIQUE (vm, bucket)\
+            )".format(", ".join([ "{} blob".format(c) for c in [ "ts", *COUNTER_COLUMNS ] ])))
+        _sql(cursor, "create index if not exists vmchunk_last_ts on vmchunk (last_ts)")
+        _sql(cursor, "create view if not exists vmchunks as select vmchunk.*, vms.uuid as vmid from vmchunk join vms on vms.id = vmchunk.vm")
+        self._conn.commit()
+        self._chunks = True
+
+    # Version 13: the incremental sample of the first sample of each VM (i.e. the consumption since the VM was started, see basesample) is not
+    #   kept in vmdelta, because it is not consumption in the range of dates of the samples (RawData discards it, and so do the rollups); the
+    #   one stored by the previous versions is the incremental sample at the first sample of the VM that starts when the VM was started
+    def _migrate_v13(self, batchsize, progress_fnc = None):
+        # The samples are read through view vmsamples and the chunks (i.e. the features of version 12)
+        self._setfeatures()
+        cursor = self._conn.cursor()
+        vmids = [ vmid for (vmid,) in _sql(cursor, "select distinct vmid from vmdelta").fetchall() ]
+        for i, vmid in enumerate(vmids):
+            first = self._firstcounters(cursor, vmid)
+            if first is not None:
+                (ts, uptime) = first
+                # The beginning of the sample is rounded to microseconds (see _deltavalues)
+                _sql(cursor, "delete from vmdelta where vmid = ? and ts = ? and abs(tsbegin - ?) <= 1", (vmid, ts, ts - uptime * 1000000))
+            if ((i + 1) % batchsize == 0) or (i + 1 == len(vmids)):
+                self._conn.commit()
+                if callable(progress_fnc):
+                    progress_fnc(i + 1, len(vmids))
+
+    # Version 14: the incremental samples that stand for a series of repeated samples (see Storage dedup) have the amount of repeated samples in
+    #   vmdelta (column repeated), so that iter_deltas splits them into that amount of samples and includes the ones that overlap the range of
+    #   dates, instead of any incremental sample without consumption; they are the incremental samples that end where a row of the samples ends
+    #   (i.e. at tsend)
+    def _migrate_v14(self, batchsize, progress_fnc = None):
+        self._setfeatures()
+        cursor = self._conn.cursor()
+        columns = [ row[1] for row in _sql(cursor, "pragma table_info(vmdelta)").fetchall() ]
+        if "repeated" not in columns:
+            _sql(cursor, "alter table vmdelta add column repeated integer NOT NULL DEFAULT 0")
+        self._conn.commit()
+
+        rows = _sql(cursor, "select repeats, vmid, tsend from {} where tsend > ts".format(self._samples)).fetchall()
+        for i in range(0, len(rows), batchsize):
+            cursor.executemany(_SET_REPEATED_DELTA, rows[i:i + batchsize])
+            self._conn.commit()
+            if callable(progress_fnc):
+                progress_fnc(min(i + batchsize, len(rows)), len(rows))
+        self._deltarepeats = True
+
+    # Obtains the epoch and the uptime of the first sample of a VM with valid counters (either in vmmonitor or in the chunks)
+    # @return a tuple (ts, uptime), or None if the VM has no samples with valid counters
+    def _firstcounters(self, cursor, vmid):
+        first = _sql(cursor, "select ts, uptime from {} where vmid = ? and tcpu_ns is not null order by ts limit 1".format(self._samples), (vmid,)).fetchone()
+        if self._chunks:
+            first_ts = _sql(cursor, "select min(first_ts) from vmchunks where vmid = ?", (vmid,)).fetchone()[0]
+            if (first_ts is not None) and ((first is None) or (first_ts < first[0])):
+                for (_, rows) in self._iterchunks(first_ts, first_ts, [ vmid ]):
+                    first = (rows[0][0], rows[0][-1])
+        return first
+
+    _MIGRATIONS = [
+        (2, _migrate_v2),
+        (3, _migrate_v3),
+        (4, _migrate_v4),
+        (5, _migrate_v5),
+        (6, _migrate_v6),
+        (7, _migrate_v7),
+        (8, _migrate_v8),
+        (9, _migrate_v9),
+        (10, _migrate_v10),
+        (11, _migrate_v11),
+        (12, _migrate_v12),
+        (13, _migrate_v13),
+        (14, _migrate_v14),
+    ]
+
+    # Clusters the samples of each VM again, i.e. copies vmmonitor to a new table ordered by (vm, ts). The rows are appended in the order
+    #   in which they are stored, so the samples of the VMs stored after a migration that copies the table (see _migrate_v2) are interleaved
+    #   again and reading the samples of a VM reads more pages as the database grows. The table is copied in batches (as in the migrations)
+    #   and the rows that the monitor modifies or deletes meanwhile (e.g. the repeated samples, the chunks or the expired samples) are
+    #   logged by triggers and copied again in the same transaction that swaps the tables.
+    # @param progress_fnc a function that is called as progress_fnc(done, total) after each step
+    # @return the amount of rows copied
+    def cluster(self, batchsize = MIGRATION_BATCH_SIZE, progress_fnc = None):
+        if (not self.isConnected()) or self._readonly or (not self._vms):
+            return None
+
+        cursor = self._conn.cursor()
+        _sql(cursor, "drop table if exists vmmonitor_cluster")
+        _sql(cursor, _CREATE_VMMONITOR.format("vmmonitor_cluster"))
+        _sql(cursor, "drop table if exists vmmonitor_cluster_log")
+        _sql(cursor, "create table vmmonitor_cluster_log (vm integer, ts integer, PRIMARY KEY (vm, ts))")
+        for action in [ "update", "delete" ]:
+            _sql(cursor, "drop trigger if exists vmmonitor_cluster_{}".format(action))
+            _sql(cursor, "create trigger vmmonitor_cluster_{} after {} on vmmonitor begin \
+                insert or ignore into vmmonitor_cluster_log (vm, ts) values (old.vm, old.ts); end".format(action, action))
+        self._conn.commit()
+
+        columns = ", ".join([ "vm", "t", "ts", "tsend", "repeats", *COUNTER_COLUMNS, "data" ])
+        insert = "insert into {{}} ({}) values ({})".format(columns, ", ".join([ "?" ] * (5 + len(COUNTER_COLUMNS) + 1)))
+        (maxid, total) = _sql(cursor, "select coalesce(max(id), 0), count(*) from vmmonitor").fetchone()
+        done = 0
+        last = None
+        while True:
+            if last is None:
+                _sql(cursor, "select id, {} from vmmonitor where id <= ? order by vm, ts, id limit ?".format(columns), (maxid, batchsize))
+            else:
+                _sql(cursor, "select id, {} from vmmonitor where id <= ? and (vm, ts, id) > (?, ?, ?) order by vm, ts, id limit ?".format(columns),
+                    (maxid, *last, batchsize))
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                break
+            cursor.executemany(insert.format("vmmonitor_cluster"), [ row[1:] for row in rows ])
+            self._conn.commit()
+            last = (rows[-1][1], rows[-1][3], rows[-1][0])
+            done += len(rows)
+            if callable(progress_fnc):
+                progress_fnc(done, total)
+
+        cursor.execute("begin immediate")
+        # The rows modified after being copied are obtained from the original table before dropping it, and they replace their copies once
+        #   the new table has its indexes
+        copied = _sql(cursor, "select coalesce(max(id), 0) from vmmonitor_cluster").fetchone()[0]
+        modified = _sql(cursor, "select {} from vmmonitor where id <= ? and (vm, ts) in (select vm, ts from vmmonitor_cluster_log) order by vm, ts, id".format(columns),
+            (maxid,)).fetchall()
+        _sql(cursor, "insert into vmmonitor_cluster ({0}) select {0} from vmmonitor where id > ? order by vm, ts, id".format(columns), (maxid,))
+        _sql(cursor, "drop view vmsamples")
+        _sql(cursor, "drop table vmmonitor")
+        _sql(cursor, "alter table vmmonitor_cluster rename to vmmonitor")
+        for statement in _VMMONITOR_INDEXES:
+            _sql(cursor, statement)
+        _sql(cursor, "delete from vmmonitor where id <= ? and (vm, ts) in (select vm, ts from vmmonitor_cluster_log)", (copied,))
+        cursor.executemany(insert.format("vmmonitor"), modified)
+        _sql(cursor, "drop table vmmonitor_cluster_log")
+        self._conn.commit()
+        return done
+
+    # Calculates the incremental samples and the rollups from the samples stored up to a moment (one VM at a time, committing the data of
+    #   each VM)
+    # @param maxts the epoch (in microseconds) of the last sample to consider
+    # @param rollups, deltas whether to calculate the rollups and the incremental samples
+    # @param progress_fnc a function that is called as progress_fnc(done, total) after each VM
+    def _buildderived(self, maxts, rollups, deltas, progress_fnc = None):
+        cursor = self._conn.cursor()
+        vmids = [ vmid for (vmid,) in _sql(cursor, "select distinct vmid from {}{}".format(self._samples, " union select vmid from vmchunks" if self._chunks else "")).fetchall() ]
+        for i, vmid in enumerate(vmids):
+            _sql(cursor, "select {}, {} from {} where vmid = ? and ts <= ? and tcpu_ns is not null order by ts".format(_columns(True, self._repeats),
+                "repeats" if self._repeats else "0", self._samples), (vmid, maxts))
+            rows = cursor.fetchall()
+            if self._chunks:
+                rows = sorted(rows + [ (*row, 0) for (_, chunkrows) in self._iterchunks(None, maxts, [ vmid ]) for row in chunkrows ], key = lambda x: x[0])
+
+            buckets = {}
+            deltarows = []
+            repeatedrows = []
+            # The first sample of the VM follows the last one of the VM in the previous shard, if any (as when the samples are stored)
+            prev = self.lastcounters_fnc(vmid, rows[0][0]) if callable(self.lastcounters_fnc) and (len(rows) > 0) else None
+            for (ts, tsend, *counters, repeats) in rows:
+                samples = [ _countersample(ts, *counters) ]
+                # The row stands for a series of repeated samples, so the counters did not change until tsend
+                if (tsend is not None) and (tsend > ts):
+                    samples.append(_countersample(tsend, *counters))
+                for cur in samples:
+                    # The consumption since the VM was started (see basesample) is not included in the incremental samples nor in the rollups,
+                    #   as RawData discards the first sample of a series
+                    delta = incremental(prev, cur) if prev is not None else None
+                    if delta is not None:
+                        if deltas:
+                            deltarows.append(_deltavalues(vmid, cur["ts"], delta))
+                            if cur is not samples[0]:
+                                repeatedrows.append((repeats, vmid, cur["ts"]))
+                        if rollups:
+                            for (resolution, bucket, *values) in _rollupbuckets(prev["ts"], cur["ts"], delta, cur is samples[0]):
+                                if (resolution, bucket) not in buckets:
+                                    buckets[(resolution, bucket)] = values
+                                else:
+                                    buckets[(resolution, bucket)] = _addrollup(buckets[(resolution, bucket)], values)
+                    prev = cur
+
+            if deltas:
+                cursor.executemany(_INSERT_DELTA, deltarows)
+                if self._deltarepeats:
+                    cursor.executemany(_SET_REPEATED_DELTA, repeatedrows)
+            if rollups:
+                cursor.executemany(_UPSERT_ROLLUP, [ (vmid, *key, *values) for (key, values) in buckets.items() ])
+            self._conn.commit()
+            if callable(progress_fnc):
+                progress_fnc(i + 1, len(vmids))
+
+    # Calculates the incremental samples, the rollups, the catalog of VMs and the metadata again from the samples in the database (e.g. if
+    #   samples have been stored out of order)
+    # @param progress_fnc a function that is called as progress_fnc(done, total) after each VM
+    def rebuildderived(self, progress_fnc = None):
+        if (not self.isConnected()) or (not self._rollups) or (not self._deltas):
+            return False
+
+        cursor = self._conn.cursor()
+        _sql(cursor, "delete from vmrollup")
+        _sql(cursor, "delete from vmdelta")
+        maxts = _sql(cursor, "select max(ts) from (select max(ts) as ts from vmmonitor{})".format(" union all select max(last_ts) from vmchunk" if self._chunks else "")).fetchone()[0]
+        self._conn.commit()
+        self._lastcounters = {}
+        self._lastrows = {}
+        if maxts is not None:
+            self._buildderived(maxts, True, True, progress_fnc)
+        self._rebuildcatalog()
+        self._rebuildmetadata()
+        return True
+
+    # Builds the catalog of VMs from the samples in the database (e.g. after deleting or modifying samples); the aggregates are obtained in a
+    #   single pass, and then the last sample of each VM is obtained using the index
+    # @param progress_fnc a function that is called as progress_fnc(done, total) after each VM
+    def _rebuildcatalog(self, progress_fnc = None):
+        if not self._catalog:
+            return
+
+        cursor = self._conn.cursor()
+        _sql(cursor, "delete from vm_catalog")
+        samples = "select vmid, ts, {} as last_ts, 1 as samples, length(data) as bytes from {}".format("coalesce(tsend, ts)" if self._repeats else "ts", self._samples)
+        if self._chunks:
+            samples += " union all select vmid, first_ts, last_ts, samples, samples * {:d} from vmchunks".format(_CHUNK_SAMPLE_BYTES)
+        _sql(cursor, "insert into vm_catalog (vmid, first_ts, last_ts, samples, bytes) select vmid, min(ts), max(last_ts), sum(samples), sum(bytes) from ({}) group by vmid".format(samples))
+        vmids = [ vmid for (vmid,) in _sql(cursor, "select vmid from vm_catalog").fetchall() ]
+        for i, vmid in enumerate(vmids):
+            row = _sql(cursor, "select ts, data, tcpu_ns from {} where vmid = ? order by ts desc limit 1".format(self._samples), (vmid,)).fetchone()
+            counters = _sql(cursor, "select {} from {} where vmid = ? and tcpu_ns is not null order by ts desc limit 1".format(_columns(True, self._repeats), self._samples), (vmid,)).fetchone()
+            # The last samples of the VM may be packed in a chunk (they always have valid counters)
+            chunkrow = self._getlastchunkrow(cursor, vmid)
+            if (chunkrow is not None) and ((row is None) or (chunkrow[0] > row[0])):
+                state = "ok"
+            else:
+                (_, data, tcpu_ns) = row
+                state = _state(self._codec.decode(data) if tcpu_ns is None else None, tcpu_ns)
+            if (chunkrow is not None) and ((counters is None) or (chunkrow[0] > counters[0])):
+                counters = chunkrow
+            if counters is None:
+                counters = (None, ) * len(_CATALOG_COUNTERS)
+            else:
+                # The counters of a series of repeated samples are the ones of its last sample (the uptime is not stored for each sample, but it
+                #   increases with the time)
+                (ts, tsend, *counters) = counters
+                if tsend is not None:
+                    counters[-1] += round((tsend - ts) / 1e6)
+                counters = (tsend if tsend is not None else ts, *counters)
+            _sql(cursor, "update vm_catalog set state = ?, {} where vmid = ?".format(", ".join([ "{} = ?".format(c) for c in _CATALOG_COUNTERS ])), (state, *counters, vmid))
+            if callable(progress_fnc) and ((i + 1) % IN_BATCH_SIZE == 0 or i + 1 == len(vmids)):
+                progress_fnc(i + 1, len(vmids))
+        self._conn.commit()
+
+    # Calculates the global values in the metadata table from the catalog of VMs (i.e. it needs the catalog to be up to date)
+    def _rebuildmetadata(self):
+        if not self._metadata:
+            return
+
+        cursor = self._conn.cursor()
+        (first_ts, last_ts, samples) = _sql(cursor, "select min(first_ts), max(last_ts), coalesce(sum(samples), 0) from vm_catalog").fetchone()
+        _sql(cursor, "delete from metadata")
+        cursor.executemany("insert into metadata (key, value) values (?, ?)", [ (key, value) for (key, value) in [ ("first_ts", first_ts), ("last_ts", last_ts), ("samples", samples) ] if value is not None ])
+        self._conn.commit()
+
+    # Obtains a value from the metadata table (None if it is not available)
+    def _getmetadata(self, key):
+        cursor = self._conn.cursor()
+        row = _sql(cursor, "select value from metadata where key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    # The counters of the last samples stored (see _lastcounters), e.g. to move them to another storage
+    def getcachedcounters(self):
+        return dict(self._lastcounters)
+
+    def seedlastcounters(self, lastcounters):
+        for (vmid, counters) in lastcounters.items():
+            if (vmid not in self._lastcounters) or (self._lastcounters[vmid]["ts"] < counters["ts"]):
+                self._lastcounters[vmid] = counters
+
+    # Obtains the counters of the last sample of a VM stored before a moment (see _countersample)
+    # @param ts the epoch (in microseconds); if None, the last sample of the VM
+    # @param fallback whether to use lastcounters_fnc if there is no sample of the VM in the database
+    # @return the counters, or None if there is no sample of the VM
+    def getlastcounters(self, vmid, ts = None, fallback = True):
+        if not self.isConnected():
+            return None
+
+        if ts is None:
+            ts = 2**63 - 1
+        cursor = self._conn.cursor()
+        _sql(cursor, "select {} from {} where vmid = ? and ts < ? and tcpu_ns is not null order by ts desc limit 1".format(_columns(True, self._repeats), self._samples), (vmid, ts))
+        row = cursor.fetchone()
+        if row is not None:
+            (rowts, tsend, *counters) = row
+            # The last sample of a series of repeated samples is the one at tsend (if it is before the moment)
+            row = (tsend if (tsend is not None) and (tsend < ts) else rowts, *counters)
+        chunkrow = self._getlastchunkrow(cursor, vmid, ts)
+        if (chunkrow is not None) and ((row is None) or (chunkrow[0] > row[0])):
+            (chunkts, _, *counters) = chunkrow
+            row = (chunkts, *counters)
+        if row is not None:
+            return _countersample(*row)
+        if fallback and callable(self.lastcounters_fnc):
+            return self.lastcounters_fnc(vmid, ts)
+        return None
+
+    # Obtains the last row of a VM (i.e. the one that the next sample may repeat) as a tuple (ts, tsend, key), where key is obtained with
+    #   _repeatkey; returns None if there is no sample of the VM in the database
+    def _getlastrow(self, vmid):
+        cursor = self._conn.cursor()
+        row = _sql(cursor, "select ts, tsend, data, {} from {} where vmid = ? order by ts desc limit 1".format(", ".join(COUNTER_COLUMNS), self._samples), (vmid,)).fetchone()
+        chunkrow = self._getlastchunkrow(cursor, vmid)
+        if (chunkrow is not None) and ((row is None) or (chunkrow[0] >= row[0])):
+            # The samples packed in a chunk cannot be extended, so the next sample never repeats them
+            return (chunkrow[0], None, None)
+        if row is None:
+            return None
+        (ts, tsend, data, *counters) = row
+        state = _state(self._codec.decode(data) if counters[0] is None else None, counters[0])
+        return (ts, tsend, _repeatkey((vmid, ts, data, *counters), state))
+
+    # Obtains the last sample of a VM packed in the chunks before a moment, as a row (ts, tsend, *counters) (see _chunkrows); returns None if
+    #   there is no such sample
+    # @param ts the epoch (in microseconds); if None, the last sample of the VM
+    def _getlastchunkrow(self, cursor, vmid, ts = None):
+        if not self._chunks:
+            return None
+
+        if ts is None:
+            ts = 2**63 - 1
+        chunk = _sql(cursor, "select {} from vmchunks where vmid = ? and first_ts < ? order by bucket desc limit 1".format(_CHUNK_COLUMNS), (vmid, ts)).fetchone()
+        if chunk is None:
+            return None
+        rows = _chunkrows(chunk, tots = ts - 1)
+        return rows[-1] if len(rows) > 0 else None
+
+    # Iterates over the samples packed in the chunks of the VMs between two epochs (in microseconds; any of them may be None), ordered by vmid
+    #   (see _itervms)
+    # @return a generator of tuples (vmid, rows), where rows are obtained with _chunkrows
+    def _iterchunks(self, fromts, tots, vmids):
+        if not self._chunks:
+            return
+
+        conditions = []
+        params = []
+        if fromts is not None:
+            conditions.append("last_ts >= ?")
+            params.append(fromts)
+        if tots is not None:
+            conditions.append("first_ts <= ?")
+            params.append(tots)
+
+        for (vmid, chunks) in self._itervms("select vmid, {} from vmchunks{{}} order by vmid, bucket".format(_CHUNK_COLUMNS), conditions, tuple(params), vmids,
+                                                lambda *blobs: _chunkrows(blobs, fromts, tots)):
+            rows = [ row for chunk in chunks for row in chunk ]
+            if len(rows) > 0:
+                yield (vmid, rows)
+
+    # Packs the samples of a VM with valid counters stored in vmmonitor between two epochs into the chunks of their periods (along with the
+    #   samples already packed in them), and removes the samples from vmmonitor
+    # @param vm the id of the VM in the dictionary of VMs
+    def _packchunks(self, cursor, vmid, vm, fromts, tots):
+        period = CHUNK_PERIOD * 1000000
+        _sql(cursor, "select id, ts, length(data), {} from vmmonitor where vm = ? and ts >= ? and ts < ? and tcpu_ns is not null and tsend is null order by ts".format(
+            ", ".join(COUNTER_COLUMNS)), (vm, fromts, tots))
+        chunks = {}
+        ids = []
+        bytes = 0
+        for (id, ts, size, *counters) in cursor.fetchall():
+            chunks.setdefault(ts - ts % period, []).append((ts, None, *counters))
+            ids.append((id,))
+            bytes += size or 0
+        if len(ids) == 0:
+            return
+
+        for (bucket, rows) in chunks.items():
+            chunk = _sql(cursor, "select {} from vmchunk where vm = ? and bucket = ?".format(_CHUNK_COLUMNS), (vm, bucket)).fetchone()
+            if chunk is not None:
+                rows = sorted(_chunkrows(chunk) + rows, key = lambda x: x[0])
+            _sql(cursor, "insert or replace into vmchunk (vm, bucket, first_ts, last_ts, samples, {}) values (?, ?, ?, ?, ?, {})".format(_CHUNK_COLUMNS,
+                ", ".join([ "?" ] * (1 + len(COUNTER_COLUMNS)))), (vm, bucket, *_chunkvalues(rows)))
+        cursor.executemany("delete from vmmonitor where id = ?", ids)
+        if self._catalog:
+            _sql(cursor, "update vm_catalog set bytes = bytes - ? + ? where vmid = ?", (bytes, len(ids) * _CHUNK_SAMPLE_BYTES, vmid))
+
+    # Packs the chunks of the VMs that are closed by a batch of samples (i.e. the VM has samples of a later period); the first time that a VM
+    #   is seen, the chunk of its last sample in vmmonitor is packed too (e.g. the monitor was stopped before the period was over)
+    # @param rows the rows that have just been stored (as obtained from _rowvalues)
+    # @return the beginning of the open chunk of each VM, that should be cached once the rows are committed
+    def _closechunks(self, cursor, rows, vmkeys):
+        period = CHUNK_PERIOD * 1000000
+        limits = {}
+        for (vmid, ts, _, *counters) in rows:
+            if counters[0] is not None:
+                (first, last) = limits.get(vmid, (ts, ts))
+                limits[vmid] = (min(first, ts), max(last, ts))
+
+        openchunks = {}
+        for (vmid, (first, last)) in limits.items():
+            bucket = max(last - last % period, self._openchunks.get(vmid, 0))
+            fromts = self._openchunks.get(vmid)
+            if fromts is None:
+                lastts = _sql(cursor, "select max(ts) from vmmonitor where vm = ? and ts < ? and tcpu_ns is not null and tsend is null", (vmkeys[vmid], bucket)).fetchone()[0]
+                fromts = lastts - lastts % period if lastts is not None else bucket
+            # The samples older than the open chunk (e.g. imported from other database) are packed in their chunks too
+            fromts = min(fromts, first - first % period)
+            if fromts < bucket:
+                self._packchunks(cursor, vmid, vmkeys[vmid], fromts, bucket)
+            openchunks[vmid] = bucket
+        return openchunks
+
+    # Packs the open chunks of the VMs (e.g. the shard of a period that is over, that will not receive more samples)
+    def packchunks(self):
+        if (not self.isConnected()) or (not self._chunking) or (not self._chunks):
+            return False
+
         cursor = self._conn.cursor()
-        cursor.execute("select t from vmmonitor order by t desc limit 1")
         try:
-            return datetime.strptime(cursor.fetchone()[0], "%Y-%m-%dT%H:%M:%S.%fZ")
-        except Exception as e:
-            # Just in case the DB is not initialized
+            vmkeys = self._getvmkeys(cursor, self._openchunks.keys())
+            for (vmid, bucket) in self._openchunks.items():
+                self._packchunks(cursor, vmid, vmkeys[vmid], bucket, 2**63 - 1)
+            self._conn.commit()
+        except sqlite3.Error as e:
+            self._conn.rollback()
+            p_error("could not pack the samples: {}".format(e))
+            return False
+
+        self._vmkeys.update(vmkeys)
+        self._openchunks = {}
+        return True
+
+    # Obtains the ids of some VMs in the dictionary of VMs (table vms), adding the VMs that are not in the dictionary yet; the new ids are not
+    #   cached here, because they are only valid if the transaction is committed
+    # @return a dict { uuid: id }
+    def _getvmkeys(self, cursor, uuids):
+        vmkeys = {}
+        missing = []
+        for uuid in dict.fromkeys(uuids):
+            if uuid in self._vmkeys:
+                vmkeys[uuid] = self._vmkeys[uuid]
+            else:
+                missing.append(uuid)
+
+        if len(missing) > 0:
+            cursor.executemany("insert or ignore into vms (uuid) values (?)", [ (uuid,) for uuid in missing ])
+            for i in range(0, len(missing), IN_BATCH_SIZE):
+                batch = missing[i:i + IN_BATCH_SIZE]
+                _sql(cursor, "select uuid, id from vms where uuid in ({})".format(", ".join([ "?" ] * len(batch))), batch)
+                vmkeys.update(cursor.fetchall())
+        return vmkeys
+
+    # Splits a batch of rows into the ones that must be inserted and the ones that repeat the last row of their VM (see dedup)
+    # @param rows, states the rows to store (as obtained from _rowvalues) and their states
+    # @return a tuple (inserts, states, repeats, lastrows): the rows to insert and their states, a dict { (vmid, ts): (rowts, tsend) } with the
+    #   samples that extend the row of the VM that starts at rowts (tsend is the previous end of the row, None if it was a single sample)
+    #   and the last rows of the VMs, that should be cached once the rows are committed
+    def _splitrepeats(self, rows, states):
+        inserts = []
+        insertstates = []
+        repeats = {}
+        lastrows = {}
+        for (row, state) in sorted(zip(rows, states), key = lambda x: (x[0][0], x[0][1])):
+            (vmid, ts, *_) = row
+            key = _repeatkey(row, state)
+            if vmid not in lastrows:
+                lastrows[vmid] = self._lastrows[vmid] if vmid in self._lastrows else self._getlastrow(vmid)
+            last = lastrows[vmid]
+
+            if (last is not None) and (ts <= (last[1] if last[1] is not None else last[0])):
+                # A sample older than the last row of the VM is just stored (e.g. the samples imported from other database)
+                inserts.append(row)
+                insertstates.append(state)
+                continue
+
+            if (last is not None) and (last[2] == key):
+                repeats[(vmid, ts)] = (last[0], last[1])
+                lastrows[vmid] = (last[0], ts, key)
+            else:
+                inserts.append(row)
+                insertstates.append(state)
+                lastrows[vmid] = (ts, None, key)
+        return (inserts, insertstates, repeats, lastrows)
+
+    # Calculates the incremental samples (and the rollups) for the rows that have just been inserted
+    # @param rows the rows inserted, as obtained from _rowvalues (including the ones that repeat the last row of the VM)
+    # @param repeats the samples that extend the last row of the VM (see _splitrepeats); their incremental samples (i.e. without consumption)
+    #   are merged into a single one that spans the whole series
+    # @return the counters of the last sample of each VM, that should be cached once the rows are committed
+    def _updatederived(self, cursor, rows, repeats = {}):
+        lastcounters = {}
+        for (vmid, ts, _, *counters) in sorted(rows, key = lambda x: (x[0], x[1])):
+            if counters[0] is None:
+                continue
+            cur = _countersample(ts, *counters)
+
+            # The previous sample is the one in this batch, the cached one or the one in the database (e.g. after restarting the monitor)
+            prev = lastcounters.get(vmid, self._lastcounters.get(vmid))
+            if (prev is None) or (prev["ts"] >= ts):
+                prev = self.getlastcounters(vmid, ts)
+            if (vmid not in lastcounters) or (lastcounters[vmid]["ts"] < ts):
+                lastcounters[vmid] = cur
+
+            # The consumption since the VM was started is not stored (see _buildderived)
+            if prev is None:
+                continue
+            delta = incremental(prev, cur)
+            if delta is None:
+                p_debug("the counters of vm {} have been reset".format(vmid))
+                continue
+            repeat = repeats.get((vmid, ts))
+            if self._deltas:
+                if (repeat is not None) and (repeat[1] is not None):
+                    _sql(cursor, "update vmdelta set ts = ?, e = e + ?{} where vmid = ? and ts = ?".format(", repeated = repeated + 1" if self._deltarepeats else ""),
+                        (ts, delta["e"], vmid, repeat[1]))
+                if (repeat is None) or (repeat[1] is None) or (cursor.rowcount == 0):
+                    cursor.execute(_INSERT_DELTA, _deltavalues(vmid, ts, delta))
+                    if (repeat is not None) and self._deltarepeats:
+                        cursor.execute(_SET_REPEATED_DELTA, (1, vmid, ts))
+            if self._rollups:
+                cursor.executemany(_UPSERT_ROLLUP, [ (vmid, *values) for values in _rollupbuckets(prev["ts"], ts, delta, repeat is None) ])
+        return lastcounters
+
+    def isConnected(self):
+        return self._conn is not None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # Obtains the files that hold the data of this storage (i.e. the files that should be backed up)
+    def getfilenames(self):
+        return [ self._filename ]
+
+    # Makes a consistent copy of the database in a folder, using the backup API of sqlite3 (i.e. the copy is made in a single step, in a
+    #   read transaction, so the samples stored meanwhile are not included)
+    # @return the filename of the copy (it has the same name than the database)
+    def snapshot(self, folder):
+        if not self.isConnected():
             return None
 
-    # Obtains the min available timestamp (i.e. the first time that the system was started)
-    def getmint(self):
+        filename = os.path.join(folder, os.path.basename(self._filename))
+        conn = sqlite3.connect(filename)
+        try:
+            self._conn.backup(conn)
+            # The copy is not shared with other processes, so it does not need the WAL mode (i.e. it can be opened in read-only mode without
+            #   the -shm file)
+            conn.execute("pragma journal_mode = delete")
+        finally:
+            conn.close()
+        return filename
+
+    # Obtains the amount of samples stored in the database
+    def getcount(self):
+        if not self.isConnected():
+            return 0
+
+        if self._metadata:
+            return self._getmetadata("samples") or 0
+
+        cursor = self._conn.cursor()
+        return _sql(cursor, "select count(*) from vmmonitor").fetchone()[0]
+
+    # Obtains the min or max timestamp (i.e. "min" or "max") in the database, as a datetime object
+    def _getlimitt(self, fnc):
         if not self.isConnected():
             return None
 
+        if self._metadata:
+            ts = self._getmetadata("first_ts" if fnc == "min" else "last_ts")
+            return fromepoch(ts / 1e6) if ts is not None else None
+
         cursor = self._conn.cursor()
-        cursor.execute("select t from vmmonitor order by t asc limit 1")
         try:
-            return datetime.strptime(cursor.fetchone()[0], "%Y-%m-%dT%H:%M:%S.%fZ")
+            if self.getschemaversion() < 3:
+                # The database has not been migrated yet, so there is no epoch column
+                cursor.execute("select {}(t) from vmmonitor".format(fnc))
+                return datetime.strptime(cursor.fetchone()[0], TIME_FORMAT)
+            cursor.execute("select {}(ts) from vmmonitor".format(fnc))
+            return fromepoch(cursor.fetchone()[0] / 1e6)
         except Exception as e:
             # Just in case the DB is not initialized
             return None
 
+    def getmaxt(self):
+        return self._getlimitt("max")
+
+    # Obtains the min available timestamp (i.e. the first time that the system was started)
+    def getmint(self):
+        return self._getlimitt("min")
+
     def savevm(self, vmid, info, t = None):
+        return self.savevms([ (vmid, info, t) ])
+
+    # Stores a batch of samples in a single transaction (i.e. a single sync to disk for the whole batch)
+    # @param batch a list of tuples (vmid, info, t), where t may be None to use the current time of the database
+    # @return True if all the samples have been stored
+    def savevms(self, batch):
         if not self.isConnected():
             return False
 
-        cursor = self._conn.cursor()
-        if t is not None:
-            # if t is integer, convert it to datetime
-            if isinstance(t, int) or isinstance(t, float):
-                t = datetime.fromtimestamp(t)
-            if isinstance(t, datetime):
-                t = t.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            if not isinstance(t, str):
+        valid = True
+        rows = []
+        states = []
+        for (vmid, info, t) in batch:
+            # The timestamp is needed to calculate the epoch, so the current time is obtained here (in UTC, as the default of the database)
+            if t is None:
+                t = datetime.utcnow()
+            ts = _tots(t)
+            if ts is None:
                 p_error("t should be a datetime object, a timestamp or a string in the format %Y-%m-%dT%H:%M:%S.%fZ")
-                return False
-            cursor.execute("insert into vmmonitor (vmid, t, data) values (?, ?, ?)", (vmid, t, json.dumps(info)))
-        else:
-            cursor.execute("insert into vmmonitor (vmid, data) values (?, ?)", (vmid, json.dumps(info)))
-        self._conn.commit()
-        return True
+                valid = False
+                continue
+            rows.append(_rowvalues(vmid, ts, info, self._codec))
+            states.append(_state(info, rows[-1][3]))
+
+        cursor = self._conn.cursor()
+        try:
+            inserts = rows
+            insertstates = states
+            repeats = {}
+            lastrows = {}
+            if self._dedup and self._repeats:
+                (inserts, insertstates, repeats, lastrows) = self._splitrepeats(rows, states)
 
-    def getvmdata(self, vmid, fromDate = None, toDate = None):
+            vmkeys = {}
+            if self._vms:
+                # The rows refer to the VMs by their id in the dictionary of VMs
+                vmkeys = self._getvmkeys(cursor, [ row[0] for row in rows ])
+                cursor.executemany(_INSERT_ROW.format("vm"), [ (vmkeys[row[0]], *row[1:]) for row in inserts ])
+            else:
+                cursor.executemany(_INSERT_ROW.format("vmid"), inserts)
+            if self._catalog:
+                cursor.executemany(_UPSERT_CATALOG, [ _catalogvalues(row, state) for (row, state) in zip(inserts, insertstates) ])
+                # The repeated samples only move the last sample of the VM (and the uptime of its counters, that are otherwise the same)
+                cursor.executemany("update vm_catalog set last_ts = max(last_ts, ?1), \
+                    uptime = case when ?2 is not null and counters_ts < ?1 then ?2 else uptime end, \
+                    counters_ts = case when ?2 is not null and counters_ts < ?1 then ?1 else counters_ts end where vmid = ?3",
+                    [ (row[1], row[-1], row[0]) for row in rows if (row[0], row[1]) in repeats ])
+            if self._metadata and len(rows) > 0:
+                _sql(cursor, _UPSERT_METADATA_MIN, ("first_ts", min(row[1] for row in rows)))
+                _sql(cursor, _UPSERT_METADATA_MAX, ("last_ts", max(row[1] for row in rows)))
+                _sql(cursor, _UPSERT_METADATA_ADD, ("samples", len(inserts)))
+            lastcounters = {}
+            if self._rollups or self._deltas:
+                lastcounters = self._updatederived(cursor, rows, repeats)
+            if len(repeats) > 0:
+                # Each row is extended up to its last repeated sample (once the incremental samples are calculated, because they need the
+                #   previous end of the rows)
+                series = {}
+                for ((vmid, ts), (rowts, _)) in repeats.items():
+                    (tsend, count) = series.get((vmid, rowts), (ts, 0))
+                    series[(vmid, rowts)] = (max(tsend, ts), count + 1)
+                cursor.executemany("update vmmonitor set tsend = ?, repeats = repeats + ? where {} = ? and ts = ?".format("vm" if self._vms else "vmid"),
+                    [ (tsend, count, vmkeys.get(vmid, vmid), rowts) for ((vmid, rowts), (tsend, count)) in series.items() ])
+            openchunks = {}
+            if self._chunking and self._chunks:
+                # Also once the incremental samples are calculated, because they may need the previous samples in vmmonitor
+                openchunks = self._closechunks(cursor, rows, vmkeys)
+            self._conn.commit()
+        except sqlite3.Error as e:
+            self._conn.rollback()
+            p_error("could not store {} samples: {}".format(len(batch), e))
+            return False
+
+        self._vmkeys.update(vmkeys)
+        self._lastrows.update(lastrows)
+        self._openchunks.update(openchunks)
+        self.seedlastcounters(lastcounters)
+        return valid
+
+    # Obtains the samples of one VM in a range of dates
+    # @param numeric if True, the samples only contain the counters (see COUNTER_COLUMNS) and the timestamps, instead of the whole data;
+    #   this is much faster because the data does not need to be decoded
+    def getvmdata(self, vmid, fromDate = None, toDate = None, numeric = False):
         if not self.isConnected():
             return []
 
         cursor = self._conn.cursor()
 
-        if (fromDate is None) and (toDate is None):
-            _sql(cursor, "select t, data from vmmonitor where vmid = ? order by t asc", (vmid,))
-            # cursor.execute("select t, data from vmmonitor where vmid = ? order by t asc", (vmid,))
-        elif (fromDate is None):
-            fromDate = fromDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            _sql(cursor, "select t, data from vmmonitor where vmid = ? and t >= ? order by t asc", (vmid, fromDate))
-        elif (toDate is None):
-            toDate = toDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            _sql(cursor, "select t, data from vmmonitor where vmid = ? and t <= ? order by t asc", (vmid, toDate))
-        else:
-            fromDate = fromDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            toDate = toDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            _sql(cursor, "select t, data from vmmonitor where vmid = ? and t >= ? and t <= ? order by t asc", (vmid, fromDate, toDate))
-            
+        (columns, row_fnc) = self._samplecolumns(numeric)
+        (condition, params) = _timerange(fromDate, toDate, not self._counters)
+        _sql(cursor, "select {} from {} where vmid = ?{} order by {} asc".format(columns, self._samples, " and " + condition if condition != "" else "",
+            "ts" if self._counters else "t"), (vmid, *params))
+
         # TODO: filter the data and return the objects in the right format
-        result = []
-        for (t, data) in cursor.fetchall():
-            data = json.loads(data)
-            data["t"] = t
-            data["s"] = datetime.strptime(t, "%Y-%m-%dT%H:%M:%S.%fZ").timestamp()
-            result.append(data)
-        
-        return result
-        # return [ {"t": datetime.strptime(t, "%Y-%m-%dT%H:%M:%S.%fZ"), "i": json.loads(data)} for (t, data) in cursor.fetchall() ]
+        samples = [ row_fnc(*row) for row in cursor ]
+        for (_, rows) in self._iterchunks(_tots(fromDate) if fromDate is not None else None, _tots(toDate) if toDate is not None else None, [ vmid ]):
+            samples.extend(_chunktosample(row, numeric) for row in rows)
+            samples.sort(key = lambda x: x["s"])
+        return samples
+
+    # The columns to retrieve the samples (see _columns) and the function that converts each row into a sample; the databases that have not
+    #   been migrated to version 3 have neither the epoch nor the counters of the samples, so they are obtained from column t and from the
+    #   payload (using the JSON1 extension of sqlite3, if available, so that the payloads do not need to be decoded in python)
+    def _samplecolumns(self, numeric):
+        if self._counters:
+            if numeric:
+                return ("ts, {}, {}, {}".format(*([ "tsend", "repeats" ] if self._repeats else [ "null", "0" ]), ", ".join(COUNTER_COLUMNS)), _sampletonumeric)
+            return (_columns(False, self._repeats), lambda *row: _rowtodata(*row, self._codec))
+        if not numeric:
+            return ("t, data", lambda t, data: _rowtodata(_strtots(t), None, 0, data, self._codec))
+        if self._json1:
+            return ("t, {}".format(_jsoncolumns(False)), lambda t, *counters: _rowtonumeric(_strtots(t), None, *counters))
+        return ("t, data", lambda t, data: _rowtonumeric(_strtots(t), None, *(_counters(self._codec.decode(data)) or [ None ] * len(COUNTER_COLUMNS))))
+
+    # Iterates over the samples of the VMs in a range of dates, using a single query ordered by (vmid, t) (i.e. it reads the table once)
+    #   and yielding the samples of each VM as soon as the cursor moves to the next VM.
+    # @param vmids the list of VMs to retrieve (None means all the VMs); the VMs are queried in batches of IN_BATCH_SIZE
+    # @return a generator of tuples (vmid, samples), where samples is the same list that getvmdata returns for the VM
+    def iter_window(self, fromDate = None, toDate = None, vmids = None, numeric = False):
+        if not self.isConnected():
+            return
+
+        # The samples stored in vmmonitor and the ones packed in chunks are merged, so both are queried with the VMs in the same order
+        if self._chunks and (vmids is not None):
+            vmids = sorted(set(vmids))
+        (columns, row_fnc) = self._samplecolumns(numeric)
+        (condition, params) = _timerange(fromDate, toDate, not self._counters)
+        samples = self._itervms("select vmid, {} from {}{{}} order by vmid, {}".format(columns, self._samples, "ts" if self._counters else "t"), [ condition ] if condition != "" else [],
+            params, vmids, row_fnc)
+        if self._chunks:
+            chunks = ((vmid, [ _chunktosample(row, numeric) for row in rows ])
+                for (vmid, rows) in self._iterchunks(_tots(fromDate) if fromDate is not None else None, _tots(toDate) if toDate is not None else None, vmids))
+            samples = _mergevms([ samples, chunks ])
+        yield from samples
+
+    # Iterates over the incremental samples of the VMs (i.e. the consumption between each sample and the previous one) in a range of dates;
+    #   only the samples that start and end in the range are included (i.e. the same samples than RawData obtains from iter_window); a series
+    #   of repeated samples (see dedup) is split into that amount of samples, evenly spaced, before
+    # @return a generator of tuples (vmid, samples), where samples are "incremental" samples (see RawData._convert)
+    def iter_deltas(self, fromDate = None, toDate = None, vmids = None):
+        if not self.isConnected():
+            return
+
+        if not self._deltas:
+            yield from self._calculatedeltas(fromDate, toDate, vmids)
+            return
+
+        conditions = []
+        params = []
+        if fromDate is not None:
+            conditions.append("tsbegin >= ?")
+            params.append(_tots(fromDate))
+        if toDate is not None:
+            conditions.append("ts <= ?")
+            params.append(_tots(toDate))
+
+        # The series of repeated samples (see dedup) that overlap the range are included too, and only their samples in the range are kept (see
+        #   _joindeltas); the outdated databases do not have the amount of repeated samples in vmdelta, so the series are included as a single
+        #   sample (that RawData clips to the range), i.e. they end where a row of the samples ends
+        if self._repeats and len(conditions) > 0:
+            if self._deltarepeats:
+                overlap = [ "repeated > 0" ]
+            else:
+                overlap = [ "tcpu_ns = 0", "tdisk = 0", "tnic = 0", "exists (select 1 from {} m where m.vmid = vmdelta.vmid and m.tsend = vmdelta.ts)".format(self._samples) ]
+            overlap_params = []
+            if fromDate is not None:
+                overlap.insert(0, "ts > ?")
+                overlap_params.append(_tots(fromDate))
+            if toDate is not None:
+                overlap.insert(len(overlap_params), "tsbegin < ?")
+                overlap_params.append(_tots(toDate))
+            conditions = [ "(({}) or ({}))".format(" and ".join(conditions), " and ".join(overlap)) ]
+            params = params + overlap_params
+
+        vmsamples = self._itervms("select vmid, ts, tsbegin, e, tcpu_ns, tdisk, tnic, ncpu, ndisk, nnic{} from vmdelta{{}} order by vmid, ts".format(
+            ", repeated" if self._deltarepeats else ""), conditions, tuple(params), vmids, _deltatosample)
+        if self._deltarepeats:
+            fromts = _tots(fromDate) / 1e6 if fromDate is not None else None
+            tots = _tots(toDate) / 1e6 if toDate is not None else None
+            vmsamples = ((vmid, _joindeltas(samples, fromts, tots)) for (vmid, samples) in vmsamples)
+
+        # An outdated database (i.e. read-only) may have the sample since the VM was started, which would be the first one of the VM
+        if self._basedeltas:
+            vmsamples = ((vmid, samples[1:] if self._isbasedelta(vmid, samples[0]) else samples) for (vmid, samples) in vmsamples)
+        yield from ((vmid, samples) for (vmid, samples) in vmsamples if len(samples) > 0)
 
+    # Checks whether an incremental sample of vmdelta is the consumption of a VM since it was started (see _migrate_v13)
+    def _isbasedelta(self, vmid, sample):
+        first = self._firstcounters(self._conn.cursor(), vmid)
+        return (first is not None) and (abs(round(sample.s * 1e6) - first[0]) <= 1) and (abs(round(sample.S * 1e6) - (first[0] - first[1] * 1000000)) <= 1)
+
+    # Calculates the incremental samples of the VMs from their samples, for the databases that do not have table vmdelta (i.e. they could not
+    #   be migrated to version 7); the samples are filtered in the same way than iter_deltas
+    def _calculatedeltas(self, fromDate, toDate, vmids):
+        fromts = _tots(fromDate) / 1e6 if fromDate is not None else None
+        tots = _tots(toDate) / 1e6 if toDate is not None else None
+
+        if (not self._counters) and self._json1:
+            vmsamples = self._iterjsondeltas(fromDate, toDate, vmids)
+        else:
+            # The first incremental sample is the consumption since the VM was started (see basesample), that is not included
+            vmsamples = ((vmid, RawData._convert(samples)[1:]) for (vmid, samples) in self.iter_window(fromDate, toDate, vmids, True))
+
+        for (vmid, samples) in vmsamples:
+            samples = [ x for x in samples if ((fromts is None) or (x["S"] >= fromts)) and ((tots is None) or (x["s"] <= tots)) ]
+            if len(samples) > 0:
+                yield (vmid, samples)
+
+    # Calculates the incremental samples of the VMs of a database that has not been migrated to version 3, in a single query: the counters
+    #   are extracted from the payloads using the JSON1 extension (see _JSON_COUNTERS) and each sample is subtracted from the previous valid
+    #   sample of the VM using window functions, so that most of the work of RawData._convert is made by sqlite3
+    def _iterjsondeltas(self, fromDate, toDate, vmids):
+        (condition, params) = _timerange(fromDate, toDate, True)
+        query = "select vmid, t, {}, {} from (select vmid, t, {} from vmmonitor{{}}) window w as (partition by vmid order by t) order by vmid, t".format(
+            ", ".join([ "{0} - lag({0}) over w".format(x) for x in [ "tcpu_ns", "tdisk", "tnic" ] ]), ", ".join(COUNTER_COLUMNS), _jsoncolumns())
+
+        # The samples without valid information are discarded before extracting the counters (i.e. the condition is evaluated once)
+        for (vmid, rows) in self._itervms(query, [ _JSON_VALID ] + ([ condition ] if condition != "" else []), params, vmids, lambda *row: row):
+            samples = []
+            s0 = None
+            for (t, dcpu, ddisk, dnic, tcpu_ns, tdisk, tnic, ncpu, ndisk, nnic, uptime) in rows:
+                s = _strtots(t) / 1e6
+                # The first sample of the VM is the consumption since the VM was started (see basesample), that is not included
+                if s0 is None:
+                    s0 = s
+                    continue
+                if (dcpu < 0) or (ddisk < 0) or (dnic < 0):
+                    p_debug("the counters of VM {} were reset at {}".format(vmid, t))
+                else:
+                    samples.append(Sample(s, ncpu, ndisk, nnic, dcpu * 1e-9, ddisk, dnic, s - s0, s0))
+                s0 = s
+            yield (vmid, samples)
+
+    # Iterates over the consumption of the VMs in a range of dates, aggregated in the buckets of one of the resolutions of the rollups
+    #   (the buckets that are partially in the range are also included)
+    # @param resolution one of the keys of ROLLUP_RESOLUTIONS
+    # @return a generator of tuples (vmid, samples), where samples are "incremental" samples (see RawData._convert), one per bucket
+    def iter_rollups(self, fromDate = None, toDate = None, vmids = None, resolution = "hour"):
+        if not self.isConnected():
+            return
+
+        # The databases without rollups (i.e. they could not be migrated to version 6) are analyzed using the incremental samples
+        if not self._rollups:
+            yield from self.iter_deltas(fromDate, toDate, vmids)
+            return
+
+        resolution = ROLLUP_RESOLUTIONS[resolution]
+        conditions = [ "resolution = ?", "e > 0" ]
+        params = [ resolution ]
+        if fromDate is not None:
+            conditions.append("bucket > ?")
+            params.append(_tots(fromDate) - resolution * 1000000)
+        if toDate is not None:
+            conditions.append("bucket <= ?")
+            params.append(_tots(toDate))
+
+        yield from self._itervms("select vmid, tsbegin, e, tcpu_ns, tdisk, tnic, ncpu, ndisk, nnic from vmrollup{} order by vmid, bucket", conditions, tuple(params), vmids, _rolluptosample)
+
+    # Runs a query that returns rows ordered by vmid, and yields the rows of each VM (converted using row_fnc) as soon as the cursor moves to
+    #   the next VM.
+    # @param query the query, whose first column is the vmid; it includes a {} placeholder that is replaced by the "where" clause
+    # @param vmids the list of VMs to retrieve (None means all the VMs); the VMs are queried in batches of IN_BATCH_SIZE
+    def _itervms(self, query, conditions, params, vmids, row_fnc):
+        if vmids is None:
+            batches = [ None ]
+        else:
+            vmids = list(dict.fromkeys(vmids))
+            batches = [ vmids[i:i + IN_BATCH_SIZE] for i in range(0, len(vmids), IN_BATCH_SIZE) ]
+
+        for batch in batches:
+            batchconditions = list(conditions)
+            batchparams = params
+            if batch is not None:
+                batchconditions.append("vmid in ({})".format(", ".join([ "?" ] * len(batch))))
+                batchparams = (*params, *batch)
+
+            cursor = self._conn.cursor()
+            _sql(cursor, query.format(" where " + " and ".join(batchconditions) if len(batchconditions) > 0 else ""), batchparams)
+
+            vmid = None
+            samples = []
+            for (_vmid, *row) in cursor:
+                if _vmid != vmid:
+                    if len(samples) > 0:
+                        yield (vmid, samples)
+                    vmid = _vmid
+                    samples = []
+                samples.append(row_fnc(*row))
+
+            if len(samples) > 0:
+                yield (vmid, samples)
+
+    # Obtains the VMs that have samples in a range of dates (i.e. their first sample is before the end of the range and their last sample is
+    #   after the beginning of the range); they are obtained from the catalog of VMs, if available
+    # @return the sorted list of vmids
     def getvms(self, fromDate = None, toDate = None):
         if not self.isConnected():
             return []
 
+        if self._catalog:
+            return [ entry["vmid"] for entry in self.getcatalog(fromDate, toDate) ]
+
         cursor = self._conn.cursor()
-        # cursor.execute("select vmid from vmmonitor group by vmid")
+        (condition, params) = _timerange(fromDate, toDate, not self._counters)
+        _sql(cursor, "select distinct vmid from {}{} order by vmid".format(self._samples, " where " + condition if condition != "" else ""), params)
+        return [ x for (x,) in cursor ]
 
-        if (fromDate is None) and (toDate is None):
-            _sql(cursor, "select vmid from vmmonitor group by vmid")
-            # cursor.execute("select t, data from vmmonitor where vmid = ? order by t asc", (vmid,))
-        elif (fromDate is None):
-            fromDate = fromDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            _sql(cursor, "select vmid from vmmonitor group by vmid where t >= ?", (fromDate))
-        elif (toDate is None):
-            toDate = toDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            _sql(cursor, "select vmid from vmmonitor group by vmid where t <= ?", (toDate))
-        else:
-            fromDate = fromDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            toDate = toDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            _sql(cursor, "select vmid from vmmonitor group by vmid where t >= ? and t <= ?", (fromDate, toDate))
+    # Obtains the entries of the catalog of VMs (see _catalogtoentry) of the VMs that have samples in a range of dates, ordered by vmid
+    def getcatalog(self, fromDate = None, toDate = None):
+        if (not self.isConnected()) or (not self._catalog):
+            return []
 
-        return [ x for (x,) in cursor ]
+        conditions = []
+        params = []
+        if fromDate is not None:
+            conditions.append("last_ts >= ?")
+            params.append(_tots(fromDate))
+        if toDate is not None:
+            conditions.append("first_ts <= ?")
+            params.append(_tots(toDate))
+
+        cursor = self._conn.cursor()
+        _sql(cursor, "select vmid, first_ts, last_ts, samples, bytes, state, {} from vm_catalog{} order by vmid".format(", ".join(_CATALOG_COUNTERS), " where " + " and ".join(conditions) if len(conditions) > 0 else ""), tuple(params))
+        return [ _catalogtoentry(*row) for row in cursor.fetchall() ]
 
     def delete(self, keepFromDate, keepToDate):
         if not self.isConnected():
@@ -163,54 +1791,202 @@ class Storage:
 
         cursor = self._conn.cursor()
 
+        # A series of repeated samples is kept if its last sample is in the range
+        tsend = "coalesce(tsend, ts)" if self._repeats else "ts"
         if (keepFromDate is None) and (keepToDate is None):
             raise Exception("refusing to wipe the whole database")
         elif (keepFromDate is None):
-            keepToDate = keepToDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            _sql(cursor, "delete from vmmonitor where t > ?", (keepToDate,))
+            _sql(cursor, "delete from vmmonitor where ts > ?", (_tots(keepToDate),))
         elif (keepToDate is None):
-            keepFromDate = keepFromDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            _sql(cursor, "delete from vmmonitor where t < ?", (keepFromDate,))
+            _sql(cursor, "delete from vmmonitor where {} < ?".format(tsend), (_tots(keepFromDate),))
         else:
-            keepFromDate = keepFromDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            keepToDate = keepToDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            _sql(cursor, "delete from vmmonitor where t < ? or t > ?", (keepFromDate, keepToDate))
+            _sql(cursor, "delete from vmmonitor where {} < ? or ts > ?".format(tsend), (_tots(keepFromDate), _tots(keepToDate)))
+        rowcount = cursor.rowcount
+        self._lastrows = {}
+        if self._chunks:
+            rowcount += self._deletechunks(cursor, _tots(keepFromDate) if keepFromDate is not None else None, _tots(keepToDate) if keepToDate is not None else None)
+
+        # The incremental samples and the buckets of the rollups that are completely out of the range are also discarded
+        if self._deltas:
+            if keepFromDate is not None:
+                _sql(cursor, "delete from vmdelta where tsbegin < ?", (_tots(keepFromDate),))
+            if keepToDate is not None:
+                _sql(cursor, "delete from vmdelta where ts > ?", (_tots(keepToDate),))
+        if self._rollups:
+            if keepFromDate is not None:
+                _sql(cursor, "delete from vmrollup where bucket + resolution * 1000000 <= ?", (_tots(keepFromDate),))
+            if keepToDate is not None:
+                _sql(cursor, "delete from vmrollup where bucket > ?", (_tots(keepToDate),))
 
         self._conn.commit()
-        return cursor.rowcount
+        if rowcount > 0:
+            self._rebuildcatalog()
+            self._rebuildmetadata()
+        return rowcount
+
+    # Deletes the samples packed in chunks that are out of a range of epochs (in microseconds; any of them may be None); the chunks that are
+    #   partially in the range are packed again with the samples in the range
+    # @return the amount of samples deleted
+    def _deletechunks(self, cursor, fromts, tots):
+        conditions = []
+        params = []
+        if fromts is not None:
+            conditions.append("first_ts < ?")
+            params.append(fromts)
+        if tots is not None:
+            conditions.append("last_ts > ?")
+            params.append(tots)
+
+        deleted = 0
+        for (id, samples, *blobs) in _sql(cursor, "select id, samples, {} from vmchunk where {}".format(_CHUNK_COLUMNS, " or ".join(conditions)), tuple(params)).fetchall():
+            rows = _chunkrows(blobs, fromts, tots)
+            deleted += samples - len(rows)
+            if len(rows) == 0:
+                _sql(cursor, "delete from vmchunk where id = ?", (id,))
+            else:
+                _sql(cursor, "update vmchunk set first_ts = ?, last_ts = ?, samples = ?, {} where id = ?".format(", ".join([ "{} = ?".format(c) for c in [ "ts", *COUNTER_COLUMNS ] ])),
+                    (*_chunkvalues(rows), id))
+        return deleted
 
     def vaccuum(self):
         if not self.isConnected():
             return False
 
         cursor = self._conn.cursor()
+        # The full vacuum also switches the existing databases to incremental auto vacuum (see incrementalvacuum)
+        _sql(cursor, "pragma auto_vacuum = incremental")
         _sql(cursor, "vacuum")
         self._conn.commit()
         return True
 
+    # Deletes a batch of the samples older than a date (i.e. the oldest ones), along with their incremental samples and rollups, and updates
+    #   the catalog of VMs and the metadata; each batch is a short transaction, so the monitor is not blocked
+    # @param batchsize the maximum amount of samples to delete
+    # @return the amount of samples deleted (0 means that there are no more samples older than the date)
+    def expire(self, keepFromDate, batchsize = MAINTENANCE_BATCH_SIZE):
+        if not self.isConnected():
+            return 0
+
+        keepts = _tots(keepFromDate)
+        cursor = self._conn.cursor()
+        if self._repeats:
+            # A series of repeated samples is kept until its last sample expires
+            rows = _sql(cursor, "select id, vmid, ts, tsend, length(data) from {} where ts < ? and coalesce(tsend, ts) < ? order by ts limit ?".format(self._samples), (keepts, keepts, batchsize)).fetchall()
+        else:
+            rows = _sql(cursor, "select id, vmid, ts, null, length(data) from {} where ts < ? order by ts limit ?".format(self._samples), (keepts, batchsize)).fetchall()
+
+        # A chunk is deleted once its last sample expires; the batch is limited by the amount of samples in the chunks
+        chunks = []
+        if self._chunks:
+            count = 0
+            for chunk in _sql(cursor, "select id, vmid, first_ts, last_ts, samples from vmchunks where last_ts < ? order by last_ts limit ?", (keepts, batchsize)).fetchall():
+                if (count > 0) and (count + chunk[4] > batchsize):
+                    break
+                chunks.append(chunk)
+                count += chunk[4]
+        if (len(rows) == 0) and (len(chunks) == 0):
+            return 0
+
+        vms = {}
+        for (_, vmid, _, _, size) in rows:
+            (count, bytes) = vms.get(vmid, (0, 0))
+            vms[vmid] = (count + 1, bytes + (size or 0))
+            self._lastrows.pop(vmid, None)
+        for (_, vmid, _, _, samples) in chunks:
+            (count, bytes) = vms.get(vmid, (0, 0))
+            vms[vmid] = (count + samples, bytes + samples * _CHUNK_SAMPLE_BYTES)
+
+        try:
+            cursor.executemany("delete from vmmonitor where id = ?", [ (id,) for (id, _, _, _, _) in rows ])
+            cursor.executemany("delete from vmchunk where id = ?", [ (id,) for (id, _, _, _, _) in chunks ])
+            if self._deltas:
+                # The incremental sample of a series of repeated samples ends at its last sample
+                cursor.executemany("delete from vmdelta where vmid = ? and ts = ?", [ (vmid, ts) for (_, vmid, ts, _, _) in rows ] +
+                    [ (vmid, tsend) for (_, vmid, _, tsend, _) in rows if tsend is not None ])
+                cursor.executemany("delete from vmdelta where vmid = ? and ts >= ? and ts <= ?", [ (vmid, first_ts, last_ts) for (_, vmid, first_ts, last_ts, _) in chunks ])
+            if self._rollups:
+                cursor.executemany("delete from vmrollup where vmid = ? and bucket + resolution * 1000000 <= ?", [ (vmid, keepts) for vmid in vms ])
+            if self._catalog:
+                first_ts = "(select min(ts) from {} where vmid = vm_catalog.vmid)".format(self._samples)
+                if self._chunks:
+                    first_ts = "min(coalesce({0}, {1}), coalesce({1}, {0}))".format(first_ts, "(select min(first_ts) from vmchunks where vmid = vm_catalog.vmid)")
+                cursor.executemany("update vm_catalog set samples = samples - ?, bytes = bytes - ?, first_ts = coalesce({}, first_ts) where vmid = ?".format(first_ts),
+                    [ (count, bytes, vmid) for (vmid, (count, bytes)) in vms.items() ])
+                _sql(cursor, "delete from vm_catalog where samples <= 0")
+            self._conn.commit()
+        except sqlite3.Error as e:
+            self._conn.rollback()
+            p_error("could not delete the expired samples: {}".format(e))
+            return 0
+
+        self._rebuildmetadata()
+        return len(rows) + sum(samples for (_, _, _, _, samples) in chunks)
+
+    # Returns up to a number of free pages to the filesystem (only if the database uses incremental auto vacuum)
+    # @return the amount of free pages that remain in the database
+    def incrementalvacuum(self, pages = MAINTENANCE_VACUUM_PAGES):
+        if not self.isConnected():
+            return 0
+
+        cursor = self._conn.cursor()
+        if _sql(cursor, "pragma auto_vacuum").fetchone()[0] != 2:
+            return 0
+        # The pragma frees a page in each step of the statement, and execute only makes the first step (executescript runs it to the end)
+        self._conn.commit()
+        cursor.executescript("pragma incremental_vacuum({:d})".format(int(pages)))
+        return _sql(cursor, "pragma freelist_count").fetchone()[0]
+
+    # Moves the content of the WAL file to the database, without waiting for the readers (so the WAL file does not grow without limit)
+    def checkpoint(self):
+        if not self.isConnected():
+            return False
+
+        cursor = self._conn.cursor()
+        (busy, _, _) = _sql(cursor, "pragma wal_checkpoint(PASSIVE)").fetchone()
+        return busy == 0
+
+    # Updates the statistics used by the query planner (limiting the amount of rows examined in each index, so that it is fast)
+    def analyze(self):
+        if not self.isConnected():
+            return False
+
+        cursor = self._conn.cursor()
+        _sql(cursor, "pragma analysis_limit = {:d}".format(ANALYSIS_LIMIT))
+        _sql(cursor, "analyze")
+        self._conn.commit()
+        return True
+
     def filterdata(self, filter_fnc, pre_fnc = None, post_fnc = None):
         if not self.isConnected():
             return False
 
         cursor1 = self._conn.cursor()
 
-        _sql(cursor1, "select count(*) from vmmonitor")
-        count = cursor1.fetchone()[0]
+        count = self.getcount()
 
         if (callable(pre_fnc)):
             pre_fnc(count)
 
+        # The filter obtains the epoch of each sample (in seconds), as the samples obtained from iter_window
         cursor2 = self._conn.cursor()
-        _sql(cursor1, "select id, vmid, t, data from vmmonitor")
-        for (id, vmid, t, data) in cursor1:
-            data = json.loads(data)
-            data = filter_fnc(vmid, t, data)
+        _sql(cursor1, "select id, vmid, ts, data from {}".format(self._samples))
+        for (id, vmid, ts, data) in cursor1:
+            data = self._codec.decode(data)
+            data = filter_fnc(vmid, ts / 1e6, data)
             if data is not None:
-                cursor2.execute("update vmmonitor set data = ? where id = ?", (json.dumps(data), id))
+                # The counters are updated too, just in case that the filter modified them
+                (_, _, data, *counters) = _rowvalues(vmid, ts, data, self._codec)
+                cursor2.execute("update vmmonitor set data = ?, {} where id = ?".format(", ".join([ "{} = ?".format(c) for c in COUNTER_COLUMNS ])), (data, *counters, id))
             else:
                 cursor2.execute("delete from vmmonitor where id = ?", (id, ))
 
         self._conn.commit()
+        self._lastrows = {}
+        # The filter may have modified or deleted the counters of the samples, so the incremental samples and the rollups are calculated again
+        #   (along with the catalog of VMs and the metadata)
+        if not self.rebuildderived():
+            self._rebuildcatalog()
+            self._rebuildmetadata()
 
         if (callable(post_fnc)):
             post_fnc()
@@ -225,28 +2001,85 @@ class Storage:
             return False
         
         cursor1 = self._conn.cursor()
-        cursor2 = other_storage._conn.cursor()
 
-        _sql(cursor1, "select count(*) from vmmonitor")
-        count = cursor1.fetchone()[0]
+        count = self.getcount()
 
         if (callable(pre_fnc)):
             pre_fnc(count)
 
-        _sql(cursor1, "select id, vmid, t, data from vmmonitor")
-        for (id, vmid, t, data) in cursor1:
-            data = json.loads(data)
-            data = filter_fnc(vmid, t, data)
+        # The samples are stored using the API of the other storage (it may be a sharded storage), in batches
+        batch = []
+        _sql(cursor1, "select id, vmid, ts, data from {}".format(self._samples))
+        for (id, vmid, ts, data) in cursor1:
+            data = self._codec.decode(data)
+            data = filter_fnc(vmid, ts / 1e6, data)
             if data is not None:
-                cursor2.execute("insert into vmmonitor (vmid, t, data) values (?, ?, ?)", (vmid, t, json.dumps(data)))
+                batch.append((vmid, data, ts / 1e6))
+            if len(batch) >= MIGRATION_BATCH_SIZE:
+                other_storage.savevms(batch)
+                batch = []
+
+        # The samples packed in chunks have no data, so they are stored (without filtering them) as payloads with the same counters
+        for (vmid, rows) in self._iterchunks(None, None, None):
+            for row in rows:
+                batch.append((vmid, _countersinfo(*row), row[0] / 1e6))
+                if len(batch) >= MIGRATION_BATCH_SIZE:
+                    other_storage.savevms(batch)
+                    batch = []
 
-        other_storage._conn.commit()
+        if len(batch) > 0:
+            other_storage.savevms(batch)
 
         if (callable(post_fnc)):
             post_fnc()
 
         return True
 
+    # Trains a zstd dictionary using a random set of samples from the database and stores it, so that it is used to compress the new
+    #   payloads (the payloads compressed with older dictionaries are still readable)
+    # @return the id of the new dictionary
+    def traindictionary(self, samplecount = 5000, size = DICTIONARY_SIZE):
+        if not self.isConnected():
+            return None
+
+        cursor = self._conn.cursor()
+        _sql(cursor, "select data from vmmonitor order by random() limit ?", (samplecount,))
+        data = train_dictionary([ self._codec.decode(data) for (data,) in cursor.fetchall() ], size)
+        _sql(cursor, "insert into payload_dictionaries (data) values (?)", (data,))
+        self._conn.commit()
+
+        dictid = cursor.lastrowid
+        self._codec.add_dictionary(dictid, data)
+        return dictid
+
+    # Re-encodes the data of all the samples in the database, using a (new) codec that is also used for the new samples from now on
+    # @param progress_fnc a function that is called as progress_fnc(done, total) after each batch
+    def recompress(self, codec, batchsize = MIGRATION_BATCH_SIZE, progress_fnc = None):
+        if not self.isConnected():
+            return False
+
+        self._codec = PayloadCodec(codec, self._codec.dictionaries)
+
+        cursor = self._conn.cursor()
+        total = self.getcount()
+        done = 0
+        lastid = 0
+        while True:
+            _sql(cursor, "select id, data from vmmonitor where id > ? order by id limit ?", (lastid, batchsize))
+            rows = cursor.fetchall()
+            if len(rows) == 0:
+                break
+            cursor.executemany("update vmmonitor set data = ? where id = ?", [ (self._codec.encode(self._codec.decode(data)), id) for (id, data) in rows ])
+            self._conn.commit()
+            lastid = rows[-1][0]
+            done += len(rows)
+            if callable(progress_fnc):
+                progress_fnc(done, total)
+
+        # The size of the data has changed
+        self._rebuildcatalog()
+        return True
+
 def remove_unneeded_data(data):
     if ('cpu_details' not in data) or ('disk_details' not in data) or ('nic_details' not in data):
         return None
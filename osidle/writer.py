@@ -0,0 +1,176 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import queue
+import threading
+import time
+from datetime import datetime
+from .common import p_error, p_warning, p_debugv
+
+# The maximum amount of blocks of samples (i.e. calls to savevms) that can be waiting to be stored
+DEFAULT_QUEUE_SIZE = 100
+
+# The samples are committed when this amount of samples are pending, or when the oldest pending sample has waited COMMIT_INTERVAL seconds
+DEFAULT_COMMIT_SIZE = 500
+DEFAULT_COMMIT_INTERVAL = 10
+
+# The amount of seconds that savevms waits for room in the queue before dropping the samples (i.e. backpressure for the monitor)
+DEFAULT_PUT_TIMEOUT = 1
+
+# The amount of seconds that the writer waits for samples before calling idle_fnc again, when it has work pending
+IDLE_BUSY_TIMEOUT = 0.05
+
+# Stores the samples queued by savevms from its own thread, which is the only one that uses the storage, so the monitors do not wait for the disk
+class StorageWriter:
+    # @param idle_fnc called as idle_fnc(storage) when the queue is empty (e.g. Maintenance.run); it returns True if it has work pending
+    def __init__(self, storage, queue_size = DEFAULT_QUEUE_SIZE, commit_size = DEFAULT_COMMIT_SIZE, commit_interval = DEFAULT_COMMIT_INTERVAL,
+                    put_timeout = DEFAULT_PUT_TIMEOUT, idle_fnc = None):
+        self._storage = storage
+        self._idle_fnc = idle_fnc
+        self._queue = queue.Queue(max(1, queue_size))
+        self._commit_size = max(1, commit_size)
+        self._commit_interval = commit_interval
+        self._put_timeout = put_timeout
+        self._thread = None
+        self._version = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+
+        # The counters of the writer (see getstats)
+        self._written = 0
+        self._commits = 0
+        self._failed = 0
+        self._blocked = 0
+        self._dropped = 0
+        self._maxdepth = 0
+
+    # Starts the thread of the writer and connects to the storage (from that thread)
+    # @return True if the storage could be connected
+    def start(self, upgrade = False):
+        if self._thread is not None:
+            return self.isConnected()
+        self._thread = threading.Thread(target = self._run, args = (upgrade, ), name = "osidle-writer", daemon = True)
+        self._thread.start()
+        self._ready.wait()
+        return self.isConnected()
+
+    def isConnected(self):
+        return self._thread is not None and self._thread.is_alive() and self._storage.isConnected()
+
+    # The version of the schema of the storage, as obtained once it was connected (from the thread of the writer)
+    def getschemaversion(self):
+        return self._version
+
+    # Stops the thread, once all the queued samples have been stored
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    # Queues the samples (vmid, info, t) to be stored; if t is None, it is the time in which the sample is queued
+    # @return True if the samples were queued; False if they were dropped because the queue is full
+    def savevms(self, batch):
+        batch = [ (vmid, info, datetime.utcnow() if t is None else t) for (vmid, info, t) in batch ]
+        if len(batch) == 0:
+            return True
+
+        try:
+            self._queue.put_nowait(batch)
+        except queue.Full:
+            # The writer is not keeping pace with the monitor: wait a bit, but do not stall the monitoring
+            self._blocked += 1
+            try:
+                self._queue.put(batch, timeout = self._put_timeout)
+            except queue.Full:
+                self._dropped += len(batch)
+                p_warning("the queue of the writer is full; {} samples dropped".format(len(batch)))
+                return False
+
+        self._maxdepth = max(self._maxdepth, self._queue.qsize())
+        return True
+
+    def savevm(self, vmid, info, t = None):
+        return self.savevms([ (vmid, info, t) ])
+
+    # @return the depth of the queue (queued, maxqueued), the samples stored (written, commits) or lost (failed, dropped) and the waits for room (blocked)
+    def getstats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "maxqueued": self._maxdepth,
+            "written": self._written,
+            "commits": self._commits,
+            "failed": self._failed,
+            "blocked": self._blocked,
+            "dropped": self._dropped,
+        }
+
+    def _run(self, upgrade):
+        try:
+            self._storage.connect(upgrade)
+            if self._storage.isConnected():
+                self._version = self._storage.getschemaversion()
+        except Exception as e:
+            p_error("the writer could not connect to the storage: {}".format(e))
+        finally:
+            self._ready.set()
+
+        if not self._storage.isConnected():
+            return
+
+        pending = []
+        t_first = None
+        idle_busy = False
+        while True:
+            stopping = self._stop.is_set()
+
+            # Wait for new samples, but not further than the moment in which the pending samples need to be committed
+            timeout = IDLE_BUSY_TIMEOUT if idle_busy else 1
+            if t_first is not None:
+                timeout = min(timeout, max(0, t_first + self._commit_interval - time.monotonic()))
+            try:
+                pending.extend(self._queue.get(timeout = timeout))
+                if t_first is None:
+                    t_first = time.monotonic()
+            except queue.Empty:
+                if callable(self._idle_fnc) and not stopping:
+                    idle_busy = self._idle_fnc(self._storage)
+
+            if len(pending) > 0:
+                if (len(pending) >= self._commit_size) or (time.monotonic() - t_first >= self._commit_interval) or (stopping and self._queue.empty()):
+                    self._flush(pending)
+                    pending = []
+                    t_first = None
+
+            if stopping and self._queue.empty() and len(pending) == 0:
+                break
+
+        self._storage.close()
+
+    # Stores the pending samples in a single transaction; they are not retried, as a sharded storage may have stored part of them
+    def _flush(self, pending):
+        p_debugv("storing {} samples ({} blocks queued)".format(len(pending), self._queue.qsize()))
+        try:
+            stored = self._storage.savevms(pending)
+        except Exception as e:
+            p_error("failed to store the samples: {}".format(e))
+            stored = False
+
+        if stored:
+            self._written += len(pending)
+            self._commits += 1
+        else:
+            self._failed += len(pending)
@@ -154,6 +154,11 @@ if __name__ == "__main__":
             'xlsxwriter',
             'paramiko'
         ],
+    extras_require={
+            'zstd': [ 'zstandard' ],
+            'orjson': [ 'orjson' ],
+            'numpy': [ 'numpy' ],
+        },
     cmdclass={
         'install': PostInstallCommand,
         'develop': PostDevelopCommand,
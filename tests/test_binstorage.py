@@ -0,0 +1,132 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import time
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from osidle.storage import Storage
+from osidle.binstorage import BinaryStorage
+
+# The samples start at 2025-10-09T00:00:00Z
+BASE = 1759968000
+PERIOD = 300
+
+# The ranges of dates used to compare the engines: all the samples, a range whose borders are in the middle of the samples, and ranges
+#   out of the samples
+RANGES = [
+    (None, None),
+    (datetime(2025, 10, 9, 3, 17), datetime(2025, 10, 9, 9, 41)),
+    (datetime(2025, 10, 9, 12), datetime(2025, 10, 10)),
+    (datetime(2025, 10, 8), datetime(2025, 10, 8, 12)),
+]
+
+def _payload(state, uptime, cpu, disk, nic):
+    return {"state": state, "driver": "libvirt", "hypervisor": "kvm", "uptime": uptime, "num_cpus": 2, "num_disks": 1, "num_nics": 1,
+        "cpu_details": [{"id": k, "time": cpu[k], "utilisation": None} for k in range(2)],
+        "disk_details": [{"read_bytes": disk[0], "read_requests": 1, "write_bytes": disk[1], "write_requests": 2, "errors_count": -1}],
+        "nic_details": [{"mac_address": "fa:16:3e:00:00:01", "rx_octets": nic[0], "tx_octets": nic[1], "rx_drop": 0, "tx_drop": 0}],
+        "memory_details": {"maximum": 2, "used": 1}}
+
+# Generates the samples of some VMs during a day: a busy VM, an idle VM, a VM that is rebooted (so its counters are reset) and a VM that
+#   is not running from time to time (so some samples have no counters)
+def _samples():
+    random.seed(1)
+    samples = []
+    for v in range(4):
+        vmid = "00000000-0000-0000-0000-{:012d}".format(v)
+        cpu = [0, 0]; disk = [0, 0]; nic = [0, 0]; uptime = 1000
+        for i in range(288):
+            t = datetime(2025, 10, 9) + timedelta(seconds = i * PERIOD + v)
+            if (v == 3) and (i % 50 == 7):
+                samples.append((vmid, {"conflictingRequest": {"code": 409, "message": "Cannot 'get_diagnostics' instance"}}, t))
+                continue
+            if (v == 2) and (i == 150):
+                cpu = [0, 0]; disk = [0, 0]; nic = [0, 0]; uptime = 0
+            uptime += PERIOD
+            if v != 1:
+                cpu = [c + random.randint(0, PERIOD * 10**9) for c in cpu]
+                disk = [d + random.randint(0, 4096 * PERIOD) for d in disk]
+                nic = [n + random.randint(0, 8192 * PERIOD) for n in nic]
+            samples.append((vmid, _payload("running", uptime, cpu, disk, nic), t))
+    return samples
+
+@pytest.fixture
+def storages(tmp_path):
+    samples = _samples()
+    sqlite = Storage(str(tmp_path / "osidled.db"))
+    sqlite.connect()
+    sqlite.savevms(samples)
+    binary = BinaryStorage(str(tmp_path / "osidled.bin"))
+    binary.connect()
+    binary.savevms(samples)
+    yield (sqlite, binary)
+    sqlite.close()
+    binary.close()
+
+def _asdicts(iterator):
+    return { vmid: [ s if isinstance(s, dict) else s.asdict() for s in samples ] for (vmid, samples) in iterator }
+
+def _rounded(vms):
+    return { vmid: [ { k: round(v, 6) if isinstance(v, float) else v for (k, v) in s.items() } for s in samples ] for (vmid, samples) in vms.items() }
+
+@pytest.mark.parametrize("fromDate,toDate", RANGES)
+def test_window(storages, fromDate, toDate):
+    (sqlite, binary) = storages
+    assert _asdicts(binary.iter_window(fromDate, toDate, None, True)) == _asdicts(sqlite.iter_window(fromDate, toDate, None, True))
+
+@pytest.mark.parametrize("fromDate,toDate", RANGES)
+def test_deltas(storages, fromDate, toDate):
+    (sqlite, binary) = storages
+    assert _rounded(_asdicts(binary.iter_deltas(fromDate, toDate))) == _rounded(_asdicts(sqlite.iter_deltas(fromDate, toDate)))
+
+@pytest.mark.parametrize("resolution", [ "hour", "day" ])
+@pytest.mark.parametrize("fromDate,toDate", RANGES)
+def test_rollups(storages, fromDate, toDate, resolution):
+    (sqlite, binary) = storages
+    assert _rounded(_asdicts(binary.iter_rollups(fromDate, toDate, None, resolution))) == \
+        _rounded(_asdicts(sqlite.iter_rollups(fromDate, toDate, None, resolution)))
+
+# The timestamps of the samples are in UTC (see common.toepoch), so the epochs stored by both engines do not depend on the timezone of the host
+@pytest.mark.parametrize("timezone", [ "UTC", "Europe/Madrid", "America/New_York" ])
+def test_timezone(tmp_path, monkeypatch, timezone):
+    monkeypatch.setenv("TZ", timezone)
+    time.tzset()
+    try:
+        samples = _samples()
+        for storage in [ Storage(str(tmp_path / "osidled.db")), BinaryStorage(str(tmp_path / "osidled.bin")) ]:
+            storage.connect()
+            storage.savevms(samples)
+            assert storage.getmint() == datetime(2025, 10, 9)
+            (_, window) = next(storage.iter_window(datetime(2025, 10, 9), datetime(2025, 10, 9, 0, 5), None, True))
+            assert [ s["s"] for s in window ] == [ BASE, BASE + PERIOD ]
+            storage.close()
+    finally:
+        monkeypatch.delenv("TZ")
+        time.tzset()
+
+# The options of the sqlite engine are ignored (and reported) by the binary engine, which still stores the samples
+@pytest.mark.parametrize("option", [ { "codec": "zlib" }, { "dedup": True }, { "chunks": True } ])
+def test_unsupported(tmp_path, capsys, option):
+    storage = BinaryStorage(str(tmp_path / "osidled.bin"), **option)
+    assert "does not support the {} option".format(next(iter(option))) in capsys.readouterr().err
+    storage.connect()
+    storage.savevms(_samples())
+    assert _asdicts(storage.iter_window(None, None, None, True)).keys() == { "00000000-0000-0000-0000-{:012d}".format(v) for v in range(4) }
+    storage.close()
+    BinaryStorage(str(tmp_path / "osidled.bin"))
+    assert capsys.readouterr().err == ""
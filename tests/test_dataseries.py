@@ -0,0 +1,114 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import copy
+import math
+import random
+import types
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from osidle.dataseries import DataSeries, ArrayDataSeries, basicstats, arraybasicstats, _fragments, _arrayfragments, _filter_saturation, \
+    _arrayfilter_saturation
+
+THRESHOLD_DISK = 4096
+THRESHOLD_NIC = 8192
+SEEDS = range(300)
+
+# Generates a random series of rates, i.e. rows (e, cpu, disk, nic) as obtained from RawData.rates: the series may be empty or have a
+#   single sample, and the values may be repeated, NaN, or over the thresholds (even in chains of samples, so that the saturation is carried)
+def _series(seed):
+    rng = random.Random(seed)
+    n = rng.choice([ 0, 1, 2, 3, 10, 200 ])
+    kind = rng.choice([ "random", "constant", "saturated", "nan" ])
+    constant = [ rng.choice([ 0.0, 1.0, 4096.0 ]) for _ in range(3) ]
+
+    def value(threshold):
+        if kind == "saturated" and rng.random() < 0.7:
+            return rng.uniform(threshold, 20 * threshold)
+        return rng.choice([ rng.choice([ 0.0, 1.0, 0.5, float(threshold), 1e6 ]), rng.uniform(0, 2 * threshold), rng.expovariate(1 / threshold) ])
+
+    rows = []
+    for _ in range(n):
+        e = rng.choice([ 60.0, 30.5, 1.0, rng.uniform(0.1, 300) ])
+        if kind == "constant":
+            rows.append([ e, *constant ])
+            continue
+        row = [ e, rng.uniform(0, 4) if rng.random() < 0.8 else rng.choice([ 0.0, 1.0 ]), value(THRESHOLD_DISK), value(THRESHOLD_NIC) ]
+        if kind == "nan" and rng.random() < 0.1:
+            row[rng.randint(1, 3)] = math.nan
+        rows.append(row)
+    return rows
+
+# The result of a function (repr, so that NaN values are compared too) or the type of the exception that it raises
+def _outcome(fnc, *args, **kwargs):
+    try:
+        return repr(fnc(*args, **kwargs))
+    except Exception as e:
+        return type(e).__name__
+
+def _array(rows):
+    return np.asarray(rows, dtype = np.float64).reshape(-1, 4)
+
+class _RawData:
+    def __init__(self, rows, ncpu):
+        self._rows = rows
+        self.ncpu = ncpu
+        self.ndisk = 1
+        self.nnic = 1
+
+    def rates(self):
+        return copy.deepcopy(self._rows)
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_basicstats(seed):
+    rows = _series(seed)
+    for vpos in (1, 2, 3):
+        assert _outcome(arraybasicstats, _array(rows), 0, vpos) == _outcome(basicstats, rows, 0, vpos)
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_fragments(seed):
+    rows = _series(seed)
+    for (vpos, up) in [ (1, 4), (2, THRESHOLD_DISK), (3, THRESHOLD_NIC), (2, None) ]:
+        for tpos in (0, None):
+            assert _outcome(_arrayfragments, _array(rows), tpos, vpos, 0, up, 10) == _outcome(_fragments, rows, tpos, vpos, 0, up, 10)
+    assert _outcome(_arrayfragments, _array(rows), 0, 1) == _outcome(_fragments, rows, 0, 1)
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_filter_saturation(seed):
+    rows = _series(seed)
+    for eps in (0.0, 0.25, 0.5, 1.0):
+        serie = copy.deepcopy(rows)
+        _filter_saturation(serie, 0, 2, THRESHOLD_DISK, eps)
+        _filter_saturation(serie, 0, 3, THRESHOLD_NIC, eps)
+        array = _array(rows)
+        _arrayfilter_saturation(array, 0, 2, THRESHOLD_DISK, eps)
+        _arrayfilter_saturation(array, 0, 3, THRESHOLD_NIC, eps)
+        assert repr(array.tolist()) == repr([ [ float(x) for x in row ] for row in serie ])
+
+@pytest.mark.parametrize("level", [ "softer", "soft", "medium", "hard" ])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_scores(seed, level):
+    rows = _series(seed)
+    args = types.SimpleNamespace(threshold_disk = THRESHOLD_DISK, threshold_nic = THRESHOLD_NIC, level = level, epsilon_softer = 0.85,
+        epsilon_soft = 0.85, epsilon_medium = 0.75, epsilon_hard = 0.25)
+    rawdata = _RawData(rows, random.Random(seed).randint(1, 8))
+
+    def evaluate(cls):
+        series = cls(rawdata, args)
+        return (series.stats, series.evaluation, [ [ float(x) for x in row ] for row in series._data_series ])
+    assert _outcome(evaluate, ArrayDataSeries) == _outcome(evaluate, DataSeries)
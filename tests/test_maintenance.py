@@ -0,0 +1,97 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from osidle.maintenance import Maintenance
+from osidle.storage import Storage, MAINTENANCE_VACUUM_PAGES
+
+DAY = 86400
+
+def _payload(i):
+    return {"state": "running", "uptime": 1000 + i, "num_cpus": 1, "num_disks": 1, "num_nics": 1, "padding": "x" * 1000,
+        "cpu_details": [{"id": 0, "time": 10**9 * i, "utilisation": None}],
+        "disk_details": [{"read_bytes": 100 * i, "read_requests": i, "write_bytes": 100 * i, "write_requests": i, "errors_count": -1}],
+        "nic_details": [{"mac_address": "fa:16:3e:00:00:01", "rx_octets": 200 * i, "tx_octets": 200 * i, "rx_drop": 0, "tx_drop": 0}]}
+
+# A database with 10 VMs sampled every 5 minutes during the last 4 days (the timestamps of the samples are in UTC)
+@pytest.fixture
+def storage(tmp_path):
+    storage = Storage(str(tmp_path / "osidled.db"))
+    storage.connect()
+    now = datetime.utcnow()
+    for vm in range(10):
+        vmid = "00000000-0000-0000-0000-{:012d}".format(vm)
+        storage.savevms([ (vmid, _payload(i), now - timedelta(minutes = 5 * i)) for i in range(4 * 288) ])
+    yield storage
+    storage.close()
+
+def _count(storage):
+    return storage._conn.execute("select count(*) from vmmonitor").fetchone()[0]
+
+def _pages(storage):
+    return storage._conn.execute("pragma page_count").fetchone()[0]
+
+# A vacuum that records the free pages of the database before it is made, and the ones that it leaves
+def _spyvacuum(storage, calls):
+    vacuum = storage.incrementalvacuum
+    def incrementalvacuum(*args, **kwargs):
+        before = storage._conn.execute("pragma freelist_count").fetchone()[0]
+        after = vacuum(*args, **kwargs)
+        calls.append((before, after))
+        return after
+    storage.incrementalvacuum = incrementalvacuum
+
+# A step with time enough deletes all the samples older than the retention and returns the free pages to the filesystem
+def test_run(storage):
+    total = _count(storage)
+    pages = _pages(storage)
+    calls = []
+    _spyvacuum(storage, calls)
+
+    maintenance = Maintenance(retention = 2 * DAY, batchsize = 500, checkpoint_interval = 0, analyze_interval = 0, step_time = 30)
+    t0 = time.monotonic()
+    pending = maintenance.run(storage)
+    assert time.monotonic() - t0 < 30
+
+    # The samples of the last 2 days are kept (the one at the border may have expired while the step was running)
+    assert total == 10 * 4 * 288
+    assert 10 * 576 <= _count(storage) <= 10 * 577
+    assert storage.getmint() >= datetime.utcnow() - timedelta(days = 2, minutes = 1)
+    assert len(calls) == 1
+    (before, after) = calls[0]
+    assert (before > 0) and (after == max(0, before - MAINTENANCE_VACUUM_PAGES))
+    assert _pages(storage) < pages
+    assert pending == (after > 0)
+
+# A step that has no time to delete all the expired samples stops once the step time is over, and the next steps continue the work
+def test_run_step_time(storage):
+    total = _count(storage)
+    maintenance = Maintenance(retention = 2 * DAY, batchsize = 10, checkpoint_interval = 0, analyze_interval = 0, step_time = 0.05)
+    t0 = time.monotonic()
+    assert maintenance.run(storage)
+    assert time.monotonic() - t0 < 0.05 + 0.5
+    first = total - _count(storage)
+    assert 0 < first < total - 10 * 577
+
+    steps = 1
+    while maintenance.run(storage):
+        steps += 1
+    assert steps > 1
+    assert 10 * 576 <= _count(storage) <= 10 * 577
+    assert storage.getmint() >= datetime.utcnow() - timedelta(days = 2, minutes = 1)
@@ -0,0 +1,369 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import os
+import sys
+import json
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from osidle.common import toepoch
+from osidle.storage import Storage, SCHEMA_VERSION, TIME_FORMAT, remove_unneeded_data
+from osidle.sharding import newStorage
+from osidle.rawdata import RawData
+from osidle.packdb import osidle_packdb
+from osidle.analysis import osidle_analysis
+
+PERIOD = 300
+
+def _payload(state, uptime, cpu, disk, nic):
+    return {"state": state, "driver": "libvirt", "hypervisor": "kvm", "uptime": uptime, "num_cpus": 2, "num_disks": 1, "num_nics": 2,
+        "cpu_details": [{"id": k, "time": cpu[k], "utilisation": None} for k in range(2)],
+        "disk_details": [{"read_bytes": disk[0], "read_requests": 1, "write_bytes": disk[1], "write_requests": 2, "errors_count": -1}],
+        # The second NIC has no MAC address, so it is discarded when the database is minimized (see remove_unneeded_data)
+        "nic_details": [{"mac_address": "fa:16:3e:00:00:01", "rx_octets": nic[0], "tx_octets": nic[1], "rx_drop": 0, "tx_drop": 0},
+            {"rx_octets": nic[0], "tx_octets": nic[1]}],
+        "memory_details": {"maximum": 2, "used": 1}}
+
+# Generates the samples of some VMs during two days from 2025-10-09T12:00:00Z: busy VMs, an idle VM, a VM that is rebooted and a VM that
+#   is not running from time to time (so some samples have no counters)
+def _samples():
+    random.seed(1)
+    samples = []
+    for v in range(4):
+        vmid = "00000000-0000-0000-0000-{:012d}".format(v)
+        cpu = [0, 0]; disk = [0, 0]; nic = [0, 0]; uptime = 1000
+        for i in range(288):
+            t = datetime(2025, 10, 9, 12) + timedelta(seconds = i * PERIOD + v)
+            if (v == 3) and (i % 50 == 7):
+                samples.append((vmid, {"conflictingRequest": {"code": 409, "message": "Cannot 'get_diagnostics' instance"}}, t))
+                continue
+            if (v == 2) and (i == 150):
+                cpu = [0, 0]; disk = [0, 0]; nic = [0, 0]; uptime = 0
+            uptime += PERIOD
+            if v != 1:
+                cpu = [c + random.randint(0, PERIOD * 10**9) for c in cpu]
+                disk = [d + random.randint(0, 4096 * PERIOD) for d in disk]
+                nic = [n + random.randint(0, 8192 * PERIOD) for n in nic]
+            samples.append((vmid, _payload("running", uptime, cpu, disk, nic), t))
+    return samples
+
+def _asdicts(iterator):
+    return { vmid: [ { k: round(v, 6) if isinstance(v, float) else v for (k, v) in s.asdict().items() } for s in samples ] for (vmid, samples) in iterator }
+
+# The incremental samples calculated from the samples in the database (i.e. what RawData obtains from iter_window)
+def _windowdeltas(storage):
+    return _asdicts((vmid, RawData._convert(samples)[1:]) for (vmid, samples) in storage.iter_window(None, None, None, True))
+
+def _newstorage(filename, sharding, samples, engine = None):
+    storage = newStorage(filename, sharding = sharding, engine = engine)
+    storage.connect()
+    storage.savevms(samples)
+    storage.close()
+
+# Generates the samples of some VMs that are idle most of the time (so most of their samples are repeated, see Storage dedup), taken at regular
+#   intervals from 2025-10-09T00:00:00Z; the VMs have bursts of consumption over the thresholds, followed by idle periods
+def _idlesamples():
+    random.seed(2)
+    samples = []
+    for v in range(4):
+        vmid = "00000000-0000-0000-0000-{:012d}".format(v)
+        cpu = [0, 0]; disk = [0, 0]; nic = [0, 0]; uptime = 1000
+        for i in range(288):
+            t = datetime(2025, 10, 9) + timedelta(seconds = i * PERIOD + v)
+            uptime += PERIOD
+            if ((v % 2 == 0) and (i % 40 < 5)) or ((v == 1) and (100 <= i < 110)):
+                cpu = [c + random.randint(0, PERIOD * 10**9) for c in cpu]
+                disk = [d + random.randint(0, 10**8) for d in disk]
+                nic = [n + random.randint(0, 10**8) for n in nic]
+            samples.append((vmid, _payload("shutoff" if v == 3 else "running", uptime, cpu, disk, nic), t))
+    return samples
+
+@pytest.mark.parametrize("fromDate,toDate", [ (None, None), (datetime(2025, 10, 9, 3, 17), datetime(2025, 10, 9, 9, 41)),
+    (datetime(2025, 10, 9, 7), datetime(2025, 10, 9, 8)) ])
+def test_dedup(tmp_path, fromDate, toDate):
+    samples = _idlesamples()
+    storages = []
+    for dedup in [ False, True ]:
+        storage = Storage(str(tmp_path / "osidled-{}.db".format(dedup)), dedup = dedup)
+        storage.connect()
+        # The samples are stored in several batches, so that the series of repeated samples are extended
+        for i in range(0, len(samples), 100):
+            storage.savevms(samples[i:i + 100])
+        storages.append(storage)
+
+    (storage, dedup) = storages
+    assert dedup.getcount() < storage.getcount() / 2
+    # The series of repeated samples are split into the samples that were merged, so the analysis obtains the same samples
+    assert _asdicts(dedup.iter_deltas(fromDate, toDate)) == _asdicts(storage.iter_deltas(fromDate, toDate))
+    for resolution in [ "hour", "day" ]:
+        assert _asdicts(dedup.iter_rollups(fromDate, toDate, None, resolution)) == _asdicts(storage.iter_rollups(fromDate, toDate, None, resolution))
+    if fromDate is None:
+        assert _windowdeltas(dedup) == _windowdeltas(storage)
+    # The incremental samples calculated again from the samples in the database are the same than the ones calculated when they were stored
+    deltas = _asdicts(dedup.iter_deltas(fromDate, toDate))
+    dedup.rebuildderived()
+    assert _asdicts(dedup.iter_deltas(fromDate, toDate)) == deltas
+    for storage in storages:
+        storage.close()
+
+@pytest.mark.parametrize("sharding", [ "none", "daily" ])
+def test_minimize(tmp_path, monkeypatch, sharding):
+    samples = _samples()
+    _newstorage(str(tmp_path / "osidled.db"), sharding, samples)
+    # The same samples, minimized before storing them
+    _newstorage(str(tmp_path / "minimized.db"), sharding, [ (vmid, remove_unneeded_data(info), t) for (vmid, info, t) in samples
+        if remove_unneeded_data(info) is not None ])
+
+    monkeypatch.setattr(sys, "argv", [ "osidle-dbpack", "-d", str(tmp_path / "osidled.db"), "--minimize", "-y", "-n", "-q" ])
+    osidle_packdb()
+
+    storage = newStorage(str(tmp_path / "osidled.db"), readonly = True)
+    storage.connect()
+    expected = newStorage(str(tmp_path / "minimized.db"), readonly = True)
+    expected.connect()
+    deltas = _asdicts(storage.iter_deltas())
+    assert deltas == _windowdeltas(storage)
+    assert deltas == _asdicts(expected.iter_deltas())
+    for resolution in [ "hour", "day" ]:
+        assert _asdicts(storage.iter_rollups(None, None, None, resolution)) == _asdicts(expected.iter_rollups(None, None, None, resolution))
+    assert storage.getcatalog() == expected.getcatalog()
+    storage.close()
+    expected.close()
+
+# The minimized database is a single file (or folder) of the same engine than the database, even if the database is sharded; the binary
+#   engine does not keep the data of the samples, so it only discards the samples without counters
+@pytest.mark.parametrize("sharding,engine", [ ("none", "sqlite"), ("daily", "sqlite"), ("none", "binary") ])
+def test_minimize_to(tmp_path, monkeypatch, sharding, engine):
+    samples = _samples()
+    _newstorage(str(tmp_path / "osidled.db"), sharding, samples, engine)
+    _newstorage(str(tmp_path / "expected.db"), "none", [ (vmid, info if engine == "binary" else remove_unneeded_data(info), t)
+        for (vmid, info, t) in samples if remove_unneeded_data(info) is not None ], engine)
+
+    monkeypatch.setattr(sys, "argv", [ "osidle-dbpack", "-d", str(tmp_path / "osidled.db"), "--minimize-to", str(tmp_path / "minimized.db"),
+        "-y", "-n", "-q" ])
+    osidle_packdb()
+
+    assert os.path.isdir(tmp_path / "minimized.db") == (engine == "binary")
+    assert not any(name.startswith("minimized-") for name in os.listdir(tmp_path))
+    storage = newStorage(str(tmp_path / "minimized.db"), readonly = True)
+    storage.connect()
+    expected = newStorage(str(tmp_path / "expected.db"), readonly = True)
+    expected.connect()
+    assert _asdicts(storage.iter_deltas()) == _asdicts(expected.iter_deltas())
+    assert storage.getcount() == expected.getcount()
+    storage.close()
+    expected.close()
+
+# The catalog of VMs and the metadata of the database after removing samples are the same than the ones of a database with just the samples
+#   that were kept (a VM whose samples are all removed is no longer in the catalog); with daily shards, whole files are removed too
+@pytest.mark.parametrize("sharding", [ "none", "daily" ])
+@pytest.mark.parametrize("operation", [ "delete", "expire" ])
+def test_catalog_after_removing(tmp_path, sharding, operation):
+    samples = _samples() + [ ("00000000-0000-0000-0000-000000000004", _payload("running", 1000 + i * PERIOD, [ i * 10**9 ] * 2, [ i, i ], [ i, i ]),
+        datetime(2025, 10, 9, 12) + timedelta(seconds = i * PERIOD)) for i in range(24) ]
+    if operation == "delete":
+        (keepFromDate, keepToDate) = (datetime(2025, 10, 9, 18, 2, 30), datetime(2025, 10, 10, 6, 2, 30))
+    else:
+        (keepFromDate, keepToDate) = (datetime(2025, 10, 10, 3, 2, 30), None)
+    kept = [ (vmid, info, t) for (vmid, info, t) in samples if (t >= keepFromDate) and ((keepToDate is None) or (t <= keepToDate)) ]
+    _newstorage(str(tmp_path / "osidled.db"), sharding, samples)
+    _newstorage(str(tmp_path / "expected.db"), sharding, kept)
+
+    storage = newStorage(str(tmp_path / "osidled.db"))
+    storage.connect()
+    if operation == "delete":
+        storage.delete(keepFromDate, keepToDate)
+    else:
+        while storage.expire(keepFromDate, 100) > 0:
+            pass
+    expected = newStorage(str(tmp_path / "expected.db"), readonly = True)
+    expected.connect()
+
+    assert len(expected.getcatalog()) == 4
+    assert storage.getcatalog() == expected.getcatalog()
+    assert storage.getvms() == expected.getvms()
+    assert (storage.getcount(), storage.getmint(), storage.getmaxt()) == (len(kept), expected.getmint(), expected.getmaxt())
+    assert (storage.getmint(), storage.getmaxt()) == (min(t for (_, _, t) in kept), max(t for (_, _, t) in kept))
+    storage.close()
+    expected.close()
+
+# The samples are packed in the chunk of their hour (the sample at 12:00:00 opens the chunk of 12:00) whatever the batches in which they are
+#   stored, and the open hour is kept in vmmonitor; the monitor is restarted while an hour is open, and the chunk is packed once a sample
+#   of the next hour is stored
+@pytest.mark.parametrize("batchsize", [ 1, 7, 40 ])
+def test_chunks_hour_boundary(tmp_path, batchsize):
+    # The samples of two VMs from 10:50:00 to 13:10:02
+    samples = sorted([ (vmid, info, t - timedelta(hours = 1, minutes = 10)) for (vmid, info, t) in _samples()
+        if (vmid[-1] in "02") and (t < datetime(2025, 10, 9, 14, 25)) ], key = lambda s: s[2])
+    storages = []
+    for chunks in [ False, True ]:
+        filename = str(tmp_path / "osidled-{}.db".format(chunks))
+        storage = Storage(filename, chunks = chunks)
+        storage.connect()
+        restarted = False
+        for i in range(0, len(samples), batchsize):
+            batch = samples[i:i + batchsize]
+            storage.savevms(batch)
+            if (not restarted) and (datetime(2025, 10, 9, 12, 30) <= batch[-1][2] < datetime(2025, 10, 9, 13)):
+                restarted = True
+                storage.close()
+                storage = Storage(filename, chunks = chunks)
+                storage.connect()
+        storages.append(storage)
+
+    (storage, chunked) = storages
+    hour = 3600 * 1000000
+    expected = []
+    for (vmid, offset) in [ ("00000000-0000-0000-0000-000000000000", 0), ("00000000-0000-0000-0000-000000000002", 2) ]:
+        for (h, first, last, count) in [ (10, (10, 50), (10, 55), 2), (11, (11, 0), (11, 55), 12), (12, (12, 0), (12, 55), 12) ]:
+            expected.append((vmid, int(toepoch(datetime(2025, 10, 9, h))) * 1000000, int(toepoch(datetime(2025, 10, 9, *first, offset))) * 1000000,
+                int(toepoch(datetime(2025, 10, 9, *last, offset))) * 1000000, count))
+    assert chunked._conn.execute("select vmid, bucket, first_ts, last_ts, samples from vmchunks order by vmid, bucket").fetchall() == expected
+    # The samples of 13:00 are not packed yet
+    assert chunked._conn.execute("select count(*), min(ts) from vmmonitor").fetchone() == (6, int(toepoch(datetime(2025, 10, 9, 13))) * 1000000)
+    assert chunked.getcount() == storage.getcount() == len(samples)
+
+    for (fromDate, toDate) in [ (None, None), (datetime(2025, 10, 9, 11, 30), datetime(2025, 10, 9, 12, 5)), (datetime(2025, 10, 9, 12),
+            datetime(2025, 10, 9, 13)), (datetime(2025, 10, 9, 11, 59, 59), datetime(2025, 10, 9, 12, 0, 1)), (datetime(2025, 10, 9, 12, 55, 1),
+            datetime(2025, 10, 9, 13, 0, 1)) ]:
+        assert dict(chunked.iter_window(fromDate, toDate, None, True)) == dict(storage.iter_window(fromDate, toDate, None, True))
+        assert _asdicts(chunked.iter_deltas(fromDate, toDate)) == _asdicts(storage.iter_deltas(fromDate, toDate))
+    for resolution in [ "hour", "day" ]:
+        assert _asdicts(chunked.iter_rollups(None, None, None, resolution)) == _asdicts(storage.iter_rollups(None, None, None, resolution))
+    storage.close()
+    chunked.close()
+
+# Creates a database with the original layout (i.e. schema version 1), as the first versions of the monitor stored the samples
+def _legacydb(filename, samples):
+    conn = sqlite3.connect(filename)
+    conn.execute("create table vmmonitor (id integer PRIMARY KEY AUTOINCREMENT, t datetime DEFAULT (STRFTIME('%Y-%m-%dT%H:%M:%fZ', 'NOW')), \
+        vmid varchar(36) NOT NULL, data text)")
+    conn.executemany("insert into vmmonitor (vmid, t, data) values (?, ?, ?)", [ (vmid, t.strftime(TIME_FORMAT), json.dumps(info)) for (vmid, info, t) in samples ])
+    conn.commit()
+    conn.close()
+
+def _rounded(value):
+    if isinstance(value, dict):
+        return { k: _rounded(v) for (k, v) in value.items() }
+    if isinstance(value, list):
+        return [ _rounded(v) for v in value ]
+    return round(value, 6) if isinstance(value, float) else value
+
+# The report of the analysis of a database (the stats are compared up to the rounding of the floats, because the incremental samples of
+#   the outdated databases are calculated from the samples instead of being read from the database)
+def _analysis(monkeypatch, capsys, filename, *args):
+    monkeypatch.setattr(sys, "argv", [ "osidle", "-d", filename, "-q", "-T", "end", "-f", "json", "--full-report", *args ])
+    osidle_analysis()
+    return _rounded(json.loads(capsys.readouterr().out.strip().split("\n")[-1]))
+
+def test_migrate(tmp_path, monkeypatch, capsys):
+    samples = _samples()
+    filename = str(tmp_path / "osidled.db")
+    _legacydb(filename, samples)
+    _newstorage(str(tmp_path / "current.db"), "none", samples)
+
+    # The monitor does not migrate a database with samples (see osidle-dbpack --migrate), but it creates the new ones with the current schema
+    for (name, version) in [ ("osidled.db", 1), ("new.db", SCHEMA_VERSION) ]:
+        storage = Storage(str(tmp_path / name))
+        storage.connect()
+        assert storage.getschemaversion() == version
+        storage.close()
+
+    analysis = _analysis(monkeypatch, capsys, filename)
+    ranges = [ ("-F", "2025-10-10T00:00:00", "-T", "2025-10-10T06:30:00"), ("-i", "00000000-0000-0000-0000-000000000002") ]
+    partial = [ _analysis(monkeypatch, capsys, filename, *r) for r in ranges ]
+
+    monkeypatch.setattr(sys, "argv", [ "osidle-dbpack", "-d", filename, "--migrate", "-y", "-n", "-q" ])
+    osidle_packdb()
+    storage = Storage(filename, readonly = True)
+    storage.connect()
+    assert storage.getschemaversion() == SCHEMA_VERSION
+    storage.close()
+
+    # The analysis of the migrated database is the same than the one of the original database and the one of a database that stored the
+    #   samples using the current schema
+    assert _analysis(monkeypatch, capsys, filename) == analysis
+    assert _analysis(monkeypatch, capsys, str(tmp_path / "current.db")) == analysis
+    assert [ _analysis(monkeypatch, capsys, filename, *r) for r in ranges ] == partial
+
+def test_cluster(tmp_path):
+    # The samples of the VMs are stored interleaved, as the monitor stores them (the samples of the idle VM are repeated)
+    samples = sorted(_samples(), key = lambda x: x[2])
+    (first, rest) = (samples[:800], samples[800:])
+    storages = []
+    for name in [ "osidled.db", "expected.db" ]:
+        storage = Storage(str(tmp_path / name), dedup = True)
+        storage.connect()
+        for i in range(0, len(first), 40):
+            storage.savevms(first[i:i + 40])
+        storages.append(storage)
+    (storage, expected) = storages
+
+    # The monitor keeps on storing samples (extending the repeated samples that have already been copied) and expiring the old ones while
+    #   the table is copied
+    monitor = Storage(str(tmp_path / "osidled.db"), dedup = True)
+    monitor.connect()
+    steps = []
+    def progress(done, total):
+        steps.append(done)
+        if len(steps) == 2:
+            for s in [ monitor, expected ]:
+                s.savevms(rest[:200])
+                s.expire(datetime(2025, 10, 9, 14))
+        if len(steps) == 5:
+            for s in [ monitor, expected ]:
+                s.savevms(rest[200:])
+
+    conn = sqlite3.connect(str(tmp_path / "osidled.db"))
+    count = conn.execute("select count(*) from vmmonitor").fetchone()[0]
+    storage.cluster(50, progress)
+    monitor.close()
+    rows = conn.execute("select vm, ts from vmmonitor order by id").fetchall()
+    assert conn.execute("select count(*) from sqlite_master where name like 'vmmonitor_cluster%'").fetchone()[0] == 0
+    conn.close()
+    # The rows copied in batches are sorted (the rows modified or inserted meanwhile are at the end)
+    assert len(steps) > 5
+    assert rows[:count // 2] == sorted(rows[:count // 2])
+    assert rows != sorted(rows)
+    assert storage.getcount() == expected.getcount()
+    window = lambda s: { vmid: samples for (vmid, samples) in s.iter_window() }
+    assert window(storage) == window(expected)
+    assert _asdicts(storage.iter_deltas()) == _asdicts(expected.iter_deltas())
+    assert storage.getcatalog() == expected.getcatalog()
+    for s in storages:
+        s.close()
+
+# The counters extracted from the payloads by sqlite3 (see JSON1_PUSHDOWN) are the same than the ones obtained decoding them in python
+@pytest.mark.parametrize("fromDate,toDate", [ (None, None), (datetime(2025, 10, 9, 15, 17), datetime(2025, 10, 10, 9, 41)) ])
+def test_json1(tmp_path, fromDate, toDate):
+    filename = str(tmp_path / "osidled.db")
+    _legacydb(filename, _samples())
+    storage = Storage(filename, readonly = True)
+    storage.connect()
+    results = []
+    for json1 in [ False, True ]:
+        storage._json1 = json1
+        results.append((
+            { vmid: samples for (vmid, samples) in storage.iter_window(fromDate, toDate, None, True) },
+            storage.getvmdata("00000000-0000-0000-0000-000000000003", fromDate, toDate, True),
+            _asdicts(storage.iter_deltas(fromDate, toDate))))
+    storage.close()
+    assert len(results[0][0]) == 4
+    # The incremental samples are the same up to the rounding of the floats (sqlite3 subtracts the counters before they are converted)
+    assert results[0] == results[1]
@@ -0,0 +1,88 @@
+#
+#    Copyright 2022 - Carlos A. <https://github.com/dealfonso>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+import threading
+from datetime import datetime, timedelta
+
+from osidle.storage import Storage
+from osidle.writer import StorageWriter
+
+def _payload(i):
+    return {"state": "running", "uptime": 1000 + i, "num_cpus": 1, "num_disks": 1, "num_nics": 1,
+        "cpu_details": [{"id": 0, "time": 10**9 * i, "utilisation": None}],
+        "disk_details": [{"read_bytes": 100 * i, "read_requests": i, "write_bytes": 100 * i, "write_requests": i, "errors_count": -1}],
+        "nic_details": [{"mac_address": "fa:16:3e:00:00:01", "rx_octets": 200 * i, "tx_octets": 200 * i, "rx_drop": 0, "tx_drop": 0}]}
+
+# A block of samples of a VM, taken every 5 minutes from the sample first
+def _block(vm, first, count):
+    return [ ("00000000-0000-0000-0000-{:012d}".format(vm), _payload(i), datetime(2025, 10, 9) + timedelta(minutes = 5 * i))
+        for i in range(first, first + count) ]
+
+def _stored(filename):
+    storage = Storage(filename, readonly = True)
+    storage.connect()
+    result = { vmid: [ s["s"] for s in samples ] for (vmid, samples) in storage.iter_window(None, None, None, True) }
+    storage.close()
+    return result
+
+# A storage that stores the samples only once the test allows it, so that the queue of the writer gets full
+class _SlowStorage(Storage):
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.storing = threading.Event()
+        self.release = threading.Event()
+
+    def savevms(self, batch):
+        self.storing.set()
+        self.release.wait()
+        return super().savevms(batch)
+
+# The samples waiting to be committed (neither the size nor the interval are reached) are stored when the writer is stopped
+def test_flush_on_stop(tmp_path):
+    filename = str(tmp_path / "osidled.db")
+    writer = StorageWriter(Storage(filename), commit_size = 1000, commit_interval = 3600)
+    assert writer.start()
+    for vm in range(3):
+        assert writer.savevms(_block(vm, 0, 10))
+    writer.stop()
+
+    stats = writer.getstats()
+    assert (stats["written"], stats["commits"], stats["failed"], stats["dropped"], stats["queued"]) == (30, 1, 0, 0, 0)
+    stored = _stored(filename)
+    assert sorted(stored) == [ "00000000-0000-0000-0000-{:012d}".format(vm) for vm in range(3) ]
+    assert all(len(samples) == 10 for samples in stored.values())
+
+# While the storage is busy, the first block is being stored and the second one fills the queue, so the third one is dropped (and only
+#   that one is reported)
+def test_drop_on_full(tmp_path):
+    filename = str(tmp_path / "osidled.db")
+    storage = _SlowStorage(filename)
+    writer = StorageWriter(storage, queue_size = 1, commit_size = 1, put_timeout = 0.01)
+    assert writer.start()
+    assert writer.savevms(_block(0, 0, 5))
+    assert storage.storing.wait(10)
+    assert writer.savevms(_block(0, 5, 5))
+    assert not writer.savevms(_block(0, 10, 7))
+
+    stats = writer.getstats()
+    assert (stats["queued"], stats["maxqueued"], stats["blocked"], stats["dropped"], stats["written"]) == (1, 1, 1, 7, 0)
+
+    storage.release.set()
+    writer.stop()
+
+    stats = writer.getstats()
+    assert (stats["written"], stats["commits"], stats["failed"], stats["dropped"], stats["blocked"]) == (10, 2, 0, 7, 1)
+    (samples,) = _stored(filename).values()
+    assert samples == [ 1759968000 + 300 * i for i in range(10) ]